@@ -0,0 +1,134 @@
+"""
+Local copies of the files attached to the synced documents
+
+    store = AttachmentStore("attachments", bandwidth=1000000)
+    sclient = DummySyncedClient(attachments=store)
+    sclient.sync()              # also downloads the files missing from store
+    open(store.path(file_hash), "rb")
+
+Files are stored by the sha1 of their content, a file attached to several
+documents, or to documents of several groups, is downloaded and stored once.
+A download is written to a temporary file and only moved to its place once
+its sha1 is checked, so the store only has complete files and the files
+downloaded by previous runs are never downloaded again.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+# size of the writes to disk
+CHUNK_SIZE = 64 * 1024
+
+# suffix of the files being written
+PARTIAL_SUFFIX = ".part"
+
+# hex sha1, anything else could name a path outside of the store
+FILE_HASH = re.compile(r"[0-9a-f]{40}\Z")
+
+class AttachmentError(Exception):
+    pass
+
+def valid_file_hash(file_hash):
+    return isinstance(file_hash, basestring) and FILE_HASH.match(file_hash) is not None
+
+def chunked(data, size=CHUNK_SIZE):
+    """The chunks of a string for AttachmentStore.add"""
+    for start in xrange(0, len(data), size):
+        yield data[start:start + size]
+
+class BandwidthLimiter(object):
+    """Spaces out transfers shared by several threads so that on average
+       they don't go above bytes_per_second"""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = float(bytes_per_second)
+        self.lock = threading.Lock()
+        # when the transfers reserved so far are done at the full rate
+        self.available = 0
+
+    def reserve(self, size):
+        """Wait until size more bytes can be transferred"""
+        with self.lock:
+            now = time.time()
+            start = max(now, self.available)
+            self.available = start + size / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+class AttachmentStore(object):
+    """Directory of files named by the sha1 of their content
+
+       bandwidth: bytes per second of the downloads of every client using
+       the store, None for no limit"""
+
+    def __init__(self, directory, bandwidth=None):
+        self.directory = directory
+        self.limiter = BandwidthLimiter(bandwidth) if bandwidth else None
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.completed = self.scan()
+
+    def scan(self):
+        # the files stored by the previous runs, and the partial ones of a
+        # run that was killed to remove
+        completed = set()
+        for parent, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(PARTIAL_SUFFIX):
+                    os.remove(os.path.join(parent, filename))
+                elif valid_file_hash(filename):
+                    completed.add(filename)
+        return completed
+
+    def __contains__(self, file_hash):
+        with self.lock:
+            return file_hash in self.completed
+
+    def __len__(self):
+        with self.lock:
+            return len(self.completed)
+
+    def path(self, file_hash):
+        """Where the file is stored, raises AttachmentError if file_hash
+           isn't a sha1"""
+        if not valid_file_hash(file_hash):
+            raise AttachmentError("invalid file hash %r" % (file_hash,))
+        return os.path.join(self.directory, file_hash[:2], file_hash)
+
+    def throttle(self, size):
+        """Wait for the bandwidth to download size bytes"""
+        if self.limiter is not None and size:
+            self.limiter.reserve(size)
+
+    def add(self, file_hash, chunks):
+        """Write the chunks of a file to the store, raises AttachmentError
+           and keeps nothing if their sha1 isn't file_hash"""
+        path = self.path(file_hash)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                # made by another thread
+                if not os.path.isdir(parent):
+                    raise
+        descriptor, partial = tempfile.mkstemp(suffix=PARTIAL_SUFFIX, dir=parent)
+        try:
+            sha1 = hashlib.sha1()
+            with os.fdopen(descriptor, "wb") as outf:
+                for chunk in chunks:
+                    sha1.update(chunk)
+                    outf.write(chunk)
+            if sha1.hexdigest() != file_hash:
+                raise AttachmentError("sha1 of %s is %s" % (file_hash, sha1.hexdigest()))
+            os.rename(partial, path)
+        except:
+            os.remove(partial)
+            raise
+        with self.lock:
+            self.completed.add(file_hash)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the client and the sync engine against local_server.py
+
+Every benchmark runs in its own process, with the server in another one, and
+reports its timings, the api calls it made and the memory high-water mark of
+the client process. Results are written as json so runs of different
+versions can be compared.
+
+python run-benchmarks.py --output results.json
+python run-benchmarks.py --only sync --sizes 1000,10000
+
+"""
+
+import gc
+import json
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from utils import *
+
+import apidefinitions
+import requests
+from requests.structures import CaseInsensitiveDict
+from mendeley_client import MendeleyRemoteMethod, MendeleyTokensStore
+from local_server import LocalLibrary, LocalServerProcess, create_local_client
+from replica import DocumentReplica
+from sync_runner import sync_accounts
+from sync_pipeline import DocumentSyncPipeline
+from synced_client import DummySyncedClient, SyncedDocument, SyncStatus
+
+def canned_response(body):
+    response = requests.Response()
+    response.status_code = 200
+    response.headers = CaseInsensitiveDict({"Content-Type": "application/json; charset=utf-8"})
+    response.encoding = "utf-8"
+    response._content = json.dumps(body)
+    return response
+
+def bench_dispatch(calls):
+    """Cost of a MendeleyRemoteMethod call without the network: url
+       building, response handling and json decoding"""
+    response = canned_response({"id": 1, "version": 1, "type": "Book", "title": "Dispatch",
+                                "authors": [{"forename": "A", "surname": "B"}]})
+    method = MendeleyRemoteMethod(apidefinitions.methods["document_details"],
+                                  lambda *args: response, "document_details")
+
+    def run():
+        for i in xrange(calls):
+            method(i)
+
+    results = {"calls": calls}
+    for label, enabled in [("metrics_disabled", False), ("metrics_enabled", True)]:
+        metrics.registry.enabled = enabled
+        timing, _ = measure(run, 3)
+        timing["us_per_call"] = timing["seconds"] / calls * 1000000
+        results[label] = timing
+    return results
+
+def bench_endpoint(documents, calls, concurrency, latency):
+    """Throughput of document_details calls against the local server"""
+    with LocalServerProcess(documents, latency) as server:
+        client = create_local_client(server.base_url)
+        ids = client.library(items=calls)["document_ids"]
+
+        results = {"calls": len(ids), "latency": latency}
+        sequential, _ = measure(lambda: [client.document_details(i) for i in ids])
+        sequential["calls_per_second"] = len(ids) / sequential["seconds"]
+        results["sequential"] = sequential
+
+        pool = ThreadPool(concurrency)
+        concurrent, _ = measure(lambda: pool.map(client.document_details, ids))
+        pool.close()
+        concurrent["calls_per_second"] = len(ids) / concurrent["seconds"]
+        concurrent["concurrency"] = concurrency
+        results["concurrent"] = concurrent
+        return results
+
+def bench_sync(documents, latency):
+    """Full DummySyncedClient.sync() of a library, first with an empty
+       local state (cold) then again with nothing changed (warm)"""
+    with LocalServerProcess(documents, latency) as server:
+        sclient = DummySyncedClient(client=create_local_client(server.base_url))
+
+        results = {"documents": documents, "latency": latency}
+        for label in ["cold", "warm"]:
+            metrics.registry.reset()
+            timing, _ = measure(sclient.sync)
+            timing["requests"] = request_counts()
+            timing["synced_documents"] = len(sclient.documents)
+            results[label] = timing
+        return results
+
+def bench_local_changes(documents, edits, latency):
+    """Sync of a few local edits on a large library, the local changes
+       phase should only depend on the number of edits"""
+    with LocalServerProcess(documents, latency) as server:
+        sclient = DummySyncedClient(client=create_local_client(server.base_url))
+        # build the synced state from the listing, fetching the details
+        # of every document would dominate the run
+        for page in sclient.fetch_library_pages():
+            for document in page["documents"]:
+                sclient.add_document(SyncedDocument(document, SyncStatus.Synced))
+
+        for doc_id in sorted(sclient.documents.keys())[:edits]:
+            sclient.documents[doc_id].update({"title": "edited"})
+
+        metrics.registry.reset()
+        remote, remote_deleted_ids = measure(sclient.sync_remote_changes)
+        local, _ = measure(lambda: sclient.sync_local_changes(remote_deleted_ids))
+        return {"documents": documents, "edits": edits, "latency": latency,
+                "remote_changes": remote, "local_changes": local,
+                "requests": request_counts()}
+
+def bench_pipeline(documents, edits, latency):
+    """Sync of edits made on the server and as many made locally, with the
+       stages run one after the other (staged) and concurrently (pipelined)"""
+    with LocalServerProcess(documents, latency) as server:
+        client = create_local_client(server.base_url)
+        results = {"documents": documents, "edits": edits, "latency": latency}
+        for i, label in enumerate(["staged", "pipelined"]):
+            sclient = DummySyncedClient(client=client)
+            for page in sclient.fetch_library_pages():
+                for document in page["documents"]:
+                    sclient.add_document(SyncedDocument(document, SyncStatus.Synced))
+            # spread over the library, the remote edits differ between runs
+            doc_ids = sorted(sclient.documents.keys())
+            step = max(1, len(doc_ids) // (2 * edits))
+            for doc_id in doc_ids[::step][:2 * edits:2]:
+                sclient.documents[doc_id].update({"title": "local %d" % i})
+            for doc_id in doc_ids[1::step][:2 * edits:2]:
+                client.update_document(doc_id, document={"title": "remote %d" % i})
+
+            metrics.registry.reset()
+            if label == "staged":
+                def sync():
+                    sclient.sync_local_changes(sclient.sync_remote_changes())
+                    sclient.send_new_documents()
+                timing, _ = measure(sync)
+            else:
+                timing, _ = measure(DocumentSyncPipeline(sclient, sclient.compare_library(True)).run)
+            timing["requests"] = request_counts()
+            timing["stages"] = metrics.registry.snapshot()["stages"]
+            results[label] = timing
+        return results
+
+def bench_noop_sync(documents, latency):
+    """Sync of an unchanged library, comparing every document (full) and
+       only those above the watermark (incremental)"""
+    with LocalServerProcess(documents, latency) as server:
+        sclient = DummySyncedClient(client=create_local_client(server.base_url))
+        for page in sclient.fetch_library_pages():
+            for document in page["documents"]:
+                sclient.add_document(SyncedDocument(document, SyncStatus.Synced))
+        # the watermark is set after two syncs
+        sclient.sync()
+        sclient.sync()
+
+        results = {"documents": documents, "latency": latency}
+        for label, full in [("full", True), ("incremental", False)]:
+            metrics.registry.reset()
+            timing, _ = measure(lambda: sclient.sync(full), 3)
+            timing["requests"] = request_counts()
+            results[label] = timing
+        return results
+
+def fill_replica(base_url, filename):
+    sclient = DummySyncedClient(client=create_local_client(base_url), replica=DocumentReplica(filename))
+    sclient.sync()
+    sclient.replica.close()
+    return {}
+
+def bench_replica(documents, cache_size, latency):
+    """Full sync of an unchanged library from a replica filled by another
+       process, with every document in memory or at most cache_size"""
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, "replica.db")
+    try:
+        with LocalServerProcess(documents, latency) as server:
+            run_isolated(fill_replica, server.base_url, filename)
+            replica = DocumentReplica(filename, cache_size=cache_size)
+            sclient = DummySyncedClient(client=create_local_client(server.base_url), replica=replica)
+            metrics.registry.reset()
+            timing, _ = measure(lambda: sclient.sync(True))
+            timing["requests"] = request_counts()
+            timing.update({"documents": documents, "cache_size": cache_size, "latency": latency,
+                           "loaded": len(sclient.documents.loaded) + len(sclient.documents.pinned) if cache_size else len(sclient.documents)})
+            replica.close()
+            return timing
+    finally:
+        shutil.rmtree(directory)
+
+def bench_bounded_rss(sizes, cache_size, latency):
+    """Memory high-water mark of bench_replica with a bounded cache at each
+       library size, it is flat when, between the two largest sizes, the
+       growth per extra document stays well below what keeping the
+       documents in memory costs. The smaller sizes still fill the cache."""
+    results = {}
+    for size in sizes:
+        results[size] = run_isolated(bench_replica, size, cache_size, latency)["max_rss_kb"]
+    smallest, largest = sorted(sizes)[-2:] if len(sizes) > 1 else (sizes[0], sizes[0])
+    growth = (results[largest] - results[smallest]) * 1024.0 / max(largest - smallest, 1)
+    return {"max_rss_kb_by_size": results, "bytes_per_extra_document": growth, "flat": growth < 64}
+
+class LocalClientFactory(object):
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def __call__(self, account, access_token):
+        return create_local_client(self.base_url, access_token)
+
+def bench_accounts(accounts, documents, latency):
+    """Sync of many accounts by sync_runner, one account at a time and
+       many at once per process, every account syncs the same library"""
+    with LocalServerProcess(documents, latency) as server:
+        tokens_store = MendeleyTokensStore(None)
+        for i in range(accounts):
+            tokens_store.add_account("account%d" % i, "token%d" % i)
+        results = {"accounts": accounts, "documents": documents, "latency": latency}
+        for label, accounts_per_process in [("serial", 1), ("concurrent", 16)]:
+            report = sync_accounts(tokens_store, LocalClientFactory(server.base_url),
+                                   accounts_per_process=accounts_per_process, connections=32)
+            results[label] = {"seconds": report["seconds"],
+                              "accounts_per_second": report["accounts_per_second"],
+                              "failed": len(report["failed"]),
+                              "sync_seconds": report["sync_seconds"],
+                              "request_latency": report["request_latency"]}
+        return results
+
+def bench_groups(groups, documents, latency):
+    """Sync of many group libraries, one after the other and in parallel
+       with a shared concurrency budget"""
+    with LocalServerProcess(0, latency, groups=groups, group_documents=documents) as server:
+        results = {"groups": groups, "documents_per_group": documents, "latency": latency}
+        for label in ["sequential", "parallel"]:
+            sclient = DummySyncedClient(client=create_local_client(server.base_url))
+            sclient.add_all_groups()
+            metrics.registry.reset()
+            if label == "sequential":
+                timing, _ = measure(lambda: [group.sync() for group in sclient.groups.values()])
+            else:
+                timing, _ = measure(sclient.sync_groups)
+            timing["requests"] = request_counts()
+            results[label] = timing
+        return results
+
+class Attributes:
+    pass
+
+class AttributeDocument:
+    """Documents as they were stored before synced_client.Record, an
+       instance __dict__ for the document and one for its fields"""
+
+    def __init__(self, obj):
+        self.tracker = None
+        self.status = SyncStatus.Synced
+        self.changes = {}
+        self.object = Attributes()
+        for key in obj.keys():
+            setattr(self.object, key, obj[key])
+
+    def to_json(self):
+        obj = {}
+        for key in vars(self.object):
+            if key in SyncedDocument.document_fields:
+                obj[key] = getattr(self.object, key)
+        return obj
+
+def container_bytes(document):
+    """Size of the objects holding a document, without the values"""
+    size = sys.getsizeof(document) + sys.getsizeof(document.changes) + sys.getsizeof(document.object)
+    if isinstance(document, AttributeDocument):
+        return size + sys.getsizeof(vars(document)) + sys.getsizeof(vars(document.object))
+    return size + sys.getsizeof(document.object.values)
+
+def bench_documents(documents):
+    """Memory used per document and to_json throughput of SyncedDocument,
+       compared with plain attribute objects"""
+    library = LocalLibrary()
+    details = [library.document_details(doc_id) for doc_id in library.seed_documents(documents)]
+
+    results = {"documents": documents}
+    for label, create in [("attributes", AttributeDocument),
+                          ("synced_document", lambda obj: SyncedDocument(obj, SyncStatus.Synced))]:
+        gc.collect()
+        before = rss_kb()
+        instances = [create(obj) for obj in details]
+        gc.collect()
+        after = rss_kb()
+
+        to_json = lambda: [i.to_json() for i in instances]
+        timing, _ = measure(to_json, 3)
+        timing["documents_per_second"] = documents / timing["seconds"]
+        results[label] = {"container_bytes_per_document": sum(map(container_bytes, instances)) / float(documents),
+                          "to_json": timing}
+        if before is not None:
+            results[label]["rss_bytes_per_document"] = (after - before) * 1024.0 / documents
+        instances = to_json = None
+    return results
+
+def bench_files(size_mb, latency):
+    """Upload and download throughput of a single file"""
+    with LocalServerProcess(0, latency) as server:
+        client = create_local_client(server.base_url)
+        document_id = client.create_document(document={"type": "Book", "title": "files"})["document_id"]
+
+        fd, filename = tempfile.mkstemp(suffix=".pdf")
+        try:
+            os.write(fd, os.urandom(size_mb * 1024 * 1024))
+            os.close(fd)
+            upload, response = measure(lambda: client.upload_pdf(document_id, filename), 3)
+            file_hash = response["file_hash"]
+        finally:
+            os.remove(filename)
+
+        download, _ = measure(lambda: client.download_file(document_id, file_hash), 3)
+        upload["mb_per_second"] = size_mb / upload["seconds"]
+        download["mb_per_second"] = size_mb / download["seconds"]
+        return {"size_mb": size_mb, "latency": latency, "upload": upload, "download": download}
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--output", help="json file to write the results to, stdout by default")
+    parser.add_option("--only", help="comma separated list of benchmark name prefixes to run")
+    parser.add_option("--sizes", default="1000,10000,100000", help="library sizes of the sync benchmarks")
+    parser.add_option("--latency", type="float", default=0.0, help="latency of the local server in seconds")
+    parser.add_option("--concurrency", type="int", default=8)
+    options, _ = parser.parse_args()
+
+    cases = [("dispatch", bench_dispatch, (20000,)),
+             ("endpoint", bench_endpoint, (1000, 500, options.concurrency, options.latency)),
+             ("files", bench_files, (8, options.latency)),
+             ("documents", bench_documents, (100000,)),
+             ("groups", bench_groups, (50, 20, options.latency)),
+             ("accounts", bench_accounts, (64, 50, options.latency))]
+    sizes = [int(size) for size in options.sizes.split(",")]
+    cases.append(("bounded_rss", bench_bounded_rss, (sizes, 1000, options.latency)))
+    for size in sizes:
+        cases.append(("sync_%d" % size, bench_sync, (size, options.latency)))
+        cases.append(("local_changes_%d" % size, bench_local_changes, (size, 10, options.latency)))
+        cases.append(("noop_sync_%d" % size, bench_noop_sync, (size, options.latency)))
+        cases.append(("pipeline_%d" % size, bench_pipeline, (size, 50, options.latency)))
+        cases.append(("replica_%d" % size, bench_replica, (size, None, options.latency)))
+        cases.append(("replica_bounded_%d" % size, bench_replica, (size, 1000, options.latency)))
+
+    if options.only:
+        prefixes = options.only.split(",")
+        cases = [case for case in cases if any(case[0].startswith(prefix) for prefix in prefixes)]
+
+    results = {"environment": environment(), "benchmarks": {}}
+    for name, fn, args in cases:
+        results["benchmarks"][name] = run_isolated(fn, *args)
+    write_results(results, options.output)
+
+if __name__ == "__main__":
+    main()
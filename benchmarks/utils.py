@@ -0,0 +1,104 @@
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+
+import metrics
+
+def max_rss_kb():
+    """High-water mark of the resident memory of this process"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes on osx, kilobytes on linux
+        usage /= 1024
+    return usage
+
+def rss_kb():
+    """Current resident memory of this process, None where /proc isn't available"""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except IOError:
+        return None
+    return pages * resource.getpagesize() // 1024
+
+def cpu_seconds():
+    """User and system time used by this process"""
+    times = os.times()
+    return times[0] + times[1]
+
+def measure(fn, repeat=1):
+    """Call fn repeat times, return the timings in seconds and the
+       result of the last call"""
+    timings = []
+    cpu_timings = []
+    result = None
+    for i in range(repeat):
+        gc.collect()
+        start = time.time()
+        cpu_start = cpu_seconds()
+        result = fn()
+        cpu_timings.append(cpu_seconds() - cpu_start)
+        timings.append(time.time() - start)
+    timings.sort()
+    cpu_timings.sort()
+    return {"seconds": timings[len(timings) // 2],
+            "min_seconds": timings[0],
+            "max_seconds": timings[-1],
+            "cpu_seconds": cpu_timings[len(cpu_timings) // 2],
+            "repeat": repeat}, result
+
+def request_counts():
+    """Number of api calls per method recorded by the metrics registry"""
+    methods = metrics.registry.snapshot()["methods"]
+    return dict((name, method["latency"]["count"]) for name, method in methods.items())
+
+def _run_child(connection, fn, args):
+    try:
+        metrics.registry.enable()
+        result = fn(*args)
+        result["max_rss_kb"] = max_rss_kb()
+        connection.send(result)
+    except Exception as e:
+        connection.send({"error": "%s: %s" % (type(e).__name__, e)})
+    connection.close()
+
+def run_isolated(fn, *args):
+    """Run fn(*args) in a fresh process so the memory high-water mark only
+       covers this benchmark, fn must return a dict"""
+    parent_connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_child, args=(child_connection, fn, args))
+    process.start()
+    result = parent_connection.recv()
+    process.join()
+    return result
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=parent_dir,
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": multiprocessing.cpu_count(),
+            "revision": git_revision(),
+            "timestamp": time.time()}
+
+def write_results(results, filename=None):
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if filename:
+        with open(filename, "w") as outf:
+            outf.write(output + "\n")
+    else:
+        print output
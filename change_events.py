@@ -0,0 +1,113 @@
+"""
+Consumers of the synced_client.ChangeEvents of a DummySyncedClient
+
+Every change a sync makes to the documents (added, updated with the fields
+changed, deleted, conflict resolved) is sent to the functions in
+sclient.change_listeners, on the threads of the sync, so only the changes
+need to be looked at after a sync instead of the whole library.
+
+    sclient.change_listeners.append(callback)
+
+    queue = ChangeQueue(maxsize=1000)
+    sclient.change_listeners.append(queue)
+    event = queue.get()
+
+    log = ChangeLog("changes.log")
+    sclient.change_listeners.append(log)
+    for offset, event in log.read(last_offset):
+        ...
+
+Listeners run while the sync holds the lock of the client, they must not
+wait for anything done with the client.
+"""
+
+import Queue
+import json
+import os
+import threading
+
+from synced_client import ChangeEvent
+
+class ChangeQueue(object):
+    """Bounded queue of ChangeEvents for a consumer thread, while it's full
+       the sync waits for the consumer instead of events being dropped"""
+
+    def __init__(self, maxsize=1000):
+        self.queue = Queue.Queue(maxsize)
+
+    def __call__(self, event):
+        self.queue.put(event)
+
+    def get(self, timeout=None):
+        """Next event, raises Queue.Empty if none came within timeout seconds"""
+        return self.queue.get(True, timeout)
+
+    def drain(self):
+        """The events queued so far, without waiting"""
+        events = []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except Queue.Empty:
+                return events
+
+class ChangeLog(object):
+    """Append only file of ChangeEvents, a json object per line
+
+       The offset of an event is the position of the line after it, a
+       consumer keeps the offset of the last event it processed and resumes
+       reading from there. Lines are flushed as they are written, with fsync
+       they are also on disk before the sync goes on."""
+
+    def __init__(self, filename, fsync=False):
+        self.filename = filename
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.file = open(filename, "a+b")
+        self.truncate_partial_line()
+
+    def truncate_partial_line(self):
+        # a line cut short by a crash would be joined to the next one
+        self.file.seek(0, os.SEEK_END)
+        size = position = self.file.tell()
+        complete = 0
+        while position > 0:
+            start = max(0, position - 4096)
+            self.file.seek(start)
+            newline = self.file.read(position - start).rfind("\n")
+            if newline >= 0:
+                complete = start + newline + 1
+                break
+            position = start
+        if complete != size:
+            self.file.truncate(complete)
+
+    def __call__(self, event):
+        line = json.dumps(event.to_dict(), sort_keys=True) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def end_offset(self):
+        """Offset after the last event, where the next one will be written"""
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            return self.file.tell()
+
+    def read(self, offset=0):
+        """Yield (offset, ChangeEvent) of the events after offset, offset
+           being where the next one starts"""
+        with open(self.filename, "rb") as inf:
+            inf.seek(offset)
+            for line in iter(inf.readline, ""):
+                if not line.endswith("\n"):
+                    # still being written
+                    return
+                offset += len(line)
+                yield offset, ChangeEvent.from_dict(json.loads(line))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,159 @@
+"""
+Helpers to run blocking api calls in parallel on threads
+"""
+
+import Queue
+import collections
+import itertools
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import metrics
+import tracing
+
+def _traced(fn, submitted, item):
+    # the time spent waiting for a free worker is recorded by the first api
+    # call of fn, which knows the method name
+    tracing.tracer.queued(submitted)
+    try:
+        return fn(item)
+    finally:
+        tracing.tracer.queued(None)
+
+def bounded_imap(fn, items, workers):
+    """Like itertools.imap(fn, items) with up to workers calls running at
+       once on threads. Results are yielded in the order of items and at
+       most workers of them are in flight or waiting to be consumed, so a slow
+       consumer applies backpressure. Exceptions raised by fn are re-raised
+       when their result is reached."""
+    items = iter(items)
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+
+    def submit(count):
+        for item in itertools.islice(items, count):
+            if tracing.tracer.enabled:
+                pending.append(pool.apply_async(_traced, (fn, time.time(), item)))
+            else:
+                pending.append(pool.apply_async(fn, (item,)))
+
+    try:
+        submit(workers)
+        while pending:
+            result = pending.popleft().get()
+            submit(1)
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+class Budgeted(object):
+    """Proxy of an object whose method calls first take a slot of a
+       semaphore, proxies sharing the semaphore never have more calls in
+       flight than it allows, whatever their own concurrency"""
+
+    def __init__(self, target, semaphore):
+        self.target = target
+        self.semaphore = semaphore
+
+    def __getattr__(self, name):
+        attribute = getattr(self.target, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with self.semaphore:
+                return attribute(*args, **kwargs)
+        return call
+
+# put in the queue of a stage once per worker when its producers are done
+_DONE = object()
+
+class Stage(object):
+    """Worker threads calling fn on the items put in a bounded queue, fn
+       passes its results on by putting them in the following stages of the
+       pipeline. put() blocks while the queue is full so a slow stage slows
+       down the stages feeding it instead of queueing without bound.
+
+       The workers stop once each of the producers called close() and the
+       queue is drained. An exception raised by fn is re-raised by join(),
+       the items still coming are taken from the queue and dropped so the
+       producers never block forever."""
+
+    def __init__(self, name, fn, workers=1, maxsize=None, producers=1):
+        self.name = name
+        self.fn = fn
+        self.queue = Queue.Queue(maxsize or 2 * workers)
+        self.producers = producers
+        self.error = None
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work, name="%s-%d" % (name, i)) for i in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def put(self, item):
+        if not metrics.registry.enabled:
+            self.queue.put(item)
+            return
+        start = time.time()
+        self.queue.put(item)
+        metrics.registry.record_queue_put(self.name, self.queue.qsize(), time.time() - start)
+
+    def close(self):
+        """Called by each producer once it put its last item"""
+        with self._lock:
+            self.producers -= 1
+            done = self.producers == 0
+        if done:
+            for thread in self.threads:
+                self.queue.put(_DONE)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                return
+            if self.error is not None:
+                continue
+            start = time.time()
+            try:
+                with tracing.tracer.span(self.name):
+                    self.fn(item)
+            except Exception:
+                self.error = sys.exc_info()
+            if metrics.registry.enabled:
+                metrics.registry.record_stage_item(self.name, time.time() - start)
+
+def run_stages(stages):
+    """Wait for a chain of started stages, each stage being the only producer
+       of the next one still to be closed. Every stage is waited for even
+       when one fails, the first error is then re-raised."""
+    error = None
+    for i, stage in enumerate(stages):
+        try:
+            stage.join()
+        except Exception:
+            if error is None:
+                error = sys.exc_info()
+        if i + 1 < len(stages):
+            stages[i + 1].close()
+    if error is not None:
+        raise error[0], error[1], error[2]
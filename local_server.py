@@ -0,0 +1,746 @@
+#!/usr/bin/env python
+
+"""
+Local stand-in for the Mendeley Open API
+
+A wsgiref based server implementing the user library, folders, groups and
+files routes of apidefinitions.methods with the semantics the clients rely
+on: versions bumped on every update, 204 on deletes, paged listings and file
+downloads going through a redirect. Public, stats and profile resources
+return empty results.
+
+Documents created with seed_documents are synthetic: only their id and
+version are stored until they are read or modified, so libraries of several
+hundred thousand documents fit comfortably in memory.
+
+In process usage:
+
+    server = LocalServer(latency=0.01).start()
+    server.library.seed_documents(100000)
+    client = create_local_client(server.base_url)
+    ...
+    server.stop()
+
+In a child process (see LocalServerProcess) or from the command line:
+
+python local_server.py --port 8080 --documents 100000 --latency 0.01
+
+"""
+
+import hashlib
+import httplib
+import json
+import multiprocessing
+import optparse
+import random
+import re
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+from wsgiref.util import application_uri
+
+import apidefinitions
+
+DEFAULT_ITEMS_PER_PAGE = 20
+MAX_ITEMS_PER_PAGE = 1000
+
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+class Response(object):
+
+    def __init__(self, status=200, body=None, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or []
+
+class IdList(object):
+    """Ordered set of ids with offset paging, deletions are applied lazily
+       on the next listing to keep them O(1)"""
+
+    def __init__(self):
+        self.ids = []
+        self.members = set()
+        self.removed = False
+
+    def __contains__(self, item_id):
+        return item_id in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, item_id):
+        if item_id in self.members:
+            return
+        self.members.add(item_id)
+        self.ids.append(item_id)
+
+    def remove(self, item_id):
+        if item_id not in self.members:
+            return False
+        self.members.remove(item_id)
+        self.removed = True
+        return True
+
+    def all(self):
+        if self.removed:
+            self.ids = [item_id for item_id in self.ids if item_id in self.members]
+            self.removed = False
+        return self.ids
+
+    def page(self, page, items):
+        ids = self.all()
+        return ids[page * items:(page + 1) * items]
+
+class LocalLibrary(object):
+    """Server side state: documents, files, folders and groups of a single user"""
+
+    def __init__(self, seed=0, abstract_size=400):
+        self.seed = seed
+        self.abstract_size = abstract_size
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        # versions are timestamps on the real server, use a clock that
+        # ticks on every modification to never hand out the same version twice
+        self.clock = int(time.time())
+        self.next_id = 1
+
+        self.versions = {}
+        # None for synthetic documents that have never been read
+        self.documents = {}
+        self.library = IdList()
+        self.files = {}
+        self.folders = {}
+        self.groups = {}
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def new_id(self):
+        new_id = self.next_id
+        self.next_id += 1
+        return new_id
+
+    # Documents #
+
+    def synthetic_document(self, document_id):
+        rand = random.Random(self.seed * 1000003 + document_id)
+        words = ["sync", "paper", "graph", "protein", "model", "network", "library",
+                 "analysis", "cell", "theory", "learning", "quantum", "data"]
+        abstract = []
+        while sum(len(word) + 1 for word in abstract) < self.abstract_size:
+            abstract.append(rand.choice(words))
+        return {"type": "Journal Article",
+                "title": "Synthetic document %d about %s" % (document_id, rand.choice(words)),
+                "authors": [{"forename": "Author%d" % rand.randint(0, 999), "surname": "Surname%d" % i}
+                            for i in range(rand.randint(1, 4))],
+                "year": rand.randint(1950, 2013),
+                "tags": rand.sample(words, 2),
+                "abstract": " ".join(abstract)}
+
+    def seed_documents(self, count, group_id=None):
+        """Add count synthetic documents to the library or a group, returns their ids"""
+        with self.lock:
+            ids = []
+            target = self.library if group_id is None else self.group(group_id)["documents"]
+            for i in xrange(count):
+                document_id = self.new_id()
+                # as if they were added one after the other
+                self.versions[document_id] = self.tick()
+                self.documents[document_id] = None
+                target.add(document_id)
+                ids.append(document_id)
+            return ids
+
+    def document_data(self, document_id):
+        data = self.documents[document_id]
+        if data is None:
+            data = self.documents[document_id] = self.synthetic_document(document_id)
+        return data
+
+    def check_document(self, document_id, group_id=None):
+        if document_id not in self.versions:
+            raise HttpError(404, "document not found")
+        ids = self.library if group_id is None else self.group(group_id)["documents"]
+        if document_id not in ids:
+            raise HttpError(404, "document not found")
+
+    def document_details(self, document_id, group_id=None):
+        with self.lock:
+            self.check_document(document_id, group_id)
+            details = dict(self.document_data(document_id))
+            version = self.versions[document_id]
+            details["id"] = document_id
+            details["version"] = version
+            details["lastUpdate"] = version
+            if group_id is not None:
+                details["group_id"] = group_id
+            return details
+
+    def create_document(self, document):
+        with self.lock:
+            document = dict(document)
+            if "type" not in document:
+                raise HttpError(400, "type is required")
+            group_id = document.pop("group_id", None)
+            for key in ["id", "version", "lastUpdate"]:
+                document.pop(key, None)
+            target = self.library if group_id is None else self.group(int(group_id))["documents"]
+
+            document_id = self.new_id()
+            self.documents[document_id] = document
+            self.versions[document_id] = self.tick()
+            target.add(document_id)
+            return document_id, self.versions[document_id]
+
+    def update_document(self, document_id, changes):
+        with self.lock:
+            # documents of groups can be updated too
+            if document_id not in self.versions:
+                raise HttpError(404, "document not found")
+            for key in ["id", "version", "lastUpdate"]:
+                if key in changes:
+                    raise HttpError(400, "%s can't be updated" % key)
+            self.document_data(document_id).update(changes)
+            self.versions[document_id] = self.tick()
+            return self.versions[document_id]
+
+    def delete_document(self, document_id, group_id=None):
+        with self.lock:
+            self.check_document(document_id, group_id)
+            if group_id is None:
+                self.library.remove(document_id)
+            else:
+                group = self.group(group_id)
+                group["documents"].remove(document_id)
+                for folder in group["folders"].values():
+                    folder["documents"].remove(document_id)
+            for folder in self.folders.values():
+                folder["documents"].remove(document_id)
+            del self.versions[document_id]
+            del self.documents[document_id]
+
+    def add_file(self, document_id, file_name, data, group_id=None):
+        with self.lock:
+            self.check_document(document_id, group_id)
+            file_hash = hashlib.sha1(data).hexdigest()
+            self.files[file_hash] = (file_name, data)
+            document = self.document_data(document_id)
+            files = document.setdefault("files", [])
+            if file_hash not in [f["file_hash"] for f in files]:
+                extension = file_name.rsplit(".", 1)[-1] if "." in file_name else ""
+                files.append({"file_hash": file_hash, "file_extension": extension,
+                              "file_size": len(data), "file_name": file_name})
+            self.versions[document_id] = self.tick()
+            return file_hash
+
+    def check_file(self, document_id, file_hash, group_id=None):
+        with self.lock:
+            self.check_document(document_id, group_id)
+            files = self.document_data(document_id).get("files", [])
+            if file_hash not in [f["file_hash"] for f in files]:
+                raise HttpError(404, "file not found")
+
+    # Folders #
+
+    def new_folder(self, folders, folder):
+        if "name" not in folder:
+            raise HttpError(400, "name is required")
+        parent = folder.get("parent")
+        if parent is not None and int(parent) not in folders:
+            raise HttpError(400, "unknown parent folder")
+        folder_id = self.new_id()
+        folders[folder_id] = {"name": folder["name"],
+                              "parent": int(parent) if parent is not None else None,
+                              "documents": IdList()}
+        return folder_id
+
+    def folder(self, folder_id, group_id=None):
+        folders = self.folders if group_id is None else self.group(group_id)["folders"]
+        if folder_id not in folders:
+            raise HttpError(404, "folder not found")
+        return folders[folder_id]
+
+    def remove_folder(self, folders, folder_id):
+        if folder_id not in folders:
+            raise HttpError(404, "folder not found")
+        # deleting a folder deletes its subfolders
+        for child_id in [i for i, f in folders.items() if f["parent"] == folder_id]:
+            self.remove_folder(folders, child_id)
+        del folders[folder_id]
+
+    def folders_json(self, folders):
+        result = []
+        for folder_id in sorted(folders.keys()):
+            folder = folders[folder_id]
+            info = {"id": folder_id, "name": folder["name"], "size": len(folder["documents"])}
+            if folder["parent"] is not None:
+                info["parent"] = folder["parent"]
+            result.append(info)
+        return result
+
+    # Groups #
+
+    def group(self, group_id):
+        if group_id not in self.groups:
+            raise HttpError(404, "group not found")
+        return self.groups[group_id]
+
+    def create_group(self, group):
+        with self.lock:
+            if "name" not in group:
+                raise HttpError(400, "name is required")
+            group_id = self.new_id()
+            self.groups[group_id] = {"name": group["name"],
+                                     "type": group.get("type", "private"),
+                                     "documents": IdList(),
+                                     "folders": {}}
+            return group_id
+
+    def seed_groups(self, count, documents):
+        """Add count groups of documents synthetic documents, returns their ids"""
+        group_ids = []
+        for i in xrange(count):
+            group_id = self.create_group({"name": "Synthetic group %d" % i})
+            self.seed_documents(documents, group_id)
+            group_ids.append(group_id)
+        return group_ids
+
+    def delete_group(self, group_id):
+        with self.lock:
+            group = self.group(group_id)
+            for document_id in list(group["documents"].all()):
+                self.delete_document(document_id, group_id)
+            del self.groups[group_id]
+
+def paged(ids, params):
+    """Listing in the format of the library and group_documents methods"""
+    try:
+        page = int(params.get("page", 0))
+        items = min(int(params.get("items", DEFAULT_ITEMS_PER_PAGE)), MAX_ITEMS_PER_PAGE)
+    except ValueError:
+        raise HttpError(400, "invalid paging parameters")
+    if page < 0 or items <= 0:
+        raise HttpError(400, "invalid paging parameters")
+    total = len(ids)
+    return {"total_results": total,
+            "total_pages": (total + items - 1) // items,
+            "current_page": page,
+            "items_per_page": items,
+            "document_ids": ids.page(page, items)}
+
+class MendeleyStandIn(object):
+    """WSGI application serving a LocalLibrary through the routes of
+       apidefinitions.methods
+
+       latency (seconds, plus up to jitter seconds) is added to every request"""
+
+    # downloads are redirected to this route, like the real server
+    # redirects to its file storage
+    STORAGE_URL = "/storage/%(hash)s/"
+
+    def __init__(self, library=None, latency=0.0, jitter=0.0):
+        self.library = library or LocalLibrary()
+        self.latency = latency
+        self.jitter = jitter
+        self.routes = self.build_routes()
+
+    def build_routes(self):
+        routes = []
+        definitions = list(apidefinitions.methods.items())
+        definitions.append(("storage", {"url": MendeleyStandIn.STORAGE_URL, "required": ["hash"]}))
+        for name, details in definitions:
+            template = details["url"]
+            # placeholders and literal parts alternate
+            parts = re.split(r"%\((\w+)\)s", template.rstrip("/"))
+            literal = "".join(parts[0::2])
+            pattern = "".join(re.escape(part) if i % 2 == 0 else "(?P<%s>[^/]+)" % part
+                              for i, part in enumerate(parts))
+            pattern = re.compile("^%s/?$" % pattern)
+            http_method = details.get("method", "get").upper()
+            routes.append((len(literal), http_method, pattern, name))
+
+        # the routes with the most literal characters win, so /groups/1/leave/
+        # isn't taken for /groups/<group_id>/<document_id>/
+        routes.sort(key=lambda route: -route[0])
+        return [(http_method, pattern, name) for _, http_method, pattern, name in routes]
+
+    def __call__(self, environ, start_response):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+
+        http_method = environ["REQUEST_METHOD"]
+        try:
+            response = self.dispatch(environ, http_method)
+        except HttpError as e:
+            response = Response(e.status, {"error": e.message})
+
+        headers = list(response.headers)
+        body = response.body
+        if body is None:
+            body = ""
+        elif not isinstance(body, str):
+            body = json.dumps(body)
+            headers.append(("Content-Type", "application/json; charset=utf-8"))
+        headers.append(("Content-Length", str(len(body))))
+
+        start_response("%d %s" % (response.status, httplib.responses.get(response.status, "")), headers)
+        if http_method == "HEAD":
+            return [""]
+        return [body]
+
+    def dispatch(self, environ, http_method):
+        path = environ.get("PATH_INFO", "")
+        route_method = "GET" if http_method == "HEAD" else http_method
+        path_matched = False
+        for method, pattern, name in self.routes:
+            match = pattern.match(path)
+            if not match:
+                continue
+            path_matched = True
+            if method != route_method:
+                continue
+            args = dict((key, urllib.unquote_plus(value)) for key, value in match.groupdict().items())
+            params = self.parse_params(environ, http_method)
+            handler = getattr(self, "on_%s" % name.lstrip("_"), self.on_not_modelled)
+            return handler(args, params, environ)
+
+        if path_matched:
+            raise HttpError(405, "method not allowed")
+        raise HttpError(404, "unknown resource")
+
+    def parse_params(self, environ, http_method):
+        params = dict(urlparse.parse_qsl(environ.get("QUERY_STRING", "")))
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length else ""
+        if http_method == "POST":
+            params.update(urlparse.parse_qsl(body))
+        elif http_method == "PUT":
+            params["data"] = body
+        return params
+
+    def json_param(self, params, name):
+        if name not in params:
+            raise HttpError(400, "%s is required" % name)
+        try:
+            value = json.loads(params[name])
+        except ValueError:
+            raise HttpError(400, "%s is not valid json" % name)
+        if not isinstance(value, dict):
+            raise HttpError(400, "%s must be an object" % name)
+        return value
+
+    def int_arg(self, args, name):
+        try:
+            return int(args[name])
+        except ValueError:
+            raise HttpError(404, "unknown %s" % name)
+
+    def on_not_modelled(self, args, params, environ):
+        return Response(200, {})
+
+    # Library #
+
+    def on_library(self, args, params, environ):
+        with self.library.lock:
+            listing = paged(self.library.library, params)
+            versions = self.library.versions
+            listing["documents"] = [{"id": document_id, "version": versions[document_id]}
+                                    for document_id in listing["document_ids"]]
+            return Response(200, listing)
+
+    def on_document_details(self, args, params, environ):
+        return Response(200, self.library.document_details(self.int_arg(args, "id")))
+
+    def on_create_document(self, args, params, environ):
+        document_id, version = self.library.create_document(self.json_param(params, "document"))
+        return Response(201, {"document_id": document_id, "version": version})
+
+    def on_update_document(self, args, params, environ):
+        version = self.library.update_document(self.int_arg(args, "id"), self.json_param(params, "document"))
+        return Response(200, {"version": version})
+
+    def on_delete_library_document(self, args, params, environ):
+        self.library.delete_document(self.int_arg(args, "id"))
+        return Response(204)
+
+    def on_upload_pdf(self, args, params, environ):
+        file_name = "file.pdf"
+        disposition = environ.get("HTTP_CONTENT_DISPOSITION", "")
+        match = re.search(r'filename="([^"]*)"', disposition)
+        if match:
+            file_name = match.group(1)
+        data = params.get("data", "")
+        file_hash = self.library.add_file(self.int_arg(args, "id"), file_name, data)
+        return Response(201, {"file_hash": file_hash})
+
+    def download(self, args, params, environ, group_id=None):
+        file_hash = args["hash"]
+        self.library.check_file(self.int_arg(args, "id"), file_hash, group_id)
+        if params.get("with_redirect", "true") == "false":
+            return self.on_storage(args, params, environ)
+        location = application_uri(environ).rstrip("/") + MendeleyStandIn.STORAGE_URL % {"hash": file_hash}
+        return Response(302, None, [("Location", location)])
+
+    def on_download_file(self, args, params, environ):
+        return self.download(args, params, environ)
+
+    def on_download_file_group(self, args, params, environ):
+        return self.download(args, params, environ, self.int_arg(args, "group"))
+
+    def on_storage(self, args, params, environ):
+        if args["hash"] not in self.library.files:
+            raise HttpError(404, "file not found")
+        file_name, data = self.library.files[args["hash"]]
+        return Response(200, data, [("Content-Type", "application/pdf"),
+                                    ("Content-Disposition", 'attachment; filename="%s"' % file_name)])
+
+    # Folders #
+
+    def on_folders(self, args, params, environ):
+        with self.library.lock:
+            return Response(200, self.library.folders_json(self.library.folders))
+
+    def folder_listing(self, folder_id, folder, params):
+        listing = paged(folder["documents"], params)
+        listing["folder_id"] = folder_id
+        listing["folder_name"] = folder["name"]
+        return listing
+
+    def on_folder_documents(self, args, params, environ):
+        with self.library.lock:
+            folder_id = self.int_arg(args, "id")
+            return Response(200, self.folder_listing(folder_id, self.library.folder(folder_id), params))
+
+    def on_create_folder(self, args, params, environ):
+        with self.library.lock:
+            folder_id = self.library.new_folder(self.library.folders, self.json_param(params, "folder"))
+            return Response(201, {"folder_id": folder_id})
+
+    def on_delete_folder(self, args, params, environ):
+        with self.library.lock:
+            self.library.remove_folder(self.library.folders, self.int_arg(args, "id"))
+            return Response(204)
+
+    def on_add_document_to_folder(self, args, params, environ):
+        with self.library.lock:
+            document_id = self.int_arg(args, "document_id")
+            self.library.check_document(document_id)
+            self.library.folder(self.int_arg(args, "folder_id"))["documents"].add(document_id)
+            return Response(201, {})
+
+    def on_delete_document_from_folder(self, args, params, environ):
+        with self.library.lock:
+            folder = self.library.folder(self.int_arg(args, "folder_id"))
+            if not folder["documents"].remove(self.int_arg(args, "document_id")):
+                raise HttpError(404, "document not in folder")
+            return Response(204)
+
+    # Groups #
+
+    def on_groups(self, args, params, environ):
+        with self.library.lock:
+            groups = self.library.groups
+            return Response(200, [{"id": group_id, "name": group["name"], "type": group["type"],
+                                   "size": len(group["documents"])}
+                                  for group_id, group in sorted(groups.items())])
+
+    def on_group_documents(self, args, params, environ):
+        with self.library.lock:
+            group_id = self.int_arg(args, "id")
+            group = self.library.group(group_id)
+            listing = paged(group["documents"], params)
+            versions = self.library.versions
+            listing["documents"] = [{"id": document_id, "version": versions[document_id]}
+                                    for document_id in listing["document_ids"]]
+            listing["group_id"] = group_id
+            listing["group_name"] = group["name"]
+            return Response(200, listing)
+
+    def on_group_doc_details(self, args, params, environ):
+        return Response(200, self.library.document_details(self.int_arg(args, "doc_id"),
+                                                           self.int_arg(args, "group_id")))
+
+    def on_group_people(self, args, params, environ):
+        self.library.group(self.int_arg(args, "id"))
+        return Response(200, {"owner": {"name": "local user"}, "admins": [], "members": [], "followers": []})
+
+    def on_create_group(self, args, params, environ):
+        group_id = self.library.create_group(self.json_param(params, "group"))
+        return Response(201, {"group_id": group_id})
+
+    def on_delete_group(self, args, params, environ):
+        self.library.delete_group(self.int_arg(args, "id"))
+        return Response(204)
+
+    # leave_group and unfollow_group don't declare an expected_status,
+    # so the client expects a json body
+
+    def on_leave_group(self, args, params, environ):
+        self.library.delete_group(self.int_arg(args, "id"))
+        return Response(200, {})
+
+    def on_unfollow_group(self, args, params, environ):
+        return self.on_leave_group(args, params, environ)
+
+    def on_delete_group_document(self, args, params, environ):
+        self.library.delete_document(self.int_arg(args, "document_id"), self.int_arg(args, "group_id"))
+        return Response(204)
+
+    def on_group_folders(self, args, params, environ):
+        with self.library.lock:
+            group = self.library.group(self.int_arg(args, "group_id"))
+            return Response(200, self.library.folders_json(group["folders"]))
+
+    def on_group_folder_documents(self, args, params, environ):
+        with self.library.lock:
+            folder_id = self.int_arg(args, "id")
+            folder = self.library.folder(folder_id, self.int_arg(args, "group_id"))
+            return Response(200, self.folder_listing(folder_id, folder, params))
+
+    def on_create_group_folder(self, args, params, environ):
+        with self.library.lock:
+            group = self.library.group(self.int_arg(args, "group_id"))
+            folder_id = self.library.new_folder(group["folders"], self.json_param(params, "folder"))
+            return Response(201, {"folder_id": folder_id})
+
+    def on_delete_group_folder(self, args, params, environ):
+        with self.library.lock:
+            group = self.library.group(self.int_arg(args, "group_id"))
+            self.library.remove_folder(group["folders"], self.int_arg(args, "id"))
+            return Response(204)
+
+    def on_add_document_to_group_folder(self, args, params, environ):
+        with self.library.lock:
+            group_id = self.int_arg(args, "group_id")
+            document_id = self.int_arg(args, "document_id")
+            self.library.check_document(document_id, group_id)
+            self.library.folder(self.int_arg(args, "folder_id"), group_id)["documents"].add(document_id)
+            return Response(201, {})
+
+    def on_delete_document_from_group_folder(self, args, params, environ):
+        with self.library.lock:
+            folder = self.library.folder(self.int_arg(args, "folder_id"), self.int_arg(args, "group_id"))
+            if not folder["documents"].remove(self.int_arg(args, "document_id")):
+                raise HttpError(404, "document not in folder")
+            return Response(204)
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    # the default of 5 refuses connections under concurrent load
+    request_queue_size = 128
+
+class LocalServer(object):
+    """Run a MendeleyStandIn on a background thread, port 0 picks a free port"""
+
+    def __init__(self, library=None, host="127.0.0.1", port=0, latency=0.0, jitter=0.0):
+        self.app = MendeleyStandIn(library, latency, jitter)
+        self.library = self.app.library
+        self.httpd = make_server(host, port, self.app, ThreadingWSGIServer, QuietRequestHandler)
+        self.base_url = "http://%s:%d" % (host, self.httpd.server_port)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+def _serve(connection, documents, latency, jitter, groups, group_documents):
+    server = LocalServer(latency=latency, jitter=jitter)
+    server.library.seed_documents(documents)
+    server.library.seed_groups(groups, group_documents)
+    connection.send(server.base_url)
+    connection.close()
+    server.httpd.serve_forever()
+
+class LocalServerProcess(object):
+    """Run a LocalServer in a child process, so its cpu and memory use
+       don't add to the client being measured
+
+       with LocalServerProcess(documents=10000) as server:
+           client = create_local_client(server.base_url)
+
+       groups: number of groups of group_documents documents each to seed"""
+
+    def __init__(self, documents=0, latency=0.0, jitter=0.0, groups=0, group_documents=0):
+        self.documents = documents
+        self.latency = latency
+        self.jitter = jitter
+        self.groups = groups
+        self.group_documents = group_documents
+        self.process = None
+        self.base_url = None
+
+    def start(self):
+        parent_connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child_connection, self.documents,
+                                                                    self.latency, self.jitter,
+                                                                    self.groups, self.group_documents))
+        self.process.daemon = True
+        self.process.start()
+        self.base_url = parent_connection.recv()
+        return self
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+def create_local_client(base_url, access_token="local", transport=None):
+    """MendeleyClient talking to a local server, no authentication needed"""
+    from mendeley_client import MendeleyClient
+
+    client = MendeleyClient("local", "local", {"base_url": base_url, "transport": transport})
+    client.set_access_token(access_token)
+    return client
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--host", default="127.0.0.1")
+    parser.add_option("--port", type="int", default=8080)
+    parser.add_option("--documents", type="int", default=0, help="synthetic documents to seed the library with")
+    parser.add_option("--latency", type="float", default=0.0, help="seconds added to every request")
+    parser.add_option("--jitter", type="float", default=0.0, help="random extra latency in seconds")
+    parser.add_option("--groups", type="int", default=0, help="synthetic groups to create")
+    parser.add_option("--group-documents", type="int", default=0, help="synthetic documents in each group")
+    options, _ = parser.parse_args()
+
+    library = LocalLibrary()
+    library.seed_documents(options.documents)
+    library.seed_groups(options.groups, options.group_documents)
+    server = LocalServer(library, options.host, options.port, options.latency, options.jitter)
+    print "Serving on %s" % server.base_url
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
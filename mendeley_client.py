@@ -28,10 +28,14 @@ import os
 import pickle
 import requests
 import sys
+import time
 import urllib
 import mimetypes
 
 import apidefinitions
+import metrics
+import tracing
+import transport
 
 
 def resolve_http_redirect(url):
@@ -68,6 +72,8 @@ class OAuthClient(object):
         self.authorize_url = options.get('access_token_url', 'https://api-oauth2.mendeley.com/oauth/authorize')
         self.name = options.get('name', 'Example app')
         self.base_url = options.get('base_url', 'https://api-oauth2.mendeley.com')
+        # see transport.py for the recording and replaying transports
+        self.transport = options.get('transport') or transport.HttpTransport()
 
         self.consumer = OAuth2Service(client_id=client_id,
                 client_secret=client_secret,
@@ -109,41 +115,81 @@ class OAuthClient(object):
         return self._send_request(request, token, body, headers)
 
     def _send_request(self, request, token=None, body=None, extra_headers=None):
-        session = self.get_session(token)
+        tracer = tracing.tracer
+        with tracer.span("connection"):
+            session = self.get_session(token)
 
-        # common arguments for the requests call
-        # disables automatic redirections following as requests
-        # to use resolve_http_redirect(..) above
-        requests_args = {"allow_redirects":False}
         method = request.get("method")
         url = request.get("url")
+        start = time.time()
 
-        if method == 'GET':
-            return session.get(url, **requests_args)
+        response = self.transport.send(session, method, url, body, extra_headers)
 
-        if method == 'POST':
-            return session.post(url, data=body, headers={"Content-type": "application/x-www-form-urlencoded"},**requests_args )
-
-        elif method == 'DELETE':
-            return session.delete(url, **requests_args)
+        if tracer.enabled:
+            self._trace_response(response, method, start)
+        if metrics.registry.enabled:
+            self._record_bytes(response)
+        return response
 
-        elif method == 'PUT':
-            return session.put(url, data=body, headers=extra_headers, **requests_args)
+    def _trace_response(self, response, method, start):
+        # requests measures the elapsed time up to the parsing of the headers
+        # and reads the body after that, split the request accordingly
+        first_byte = response.elapsed.total_seconds()
+        tracing.tracer.add_span("time_to_first_byte", start, first_byte,
+                                http_method=method, status=response.status_code)
+        tracing.tracer.add_span("read_body", start + first_byte, time.time() - start - first_byte,
+                                bytes=len(response.content))
 
-        assert False
+    def _record_bytes(self, response):
+        sent = response.request.body
+        sent = len(sent) if sent else 0
+        metrics.registry.record_bytes(metrics.registry.current_method(), sent, len(response.content))
 
 class MendeleyRemoteMethod(object):
     """Call a Mendeley OpenAPI method and parse and handle the response"""
-    def __init__(self, details, callback):
+    def __init__(self, details, callback, name=None):
         self.details = details # Argument, URL and additional details.
         self.callback = callback # Callback to actually do the remote call
+        self.name = name # Name of the method in apidefinitions, used for metrics
 
     def serialize(self, obj):
         if isinstance(obj,dict):
             return json.dumps(obj)
         return obj
 
+    def method_name(self):
+        return self.name or self.details['url']
+
     def __call__(self, *args, **kwargs):
+        registry = metrics.registry
+        if not registry.enabled:
+            if not tracing.tracer.enabled:
+                return self._call(*args, **kwargs)
+            with tracing.tracer.span("call", method=self.method_name()):
+                return self._call(*args, **kwargs)
+
+        name = self.method_name()
+        previous_method = registry.set_current_method(name)
+        start = time.time()
+        try:
+            with tracing.tracer.span("call", method=name):
+                return self._call(*args, **kwargs)
+        finally:
+            registry.record_latency(name, time.time() - start)
+            registry.set_current_method(previous_method)
+
+    def _call(self, *args, **kwargs):
+        if tracing.tracer.enabled:
+            # when called from a worker pool, see concurrency.bounded_imap
+            tracing.tracer.add_queue_span()
+        with tracing.tracer.span("build_url"):
+            url, optional_args = self._build_url(args, kwargs)
+
+        # Do the callback - will return a HTTPResponse object
+        response = self.callback(url, self.details.get('access_token_required', True), self.details.get('method', 'get'), optional_args)
+        return self._handle_response(response)
+
+    def _build_url(self, args, kwargs):
         url = self.details['url']
         # Get the required arguments
         if self.details.get('required'):
@@ -161,10 +207,9 @@ class MendeleyRemoteMethod(object):
         for optional in self.details.get('optional', []):
             if kwargs.has_key(optional):
                 optional_args[optional] = self.serialize(kwargs[optional])
+        return url, optional_args
 
-        # Do the callback - will return a HTTPResponse object
-        response = self.callback(url, self.details.get('access_token_required', True), self.details.get('method', 'get'), optional_args)
-
+    def _handle_response(self, response):
         # basic redirection following
         if response.status_code in [301, 302, 303]:
             url = resolve_http_redirect(response.headers["location"])
@@ -173,6 +218,8 @@ class MendeleyRemoteMethod(object):
         # if we expect something else than 200 with no content, just check
         # that the status code is as expected
         status = response.status_code
+        if metrics.registry.enabled:
+            metrics.registry.record_status(self.method_name(), status)
         expected_status = self.details.get("expected_status",200)
         if expected_status != 200:
             return status == expected_status
@@ -200,7 +247,8 @@ class MendeleyRemoteMethod(object):
             pass
 
         if mime == 'application/json':
-            return json.loads(response.text)
+            with tracing.tracer.span("decode"):
+                return json.loads(response.text)
         elif attached == 'attachment':
             return {'filename': filename, 'data': response.content}
         else:
@@ -280,7 +328,7 @@ class MendeleyClient(object):
 
         # Create methods for all of the API calls
         for method, details in apidefinitions.methods.items():
-            setattr(self, method, MendeleyRemoteMethod(details, self._api_request))
+            setattr(self, method, MendeleyRemoteMethod(details, self._api_request, method))
 
     # replace the upload_pdf with a more user friendly method
     def upload_pdf(self,document_id, filename):
@@ -0,0 +1,113 @@
+"""
+Merkle tree over the (id, version) pairs of a library
+
+The documents are spread over fanout ** depth buckets by the prefix of a hash
+of their id. The hash of a bucket is the xor of the hashes of its (id,
+version) pairs, so a change updates it in constant time whatever the order of
+the changes, and every node above hashes its children, recomputed when
+needed along the path of the changed buckets.
+
+    tree = MerkleTree()
+    tree.update(doc_id, None, version)
+    tree.root() == other.root()     # same documents and versions
+    tree.diff(other)                # indexes of the buckets that differ
+
+Equal roots mean equal (id, version) pairs, up to sha1 collisions. Finding
+the differing buckets only descends into the nodes that differ.
+"""
+
+import hashlib
+import threading
+
+def entry_hash(doc_id, version):
+    return int(hashlib.sha1("%s:%s" % (doc_id, version)).hexdigest(), 16)
+
+class MerkleTree(object):
+
+    def __init__(self, depth=3, fanout=16):
+        self.depth = depth
+        self.fanout = fanout
+        self.buckets = [0] * fanout ** depth
+        # hashes of the nodes above the buckets by level, the root is level
+        # 0, None once a bucket below changed
+        self.levels = [[None] * fanout ** level for level in range(depth)]
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        # sent to other processes to compare libraries
+        with self.lock:
+            state = dict(self.__dict__)
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def bucket(self, doc_id):
+        """Index of the bucket of a document"""
+        return int(hashlib.sha1(str(doc_id)).hexdigest()[:8], 16) % len(self.buckets)
+
+    def update(self, doc_id, old_version, new_version):
+        """Replace the (doc_id, old_version) pair by (doc_id, new_version),
+           old_version is None for a document added and new_version for one
+           removed"""
+        if old_version == new_version:
+            return
+        index = self.bucket(doc_id)
+        with self.lock:
+            if old_version is not None:
+                self.buckets[index] ^= entry_hash(doc_id, old_version)
+                self.count -= 1
+            if new_version is not None:
+                self.buckets[index] ^= entry_hash(doc_id, new_version)
+                self.count += 1
+            # the ancestors of a node to recompute are to be recomputed too
+            for level in reversed(range(self.depth)):
+                index //= self.fanout
+                if self.levels[level][index] is None:
+                    break
+                self.levels[level][index] = None
+
+    def node(self, level, index):
+        # must be called with the lock held
+        if level == self.depth:
+            return "%040x" % self.buckets[index]
+        value = self.levels[level][index]
+        if value is None:
+            first = index * self.fanout
+            value = hashlib.sha1("".join(self.node(level + 1, child)
+                                         for child in xrange(first, first + self.fanout))).hexdigest()
+            self.levels[level][index] = value
+        return value
+
+    def root(self):
+        """Hash of every (id, version) pair"""
+        with self.lock:
+            return self.node(0, 0)
+
+    def diff(self, other):
+        """Sorted indexes of the buckets differing from those of other, a
+           MerkleTree of the same shape"""
+        assert (self.depth, self.fanout) == (other.depth, other.fanout)
+        if other is self:
+            return []
+        first, second = sorted([self, other], key=id)
+        differing = []
+        with first.lock:
+            with second.lock:
+                pending = [(0, 0)]
+                while pending:
+                    level, index = pending.pop()
+                    if self.node(level, index) == other.node(level, index):
+                        continue
+                    if level == self.depth:
+                        differing.append(index)
+                        continue
+                    first_child = index * self.fanout
+                    pending.extend((level + 1, child) for child in xrange(first_child, first_child + self.fanout))
+        return sorted(differing)
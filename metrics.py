@@ -0,0 +1,306 @@
+"""
+Client side instrumentation for the Mendeley Open API client
+
+Records per method latency histograms, response status counts, request and
+response bytes, retries and cache hits, and the throughput and queue depths of
+the stages of a pipelined sync. Recording is disabled by default and costs a
+single attribute check per call in that state.
+
+Usage:
+
+    import metrics
+    metrics.registry.enable()
+    ...
+    print metrics.registry.to_prometheus()
+    json.dump(metrics.registry.snapshot(), open("metrics.json", "w"))
+
+"""
+
+import bisect
+import threading
+import time
+
+def exponential_buckets(start, factor, count):
+    """Upper bounds of count buckets growing geometrically from start"""
+    buckets = []
+    bound = start
+    for i in range(count):
+        buckets.append(bound)
+        bound *= factor
+    return tuple(buckets)
+
+# 0.5ms to ~28s with a 25% growth factor, so quantiles estimated by
+# interpolating inside a bucket are within a few percent of the real value
+DEFAULT_LATENCY_BUCKETS = exponential_buckets(0.0005, 1.25, 50)
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+class Histogram(object):
+    """Fixed bucket histogram, the last bucket catches everything above the
+       largest bound"""
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the observations of other, a Histogram with the same buckets,
+           e.g. one recorded by another process"""
+        assert other.buckets == self.buckets
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        for value in [other.min, other.max]:
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+
+    def quantile(self, q):
+        """Estimate the q quantile (0 <= q <= 1) by linear interpolation
+           inside the bucket holding it"""
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count == 0 or seen + bucket_count < rank:
+                seen += bucket_count
+                continue
+            lower = self.buckets[index - 1] if index > 0 else 0.0
+            upper = self.buckets[index] if index < len(self.buckets) else self.max
+            # clamp to the observed range, the buckets can be much wider
+            lower = max(lower, self.min)
+            upper = min(upper, self.max)
+            fraction = (rank - seen) / float(bucket_count)
+            return lower + (upper - lower) * fraction
+        return self.max
+
+    def snapshot(self, quantiles=DEFAULT_QUANTILES):
+        snapshot = {"count": self.count,
+                    "sum": self.sum,
+                    "min": self.min,
+                    "max": self.max,
+                    "buckets": [[bound, count] for bound, count in zip(self.buckets, self.counts) if count],
+                    "overflow": self.counts[-1]}
+        for q in quantiles:
+            snapshot["p%g" % (q * 100)] = self.quantile(q)
+        return snapshot
+
+class MethodMetrics(object):
+    """Everything recorded for a single api method"""
+
+    def __init__(self, buckets):
+        self.latency = Histogram(buckets)
+        self.status = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.cache_hits = 0
+
+    def snapshot(self):
+        return {"latency": self.latency.snapshot(),
+                # json only has string keys
+                "status": dict((str(status), count) for status, count in self.status.items()),
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "retries": self.retries,
+                "cache_hits": self.cache_hits}
+
+# queue depths are small integers
+DEFAULT_DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+class StageMetrics(object):
+    """Everything recorded for a stage of a concurrency.Stage pipeline"""
+
+    def __init__(self):
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.queue_depth = Histogram(DEFAULT_DEPTH_BUCKETS)
+        # time spent by the producers waiting for room in the queue
+        self.put_wait_seconds = 0.0
+
+    def snapshot(self):
+        return {"items": self.items,
+                "busy_seconds": self.busy_seconds,
+                "items_per_second": self.items / self.busy_seconds if self.busy_seconds else None,
+                "queue_depth": self.queue_depth.snapshot(),
+                "put_wait_seconds": self.put_wait_seconds}
+
+class MetricsRegistry(object):
+    """Thread safe store of MethodMetrics keyed by api method name
+
+       Requests sent outside of a MendeleyRemoteMethod call (e.g. directly
+       through OAuthClient) are recorded under UNKNOWN_METHOD"""
+
+    UNKNOWN_METHOD = "_unknown"
+
+    def __init__(self, enabled=False, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.methods = {}
+        self.stages = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.methods = {}
+            self.stages = {}
+            self.started = time.time()
+
+    def _method(self, name):
+        # must be called with the lock held
+        method_metrics = self.methods.get(name)
+        if method_metrics is None:
+            method_metrics = self.methods[name] = MethodMetrics(self.buckets)
+        return method_metrics
+
+    def _stage(self, name):
+        # must be called with the lock held
+        stage_metrics = self.stages.get(name)
+        if stage_metrics is None:
+            stage_metrics = self.stages[name] = StageMetrics()
+        return stage_metrics
+
+    # the method being called by the current thread, used to attribute
+    # the bytes counted at the transport level
+
+    def current_method(self):
+        return getattr(self._local, "method", None) or MetricsRegistry.UNKNOWN_METHOD
+
+    def set_current_method(self, name):
+        previous = getattr(self._local, "method", None)
+        self._local.method = name
+        return previous
+
+    def record_latency(self, name, seconds):
+        with self._lock:
+            self._method(name).latency.observe(seconds)
+
+    def record_status(self, name, status):
+        with self._lock:
+            status_counts = self._method(name).status
+            status_counts[status] = status_counts.get(status, 0) + 1
+
+    def record_bytes(self, name, sent, received):
+        with self._lock:
+            method_metrics = self._method(name)
+            method_metrics.bytes_sent += sent
+            method_metrics.bytes_received += received
+
+    def record_retry(self, name):
+        with self._lock:
+            self._method(name).retries += 1
+
+    def record_cache_hit(self, name, count=1):
+        with self._lock:
+            self._method(name).cache_hits += count
+
+    def record_stage_item(self, name, seconds):
+        """An item processed by a pipeline stage in seconds"""
+        with self._lock:
+            stage_metrics = self._stage(name)
+            stage_metrics.items += 1
+            stage_metrics.busy_seconds += seconds
+
+    def record_queue_put(self, name, depth, wait_seconds):
+        """An item queued for a pipeline stage, depth is the queue size after"""
+        with self._lock:
+            stage_metrics = self._stage(name)
+            stage_metrics.queue_depth.observe(depth)
+            stage_metrics.put_wait_seconds += wait_seconds
+
+    def snapshot(self):
+        """Return a json serializable dict of everything recorded so far"""
+        with self._lock:
+            return {"started": self.started,
+                    "taken": time.time(),
+                    "methods": dict((name, method_metrics.snapshot()) for name, method_metrics in self.methods.items()),
+                    "stages": dict((name, stage_metrics.snapshot()) for name, stage_metrics in self.stages.items())}
+
+    def to_prometheus(self, prefix="mendeley_client"):
+        """Return the metrics in the prometheus text exposition format"""
+        lines = []
+
+        def header(name, kind, description):
+            lines.append("# HELP %s_%s %s" % (prefix, name, description))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+
+        with self._lock:
+            names = sorted(self.methods.keys())
+
+            header("request_duration_seconds", "histogram", "Duration of api method calls")
+            for name in names:
+                histogram = self.methods[name].latency
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_request_duration_seconds_bucket{method="%s",le="%r"} %d' % (prefix, name, bound, cumulative))
+                lines.append('%s_request_duration_seconds_bucket{method="%s",le="+Inf"} %d' % (prefix, name, histogram.count))
+                lines.append('%s_request_duration_seconds_sum{method="%s"} %r' % (prefix, name, histogram.sum))
+                lines.append('%s_request_duration_seconds_count{method="%s"} %d' % (prefix, name, histogram.count))
+
+            header("responses_total", "counter", "Responses received by http status code")
+            for name in names:
+                for status, count in sorted(self.methods[name].status.items()):
+                    lines.append('%s_responses_total{method="%s",status="%s"} %d' % (prefix, name, status, count))
+
+            counters = [("request_bytes_total", "bytes_sent", "Bytes sent in request bodies"),
+                        ("response_bytes_total", "bytes_received", "Bytes received in response bodies"),
+                        ("retries_total", "retries", "Requests sent again after a failure"),
+                        ("cache_hits_total", "cache_hits", "Calls answered without a network round trip")]
+            for metric, attribute, description in counters:
+                header(metric, "counter", description)
+                for name in names:
+                    lines.append('%s_%s{method="%s"} %d' % (prefix, metric, name, getattr(self.methods[name], attribute)))
+
+            stages = sorted(self.stages.keys())
+            counters = [("stage_items_total", "items", "Items processed by a sync pipeline stage"),
+                        ("stage_busy_seconds_total", "busy_seconds", "Time spent processing items by a stage"),
+                        ("stage_put_wait_seconds_total", "put_wait_seconds", "Time spent waiting for room in a stage queue")]
+            for metric, attribute, description in counters:
+                header(metric, "counter", description)
+                for name in stages:
+                    lines.append('%s_%s{stage="%s"} %r' % (prefix, metric, name, getattr(self.stages[name], attribute)))
+
+            header("stage_queue_depth", "histogram", "Items waiting in a stage queue")
+            for name in stages:
+                histogram = self.stages[name].queue_depth
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_stage_queue_depth_bucket{stage="%s",le="%r"} %d' % (prefix, name, bound, cumulative))
+                lines.append('%s_stage_queue_depth_bucket{stage="%s",le="+Inf"} %d' % (prefix, name, histogram.count))
+                lines.append('%s_stage_queue_depth_sum{stage="%s"} %r' % (prefix, name, histogram.sum))
+                lines.append('%s_stage_queue_depth_count{stage="%s"} %d' % (prefix, name, histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+# process wide registry used by MendeleyRemoteMethod and OAuthClient
+registry = MetricsRegistry()
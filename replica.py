@@ -0,0 +1,548 @@
+"""
+Durable local replica of the documents of a DummySyncedClient
+
+Documents are stored in a SQLite database with their version, sync status
+and pending local changes, so a restarted client only fetches what changed
+on the server since its last sync:
+
+    replica = DocumentReplica("library.db")
+    sclient = DummySyncedClient(config_file, replica=replica)
+    sclient.sync()
+
+Only the id, version and status of the documents are read on startup, the
+documents themselves are loaded the first time they are accessed. The
+database is written in WAL mode and committed after every network side effect
+of a sync, so killing the process leaves it in the state of the last
+completed step. The checkpoint of an unfinished sync is kept in the meta table.
+
+The libraries of groups are kept in partitions of the same database, tables
+of their own created by DocumentReplica.partition.
+
+For libraries too large to keep in memory, DocumentReplica(filename,
+cache_size=10000) only keeps that many documents loaded and answers everything
+else from the database, so the memory used by a sync doesn't grow with the
+library.
+"""
+
+import collections
+import json
+import re
+import sqlite3
+
+from merkle import MerkleTree
+import threading
+
+from synced_client import SyncedDocument, SyncStatus
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS %(documents)s (
+    id PRIMARY KEY,
+    version,
+    status INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    changes TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS %(new_documents)s (
+    key INTEGER PRIMARY KEY AUTOINCREMENT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS %(meta)s (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS %(documents)s_status ON %(documents)s (status);
+CREATE TEMP TABLE IF NOT EXISTS %(listed)s (
+    id PRIMARY KEY
+);
+"""
+
+# ids per query of DocumentReplica.states, below the sqlite limit of parameters
+STATES_CHUNK = 500
+
+def encode_document(document):
+    return json.dumps(document.object.to_dict(), separators=(",", ":"))
+
+class DocumentReplica(object):
+    """partition: name of a set of tables of their own in the database, see
+       DocumentReplica.partition
+
+       cache_size: number of documents kept in memory, None to keep every
+       document accessed and an index of all of them, see BoundedReplicaDocuments"""
+
+    def __init__(self, filename, partition=None, parent=None, cache_size=None):
+        self.filename = filename
+        prefix = ""
+        if partition is not None:
+            assert re.match(r"^\w+$", partition)
+            prefix = partition + "_"
+        self.tables = dict((table, prefix + table) for table in ["documents", "new_documents", "meta", "listed"])
+
+        if parent is not None:
+            self.cache_size = parent.cache_size
+            self.lock = parent.lock
+            self.connection = parent.connection
+        else:
+            self.lock = threading.RLock()
+            self.connection = sqlite3.connect(filename, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # with WAL, NORMAL can lose the last transactions on power loss
+            # but never corrupts the database
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.cache_size = cache_size
+        with self.lock:
+            self.connection.executescript(SCHEMA % self.tables)
+            self.connection.commit()
+
+    def partition(self, name):
+        """Replica sharing the database and connection of this one with
+           tables of its own, e.g. for the library of a group"""
+        return DocumentReplica(self.filename, name, self)
+
+    def documents(self):
+        """Mapping of the stored documents to use as DummySyncedClient.documents"""
+        if self.cache_size is not None:
+            return BoundedReplicaDocuments(self, self.cache_size)
+        return ReplicaDocuments(self)
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM %(documents)s" % self.tables)
+            self.connection.execute("DELETE FROM %(new_documents)s" % self.tables)
+            self.connection.execute("DELETE FROM %(meta)s" % self.tables)
+            self.connection.execute("DELETE FROM %(listed)s" % self.tables)
+            self.connection.commit()
+
+    def load_meta(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM %(meta)s WHERE key = ?" % self.tables, (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def save_meta(self, key, value):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO %(meta)s (key, value) VALUES (?, ?)" % self.tables,
+                                    (key, json.dumps(value)))
+
+    # Synced documents #
+
+    def load_index(self):
+        """{id: (version, status)} of every stored document"""
+        with self.lock:
+            rows = self.connection.execute("SELECT id, version, status FROM %(documents)s" % self.tables)
+            return dict((doc_id, (version, status)) for doc_id, version, status in rows)
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM %(documents)s" % self.tables).fetchone()[0]
+
+    def states(self, doc_ids):
+        """{id: (version, status)} of the stored documents among doc_ids"""
+        states = {}
+        for start in xrange(0, len(doc_ids), STATES_CHUNK):
+            chunk = doc_ids[start:start + STATES_CHUNK]
+            with self.lock:
+                rows = self.connection.execute("SELECT id, version, status FROM %(documents)s WHERE id IN (%%s)"
+                                               % self.tables % ",".join("?" * len(chunk)), chunk).fetchall()
+            for doc_id, version, status in rows:
+                states[doc_id] = (version, status)
+        return states
+
+    def iter_ids(self, batch=1000):
+        """Ids of the stored documents in order, read batch at a time"""
+        for row in self.iter_rows("id", batch):
+            yield row[0]
+
+    def iter_versions(self, batch=1000):
+        """(id, version) of the stored documents in order"""
+        return self.iter_rows("id, version", batch)
+
+    def iter_rows(self, columns, batch):
+        last = None
+        while True:
+            with self.lock:
+                if last is None:
+                    rows = self.connection.execute("SELECT %s FROM %s ORDER BY id LIMIT ?"
+                                                   % (columns, self.tables["documents"]), (batch,)).fetchall()
+                else:
+                    rows = self.connection.execute("SELECT %s FROM %s WHERE id > ? ORDER BY id LIMIT ?"
+                                                   % (columns, self.tables["documents"]), (last, batch)).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < batch:
+                return
+            last = rows[-1][0]
+
+    def ids_with_status(self, status):
+        with self.lock:
+            rows = self.connection.execute("SELECT id FROM %(documents)s WHERE status = ?" % self.tables,
+                                           (status,)).fetchall()
+        return set(row[0] for row in rows)
+
+    # Ids listed by the sync in progress, in a temporary table #
+
+    def clear_listed(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM %(listed)s" % self.tables)
+
+    def add_listed(self, doc_ids):
+        with self.lock:
+            self.connection.executemany("INSERT OR IGNORE INTO %(listed)s (id) VALUES (?)" % self.tables,
+                                        [(doc_id,) for doc_id in doc_ids])
+
+    def count_listed(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM %(listed)s" % self.tables).fetchone()[0]
+
+    def unlisted_ids(self):
+        """Ids of the stored documents not listed"""
+        with self.lock:
+            rows = self.connection.execute("SELECT id FROM %(documents)s WHERE id NOT IN (SELECT id FROM %(listed)s)"
+                                           % self.tables).fetchall()
+        return set(row[0] for row in rows)
+
+    def load(self, doc_id):
+        with self.lock:
+            row = self.connection.execute("SELECT status, data, changes FROM %(documents)s WHERE id = ?" % self.tables,
+                                          (doc_id,)).fetchone()
+        if row is None:
+            raise KeyError(doc_id)
+        status, data, changes = row
+        document = SyncedDocument(json.loads(data), status)
+        document.changes = json.loads(changes)
+        return document
+
+    def save(self, document):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO %(documents)s (id, version, status, data, changes) "
+                                    "VALUES (?, ?, ?, ?, ?)" % self.tables,
+                                    (document.id(), document.version(), document.status,
+                                     encode_document(document), json.dumps(document.changes)))
+
+    def delete(self, doc_id):
+        with self.lock:
+            self.connection.execute("DELETE FROM %(documents)s WHERE id = ?" % self.tables, (doc_id,))
+
+    # Documents created locally and not synced yet #
+
+    def load_new_documents(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT key, data FROM %(new_documents)s ORDER BY key" % self.tables).fetchall()
+        documents = []
+        for key, data in rows:
+            document = SyncedDocument(json.loads(data), SyncStatus.New)
+            document.replica_key = key
+            documents.append(document)
+        return documents
+
+    def save_new(self, document):
+        with self.lock:
+            key = getattr(document, "replica_key", None)
+            if key is None:
+                cursor = self.connection.execute("INSERT INTO %(new_documents)s (data) VALUES (?)" % self.tables,
+                                                 (encode_document(document),))
+                document.replica_key = cursor.lastrowid
+            else:
+                self.connection.execute("UPDATE %(new_documents)s SET data = ? WHERE key = ?" % self.tables,
+                                        (encode_document(document), key))
+
+    def remove_new(self, document):
+        with self.lock:
+            key = getattr(document, "replica_key", None)
+            if key is not None:
+                self.connection.execute("DELETE FROM %(new_documents)s WHERE key = ?" % self.tables, (key,))
+                document.replica_key = None
+
+class ReplicaDocuments(object):
+    """Documents of a DocumentReplica with the interface of
+       synced_client.DocumentMap
+
+       Documents are loaded on first access and stay in memory afterwards,
+       the version and status of the others are answered from an index
+       loaded on startup."""
+
+    def __init__(self, replica):
+        self.replica = replica
+        self.tracker = None
+        self.index = replica.load_index()
+        self.loaded = {}
+        self.listed = set()
+        # see merkle()
+        self.tree = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def __getitem__(self, doc_id):
+        document = self.loaded.get(doc_id)
+        if document is None:
+            if doc_id not in self.index:
+                raise KeyError(doc_id)
+            document = self.loaded[doc_id] = self.replica.load(doc_id)
+            document.tracker = self.tracker
+        return document
+
+    def get(self, doc_id, default=None):
+        if doc_id not in self.index:
+            return default
+        return self[doc_id]
+
+    def values(self):
+        return [self[doc_id] for doc_id in self.index]
+
+    def items(self):
+        return [(doc_id, self[doc_id]) for doc_id in self.index]
+
+    def __setitem__(self, doc_id, document):
+        assert document.id() == doc_id
+        self.loaded[doc_id] = document
+        self.save(document)
+
+    def __delitem__(self, doc_id):
+        version, status = self.index.pop(doc_id)
+        self.loaded.pop(doc_id, None)
+        self.replica.delete(doc_id)
+        self.track_version(doc_id, version, None)
+
+    def clear(self):
+        self.index = {}
+        self.loaded = {}
+        self.tree = None
+        self.replica.clear()
+
+    def merkle(self):
+        """MerkleTree of the (id, version) pairs of the documents, built on
+           first use and kept up to date afterwards"""
+        if self.tree is None:
+            tree = MerkleTree()
+            for doc_id, (version, status) in self.index.items():
+                tree.update(doc_id, None, version)
+            self.tree = tree
+        return self.tree
+
+    def track_version(self, doc_id, old_version, new_version):
+        if self.tree is not None:
+            self.tree.update(doc_id, old_version, new_version)
+
+    def state(self, doc_id):
+        document = self.loaded.get(doc_id)
+        if document is not None:
+            return document.version(), document.status
+        return self.index[doc_id]
+
+    def states(self, doc_ids):
+        return dict((doc_id, self.state(doc_id)) for doc_id in doc_ids if doc_id in self.index)
+
+    def dirty_ids(self):
+        modified_ids = set(doc_id for doc_id, (version, status) in self.index.items()
+                           if status == SyncStatus.Modified)
+        deleted_ids = set(doc_id for doc_id, (version, status) in self.index.items()
+                          if status == SyncStatus.Deleted)
+        return modified_ids, deleted_ids
+
+    def clear_listed(self):
+        self.listed = set()
+
+    def add_listed(self, doc_ids):
+        self.listed.update(doc_ids)
+
+    def count_listed(self):
+        return len(self.listed)
+
+    def unlisted_ids(self):
+        return set(self.index).difference(self.listed)
+
+    def load_meta(self, key, default=None):
+        return self.replica.load_meta(key, default)
+
+    def save_meta(self, key, value):
+        self.replica.save_meta(key, value)
+
+    def load_sync_state(self):
+        return self.replica.load_meta("sync_state", {})
+
+    def save_sync_state(self, state):
+        self.replica.save_meta("sync_state", state)
+
+    def save(self, document):
+        doc_id = document.id()
+        old_version = self.index[doc_id][0] if doc_id in self.index else None
+        self.index[doc_id] = (document.version(), document.status)
+        self.replica.save(document)
+        self.track_version(doc_id, old_version, document.version())
+
+    def save_new(self, document):
+        self.replica.save_new(document)
+
+    def remove_new(self, document):
+        self.replica.remove_new(document)
+
+    def commit(self):
+        self.replica.commit()
+
+class BoundedReplicaDocuments(ReplicaDocuments):
+    """ReplicaDocuments keeping at most cache_size documents in memory
+
+       The least recently used synced documents are dropped from memory
+       first, documents with local changes are kept apart and stay loaded
+       until they are synced.
+       There is no index, versions and statuses are read from the database,
+       a page of the library at a time by states(), and the ids listed by a
+       sync are kept in a temporary table."""
+
+    def __init__(self, replica, cache_size):
+        self.replica = replica
+        self.tracker = None
+        self.cache_size = cache_size
+        # synced documents, least recently used first
+        self.loaded = collections.OrderedDict()
+        # documents with local changes, never dropped
+        self.pinned = {}
+        self.tree = None
+
+    def __len__(self):
+        return self.replica.count()
+
+    def __contains__(self, doc_id):
+        return doc_id in self.loaded or doc_id in self.pinned or doc_id in self.replica.states([doc_id])
+
+    def __iter__(self):
+        return self.replica.iter_ids()
+
+    def keys(self):
+        return list(self.replica.iter_ids())
+
+    def __getitem__(self, doc_id):
+        document = self.pinned.get(doc_id)
+        if document is not None:
+            return document
+        document = self.loaded.pop(doc_id, None)
+        if document is None:
+            document = self.replica.load(doc_id)
+            document.tracker = self.tracker
+        self.cache(document)
+        return document
+
+    def get(self, doc_id, default=None):
+        try:
+            return self[doc_id]
+        except KeyError:
+            return default
+
+    def values(self):
+        return (self[doc_id] for doc_id in self.replica.iter_ids())
+
+    def items(self):
+        return ((doc_id, self[doc_id]) for doc_id in self.replica.iter_ids())
+
+    def __setitem__(self, doc_id, document):
+        assert document.id() == doc_id
+        self.save(document)
+
+    def __delitem__(self, doc_id):
+        if doc_id not in self:
+            raise KeyError(doc_id)
+        self.loaded.pop(doc_id, None)
+        self.pinned.pop(doc_id, None)
+        old_version = self.stored_version(doc_id)
+        self.replica.delete(doc_id)
+        self.track_version(doc_id, old_version, None)
+
+    def cache(self, document):
+        doc_id = document.id()
+        if not document.is_synced():
+            self.loaded.pop(doc_id, None)
+            self.pinned[doc_id] = document
+            return
+        self.pinned.pop(doc_id, None)
+        # most recently used last, it is kept as the caller may be about
+        # to change it
+        self.loaded.pop(doc_id, None)
+        self.loaded[doc_id] = document
+        while len(self.loaded) > max(self.cache_size, 1):
+            doc_id, cached = self.loaded.popitem(last=False)
+            if not cached.is_synced():
+                # changed since it was cached
+                self.pinned[doc_id] = cached
+
+    def clear(self):
+        self.loaded = collections.OrderedDict()
+        self.pinned = {}
+        self.tree = None
+        self.replica.clear()
+
+    def merkle(self):
+        if self.tree is None:
+            tree = MerkleTree()
+            for doc_id, version in self.replica.iter_versions():
+                tree.update(doc_id, None, version)
+            self.tree = tree
+        return self.tree
+
+    def stored_version(self, doc_id):
+        # only needed to keep the tree up to date
+        if self.tree is None:
+            return None
+        state = self.replica.states([doc_id]).get(doc_id)
+        return state[0] if state is not None else None
+
+    def cached(self, doc_id):
+        document = self.pinned.get(doc_id)
+        if document is None:
+            document = self.loaded.get(doc_id)
+        return document
+
+    def state(self, doc_id):
+        document = self.cached(doc_id)
+        if document is not None:
+            return document.version(), document.status
+        return self.replica.states([doc_id])[doc_id]
+
+    def states(self, doc_ids):
+        states = self.replica.states([doc_id for doc_id in doc_ids
+                                      if doc_id not in self.loaded and doc_id not in self.pinned])
+        for doc_id in doc_ids:
+            document = self.cached(doc_id)
+            if document is not None:
+                states[doc_id] = (document.version(), document.status)
+        return states
+
+    def dirty_ids(self):
+        return self.replica.ids_with_status(SyncStatus.Modified), self.replica.ids_with_status(SyncStatus.Deleted)
+
+    def clear_listed(self):
+        self.replica.clear_listed()
+
+    def add_listed(self, doc_ids):
+        self.replica.add_listed(doc_ids)
+
+    def count_listed(self):
+        return self.replica.count_listed()
+
+    def unlisted_ids(self):
+        return self.replica.unlisted_ids()
+
+    def save(self, document):
+        old_version = self.stored_version(document.id())
+        self.replica.save(document)
+        self.track_version(document.id(), old_version, document.version())
+        # pinned while it has local changes
+        self.cache(document)
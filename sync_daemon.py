@@ -0,0 +1,129 @@
+"""
+Background sync of a DummySyncedClient
+
+    sclient = DummySyncedClient()
+    daemon = SyncDaemon(sclient).start()
+    ...
+    daemon.stop()
+
+The daemon syncs on a schedule that adapts to the library: right after a sync
+that found changes on the server the next one comes after min_interval, every
+sync finding nothing multiplies the interval by backoff up to max_interval. A
+random jitter spreads the syncs of many accounts started at the same time.
+
+Local changes made through the client trigger a sync debounce seconds after
+the last one, so a burst of edits is sent by a single sync, but never more than
+max_debounce seconds after the first one.
+
+Documents can be edited while the daemon syncs, edits hold the lock of the
+client and those made while a change is being sent are sent by the next sync.
+"""
+
+import random
+import sys
+import threading
+import time
+
+class SyncDaemon(object):
+
+    def __init__(self, sclient, min_interval=10.0, max_interval=600.0, backoff=2.0,
+                 debounce=2.0, max_debounce=30.0, jitter=0.2, seed=None):
+        self.sclient = sclient
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.debounce = debounce
+        self.max_debounce = max_debounce
+        # fraction of the interval added or removed at random
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+        self.interval = min_interval
+        self.syncs = 0
+        self.failures = 0
+        # sys.exc_info() of the last failed sync
+        self.last_error = None
+        self.last_sync = None
+
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        # time of the next sync, the next scheduled one and the first
+        # local change not synced yet
+        self.due = self.scheduled = float("inf")
+        self.first_change = None
+
+    def start(self):
+        self.watch(self.sclient)
+        # the first syncs of accounts started together are spread too
+        with self.condition:
+            self.scheduled = time.time() + self.random.uniform(0, self.jitter * self.min_interval)
+            self.due = min(self.due, self.scheduled)
+        self.thread = threading.Thread(target=self.run, name="sync-daemon")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Wait for the sync in progress, if any, and stop"""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def watch(self, sclient):
+        # the clients of the groups are watched as they are added
+        for client in [sclient] + sclient.groups.values():
+            if self.local_changed not in client.local_change_listeners:
+                client.local_change_listeners.append(self.local_changed)
+
+    def local_changed(self):
+        """Called by the client when a document or folder is changed locally"""
+        with self.condition:
+            now = time.time()
+            if self.first_change is None:
+                self.first_change = now
+            self.due = min(now + self.debounce, self.first_change + self.max_debounce, self.scheduled)
+            self.condition.notify_all()
+
+    def sync_now(self):
+        with self.condition:
+            self.scheduled = self.due = time.time()
+            self.condition.notify_all()
+
+    def jittered(self, interval):
+        return interval * (1 + self.jitter * self.random.uniform(-1, 1))
+
+    def next_interval(self, changed):
+        """Interval until the next sync after one that found changes or not"""
+        if changed:
+            return self.min_interval
+        return min(self.interval * self.backoff, self.max_interval)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopping and time.time() < self.due:
+                    self.condition.wait(self.due - time.time())
+                if self.stopping:
+                    return
+                self.first_change = None
+                # edits made during the sync set it again
+                self.scheduled = self.due = float("inf")
+
+            self.watch(self.sclient)
+            changes = self.sclient.count_remote_changes()
+            try:
+                self.sclient.sync()
+            except Exception:
+                self.failures += 1
+                self.last_error = sys.exc_info()
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+            else:
+                self.syncs += 1
+                self.last_sync = time.time()
+                self.interval = self.next_interval(self.sclient.count_remote_changes() != changes)
+
+            with self.condition:
+                self.scheduled = time.time() + self.jittered(self.interval)
+                self.due = min(self.due, self.scheduled)
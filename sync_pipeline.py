@@ -0,0 +1,218 @@
+"""
+The sync of the documents of a DummySyncedClient run as concurrent stages
+
+           list -> reconcile -> fetch -> apply -> push
+                         \\_______________________/
+
+    pipeline = DocumentSyncPipeline(sclient, sclient.compare_library(full))
+    pipeline.run()      # False if the library changed while it was listed
+
+The library pages are fetched ahead by fetch_library_pages while reconcile
+turns them into the SyncOperations of a synced_client.LibraryComparison in
+the calling thread, the same operations a dry run plans. The fetch workers
+get the details of the new and outdated documents, apply merges them one at
+a time and the push workers send the local changes of the documents known to
+be up to date while the library is still listed. The conflicts are resolved
+at once when every document is fetched and the new local documents are
+created once the rest is done.
+"""
+
+import time
+
+import metrics
+from concurrency import Stage, run_stages
+
+class DocumentSyncPipeline(object):
+    """One DummySyncedClient.sync_documents pass
+
+       The local documents are only changed with sclient.lock held and no
+       stage waits for room in a queue with it held. Creations and deletions
+       would shift the pages still to be listed, they are held back until the
+       whole library is listed.
+
+       Once every operation of the first pages is done a checkpoint is saved
+       with the documents, an interrupted sync resumes listing after them.
+       A page with a conflict is only done once the conflicts are resolved."""
+
+    def __init__(self, sclient, comparison):
+        self.sclient = sclient
+        self.lock = sclient.lock
+        self.comparison = comparison
+        # set once the whole library is listed
+        self.listed = False
+        self.held = []
+        # (page number, local document, remote document) of the documents
+        # modified on both sides
+        self.conflicts = []
+        # items of each page still to be processed by a stage, the state to
+        # save once they are all done and the first page not done yet
+        self.outstanding = {}
+        self.page_states = {}
+        self.first_pending_page = comparison.first_page
+
+        workers = sclient.concurrency
+        self.fetch = Stage("fetch", self.fetch_document, workers)
+        self.apply = Stage("apply", self.apply_document)
+        # fed by reconcile and apply
+        self.push = Stage("push", self.push_change, workers, producers=2)
+
+    def run(self):
+        """Returns False if the library changed while it was listed"""
+        for stage in [self.fetch, self.apply, self.push]:
+            stage.start()
+        try:
+            consistent = self.reconcile()
+        finally:
+            self.fetch.close()
+            self.push.close()
+            try:
+                run_stages([self.fetch, self.apply])
+                self.resolve_conflicts()
+            finally:
+                # the last producer of push
+                self.push.close()
+                self.push.join()
+
+        with self.lock:
+            # the next sync starts over
+            self.sclient.documents.save_meta("checkpoint", None)
+        if consistent:
+            # after the new documents of the library are applied, one this
+            # client created before being interrupted isn't created again
+            self.sclient.send_new_documents()
+        with self.lock:
+            self.sclient.documents.commit()
+        return consistent
+
+    def reconcile(self):
+        sclient = self.sclient
+        comparison = self.comparison
+        operations = []
+        first_page = comparison.first_page
+        for page_number, remote_page in enumerate(sclient.fetch_library_pages(first_page), first_page):
+            start = time.time()
+            operations = comparison.compare_page(remote_page)
+            if operations is None:
+                break
+            self.queue_page(page_number, operations)
+            if metrics.registry.enabled:
+                metrics.registry.record_stage_item("reconcile", time.time() - start)
+
+        if operations is not None:
+            operations = comparison.finish()
+        consistent = operations is not None
+        if comparison.needs_full:
+            # see DummySyncedClient.full_sync_due
+            sclient.syncs_since_full = sclient.full_sync_interval
+
+        recreated = []
+        with self.lock:
+            for operation in operations or []:
+                # documents deleted on the server, the creations are sent by run
+                if operation.kind in ("remove", "conflict"):
+                    change = sclient.apply_remote_delete(operation.doc_id)
+                    if change is not None:
+                        recreated.append((None, change))
+            if consistent:
+                sclient.listed_high_water = comparison.high_water()
+                if metrics.registry.enabled and comparison.skipped:
+                    # details not fetched, the local documents are current
+                    metrics.registry.record_cache_hit("document_details", comparison.skipped)
+            self.listed = True
+            sclient.documents.commit()
+            held, self.held = self.held, []
+
+        for item in held + recreated:
+            self.push.put(item)
+        return consistent
+
+    def queue_page(self, page_number, operations):
+        """Queue the fetches and local changes of the operations of a page"""
+        state = self.comparison.checkpoint(page_number)
+        fetched_ids = [operation.doc_id for operation in operations if operation.fetches()]
+        # the changes of the fetched documents are sent once merged
+        local_ids = [operation.doc_id for operation in operations
+                     if operation.kind in ("update", "delete") and operation.doc_id not in fetched_ids]
+        with self.lock:
+            self.outstanding[page_number] = len(fetched_ids)
+
+        for doc_id in fetched_ids:
+            self.fetch.put((page_number, doc_id))
+        self.queue_local_changes(local_ids, page_number)
+        with self.lock:
+            self.page_states[page_number] = state
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        # must be called with the lock held
+        state = None
+        while (self.first_pending_page in self.page_states and
+               self.outstanding[self.first_pending_page] == 0):
+            state = self.page_states.pop(self.first_pending_page)
+            del self.outstanding[self.first_pending_page]
+            self.first_pending_page += 1
+        if state is not None:
+            self.sclient.documents.save_meta("checkpoint", state)
+            self.sclient.documents.commit()
+
+    def done(self, page_number):
+        """An item of a page is processed"""
+        if page_number is None:
+            return
+        with self.lock:
+            self.outstanding[page_number] -= 1
+            self.save_checkpoint()
+
+    def queue_local_changes(self, doc_ids, page_number):
+        """Queue the local changes of up to date documents to be pushed"""
+        changes = []
+        for doc_id in doc_ids:
+            change = self.sclient.take_local_change(doc_id)
+            if change is not None:
+                changes.append(change)
+        with self.lock:
+            self.outstanding[page_number] += len(changes)
+        for change in changes:
+            self.push.put((page_number, change))
+
+    def fetch_document(self, item):
+        page_number, remote_id = item
+        self.apply.put((page_number, self.sclient.fetch_document(remote_id)))
+
+    def apply_document(self, item):
+        page_number, remote_document = item
+        conflicts = []
+        with self.lock:
+            self.sclient.apply_remote_document(remote_document, conflicts)
+            self.conflicts.extend((page_number, local_document, remote_document)
+                                  for local_document, remote_document in conflicts)
+        if not conflicts:
+            self.applied(page_number, remote_document.id())
+
+    def resolve_conflicts(self):
+        """Resolve the conflicts once every document is fetched and applied,
+           as DummySyncedClient.apply_remote_operations does"""
+        with self.lock:
+            conflicts, self.conflicts = self.conflicts, []
+            self.sclient.resolve_conflicts([(local_document, remote_document)
+                                            for page_number, local_document, remote_document in conflicts])
+            self.sclient.documents.commit()
+        for page_number, local_document, remote_document in conflicts:
+            self.applied(page_number, remote_document.id())
+
+    def applied(self, page_number, doc_id):
+        # a fetched document is merged, its local changes are up to date,
+        # including those a merge made
+        self.queue_local_changes([doc_id], page_number)
+        self.done(page_number)
+
+    def push_change(self, item):
+        page_number, change = item
+        if change[0] != "update":
+            with self.lock:
+                if not self.listed:
+                    self.held.append(item)
+                    return
+
+        self.sclient.push_change(change)
+        self.done(page_number)
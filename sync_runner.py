@@ -0,0 +1,192 @@
+"""
+Sync of many accounts at once
+
+    store = MendeleyTokensStore("keys_api-oauth2.mendeley.com.pkl")
+    report = sync_accounts(store, ConfiguredClientFactory("config.json"),
+                           processes=4, connections=64, replica_directory="replicas")
+    print report["accounts_per_second"], report["failed"]
+
+The accounts of the token store are sharded across processes, each process
+syncs up to accounts_per_process of its accounts at once on threads and the
+requests of all its accounts share a budget of connections / processes in
+flight, so the total is bounded by connections whatever the number of
+accounts. An account whose sync fails is reported and doesn't stop the others.
+"""
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import metrics
+from concurrency import Budgeted, bounded_imap
+from mendeley_client import MendeleyClient, MendeleyClientConfig
+from replica import DocumentReplica
+from synced_client import DummySyncedClient
+
+class ConfiguredClientFactory(object):
+    """Create the MendeleyClient of an account from a config file, picklable
+       so it can be sent to the worker processes"""
+
+    def __init__(self, config_file="config.json"):
+        self.config_file = config_file
+
+    def __call__(self, account, access_token):
+        config = MendeleyClientConfig(self.config_file)
+        if not config.is_valid():
+            raise Exception("Please edit %s before syncing accounts" % self.config_file)
+        client = MendeleyClient(config.client_id, config.client_secret,
+                                {"host": getattr(config, "host", "api-oauth2.mendeley.com")})
+        client.set_access_token(access_token)
+        return client
+
+class AccountResult(object):
+    """Outcome of the sync of an account, error is None if it succeeded"""
+
+    def __init__(self, account, seconds, documents=0, remote_changes=0, pushed=0, error=None):
+        self.account = account
+        self.seconds = seconds
+        self.documents = documents
+        self.remote_changes = remote_changes
+        self.pushed = pushed
+        self.error = error
+
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.error is not None:
+            return "<AccountResult %s failed: %s>" % (self.account, self.error)
+        return "<AccountResult %s %d documents in %.2fs>" % (self.account, self.documents, self.seconds)
+
+def sync_account(account, client, options):
+    replica = None
+    start = time.time()
+    try:
+        if options.get("replica_directory"):
+            replica = DocumentReplica(os.path.join(options["replica_directory"], "%s.db" % account))
+        sclient = DummySyncedClient(client=client, replica=replica,
+                                    page_size=options.get("page_size", 500),
+                                    concurrency=options.get("concurrency", 4))
+        sclient.sync(options.get("full", False))
+        return AccountResult(account, time.time() - start, len(sclient.documents),
+                             sclient.count_remote_changes(), len(sclient.push_results))
+    except Exception as e:
+        return AccountResult(account, time.time() - start, error="%s: %s" % (type(e).__name__, e))
+    finally:
+        if replica is not None:
+            replica.close()
+
+def sync_shard(accounts, client_factory, options):
+    """Sync accounts, a list of (account, access_token), in a worker process
+
+       Return the AccountResult of every account and the latency histograms
+       of the requests sent, by api method"""
+    metrics.registry.reset()
+    metrics.registry.enable()
+    budget = threading.BoundedSemaphore(options["connections"])
+
+    def sync(item):
+        account, access_token = item
+        try:
+            client = Budgeted(client_factory(account, access_token), budget)
+        except Exception as e:
+            return AccountResult(account, 0.0, error="%s: %s" % (type(e).__name__, e))
+        return sync_account(account, client, options)
+
+    results = list(bounded_imap(sync, accounts, options["accounts_per_process"]))
+    latencies = dict((name, method_metrics.latency) for name, method_metrics in metrics.registry.methods.items())
+    return results, latencies
+
+def _sync_shard(args):
+    # Pool.imap_unordered passes a single argument
+    return sync_shard(*args)
+
+def summarize(results, latencies, seconds):
+    sync_seconds = metrics.Histogram()
+    for result in results:
+        if result.succeeded():
+            sync_seconds.observe(result.seconds)
+    request_latency = metrics.Histogram()
+    for histogram in latencies.values():
+        request_latency.merge(histogram)
+    documents = sum(result.documents for result in results)
+    return {"accounts": len(results),
+            "failed": [result for result in results if not result.succeeded()],
+            "results": results,
+            "seconds": seconds,
+            "accounts_per_second": len(results) / seconds if seconds else None,
+            "documents_per_second": documents / seconds if seconds else None,
+            "sync_seconds": sync_seconds.snapshot(),
+            "request_latency": request_latency.snapshot(),
+            "requests": dict((name, histogram.count) for name, histogram in latencies.items())}
+
+def sync_accounts(tokens_store, client_factory, processes=None, accounts_per_process=16,
+                  connections=64, accounts=None, **options):
+    """Sync the accounts of a MendeleyTokensStore, all of them or the given
+       keys, and return a report of the run
+
+       client_factory(account, access_token) returns the client of an
+       account, it's called in the worker processes and must be picklable.
+       Other options (page_size, concurrency, full, replica_directory with a
+       replica per account) are passed on to the sync of every account."""
+    if accounts is None:
+        accounts = sorted(tokens_store.accounts.keys())
+    accounts = [(account, tokens_store.get_access_token(account)) for account in accounts]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(accounts)))
+    options["accounts_per_process"] = accounts_per_process
+    options["connections"] = max(1, connections // processes)
+    if options.get("replica_directory") and not os.path.isdir(options["replica_directory"]):
+        os.makedirs(options["replica_directory"])
+
+    start = time.time()
+    results = []
+    latencies = {}
+    pool = multiprocessing.Pool(processes)
+    try:
+        shards = [(accounts[i::processes], client_factory, options) for i in range(processes)]
+        for shard_results, shard_latencies in pool.imap_unordered(_sync_shard, shards):
+            results.extend(shard_results)
+            for name, histogram in shard_latencies.items():
+                if name in latencies:
+                    latencies[name].merge(histogram)
+                else:
+                    latencies[name] = histogram
+    finally:
+        pool.close()
+        pool.join()
+    results.sort(key=lambda result: result.account)
+    return summarize(results, latencies, time.time() - start)
+
+def main():
+    import optparse
+    from mendeley_client import MendeleyTokensStore
+
+    parser = optparse.OptionParser(usage="%prog [options] keys_file")
+    parser.add_option("--config", default="config.json")
+    parser.add_option("--processes", type="int", default=None, help="worker processes, one per cpu by default")
+    parser.add_option("--accounts-per-process", type="int", default=16, help="accounts synced at once by a process")
+    parser.add_option("--connections", type="int", default=64, help="requests in flight over all the processes")
+    parser.add_option("--replicas", help="directory of the replica of each account")
+    parser.add_option("--full", action="store_true", default=False)
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("the keys file is required")
+
+    tokens_store = MendeleyTokensStore(args[0])
+    # the accounts are only read
+    tokens_store.filename = None
+    report = sync_accounts(tokens_store, ConfiguredClientFactory(options.config), options.processes,
+                           options.accounts_per_process, options.connections,
+                           replica_directory=options.replicas, full=options.full)
+    print "%d accounts synced in %.2fs, %.1f accounts/s, %d failed" % (
+        report["accounts"], report["seconds"], report["accounts_per_second"], len(report["failed"]))
+    for result in report["failed"]:
+        print result
+    sys.exit(1 if report["failed"] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,14 @@
+import copy
+import hashlib
+import json
+import threading
+
+import metrics
 from mendeley_client import *
+from concurrency import Budgeted, bounded_imap
+from merkle import MerkleTree
+from attachments import chunked, valid_file_hash
+from sync_pipeline import DocumentSyncPipeline
 
 class SyncStatus:
     Deleted = 0
@@ -10,12 +20,177 @@ class SyncStatus:
     def to_str(status):
         return ["DEL","MOD","NEW","SYN"][status]
 
-class Object:
-    pass
+def fingerprint(value):
+    """Hash of the canonical json of a field value, the same for equal values
+       whatever the order of their keys or the type of their strings"""
+    return hashlib.sha1(json.dumps(value, sort_keys=True, separators=(",", ":"))).digest()
+
+def document_view(document):
+    """The fields of a document as seen locally, its synced values with the
+       local changes not sent yet applied"""
+    view = document.to_json()
+    view.update(document.changes)
+    return view
+
+def changed_fields(before, after):
+    """Sorted names of the fields differing between two document_views"""
+    return sorted(key for key in set(before) | set(after)
+                  if key not in before or key not in after or fingerprint(before[key]) != fingerprint(after[key]))
+
+class FieldTable(object):
+    """Known fields of a kind of object, in a fixed order
+
+       Records with the same set of fields share a Shape, so the field names
+       and their positions are stored once and not in every record."""
+
+    def __init__(self, fields):
+        self.rank = dict((name, i) for i, name in enumerate(fields))
+        self.shapes = {}
+        self.empty = self.shape(())
+
+    def shape(self, names):
+        key = frozenset(names)
+        shape = self.shapes.get(key)
+        if shape is None:
+            # known fields first in table order, unknown ones after by name
+            ordered = sorted(key, key=lambda name: (self.rank.get(name, len(self.rank)), name))
+            shape = self.shapes[key] = Shape(self, tuple(intern_name(name) for name in ordered))
+        return shape
+
+def intern_name(name):
+    # json keys are unicode, only str can be interned
+    try:
+        return intern(str(name))
+    except UnicodeEncodeError:
+        return name
+
+class Shape(object):
+    """Field names of records and their positions in Record.values"""
+
+    def __init__(self, table, names):
+        self.table = table
+        self.names = names
+        self.index = dict((name, i) for i, name in enumerate(names))
+        self.projections = {}
+
+    def with_field(self, name):
+        return self.table.shape(self.names + (name,))
+
+    def without_field(self, name):
+        return self.table.shape(n for n in self.names if n != name)
+
+    def projection(self, fields):
+        """(name, position) of the fields of this shape in fields"""
+        positions = self.projections.get(fields)
+        if positions is None:
+            positions = self.projections[fields] = [(name, i) for i, name in enumerate(self.names)
+                                                    if name in fields]
+        return positions
+
+class Record(object):
+    """Object with attributes for the fields of a dict, only the values
+       are stored per record, see FieldTable"""
+
+    __slots__ = ("shape", "values")
+
+    def __init__(self, table, obj=None):
+        if obj:
+            shape = table.shape(obj.keys())
+            values = [obj[name] for name in shape.names]
+        else:
+            shape = table.empty
+            values = []
+        object.__setattr__(self, "shape", shape)
+        object.__setattr__(self, "values", values)
+
+    def __getattr__(self, name):
+        # only called for the fields, shape and values are slots, still
+        # unset on a record copy or pickle is making
+        if name in Record.__slots__ or name.startswith("__"):
+            raise AttributeError(name)
+        i = self.shape.index.get(name)
+        if i is None:
+            raise AttributeError(name)
+        return self.values[i]
+
+    def __getstate__(self):
+        return self.shape, self.values
+
+    def __setstate__(self, state):
+        object.__setattr__(self, "shape", state[0])
+        object.__setattr__(self, "values", list(state[1]))
+
+    def __copy__(self):
+        record = Record.__new__(Record)
+        record.__setstate__((self.shape, self.values))
+        return record
+
+    def __deepcopy__(self, memo):
+        # the shape is shared with the other records
+        record = Record.__new__(Record)
+        record.__setstate__((self.shape, copy.deepcopy(self.values, memo)))
+        return record
+
+    def __setattr__(self, name, value):
+        i = self.shape.index.get(name)
+        if i is not None:
+            self.values[i] = value
+            return
+        obj = self.to_dict()
+        obj[name] = value
+        shape = self.shape.with_field(name)
+        object.__setattr__(self, "shape", shape)
+        object.__setattr__(self, "values", [obj[n] for n in shape.names])
+
+    def __delattr__(self, name):
+        if name not in self.shape.index:
+            raise AttributeError(name)
+        obj = self.to_dict()
+        del obj[name]
+        shape = self.shape.without_field(name)
+        object.__setattr__(self, "shape", shape)
+        object.__setattr__(self, "values", [obj[n] for n in shape.names])
+
+    def __contains__(self, name):
+        return name in self.shape.index
+
+    def keys(self):
+        return list(self.shape.names)
+
+    def items(self):
+        return zip(self.shape.names, self.values)
+
+    def to_dict(self, fields=None):
+        """The fields as a dict, only those in fields (a frozenset) if given"""
+        if fields is None:
+            return dict(zip(self.shape.names, self.values))
+        values = self.values
+        return dict((name, values[i]) for name, i in self.shape.projection(fields))
+
+class _Unlocked(object):
+    # lock of the objects no client tracks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_UNLOCKED = _Unlocked()
+
+class SyncedObject(object):
+
+    # no per instance __dict__, there can be a lot of documents,
+    # replica_key identifies new documents, set by the DocumentMap
+    __slots__ = ("tracker", "status", "changes", "object", "replica_key")
 
-class SyncedObject:
+    field_table = FieldTable(["id", "version"])
 
     def __init__(self, obj, status=SyncStatus.New):
+        # notified when the object is modified or deleted locally,
+        # see DummySyncedClient.mark_dirty
+        self.tracker = None
+        self.replica_key = None
         self.reset(obj, status)
         
     def reset(self, obj, status):
@@ -23,32 +198,79 @@ class SyncedObject:
         self.status = status
 
         if isinstance(obj, dict):
-            self.object = Object()
-            for key in obj.keys():
-                setattr(self.object, key, obj[key])
+            self.object = Record(self.field_table, obj)
         elif isinstance(obj, SyncedObject):
             self.object = obj.object
         else:
             assert False
 
     def version(self):
-        if not hasattr(self.object, "version"):
+        if "version" not in self.object:
             return None
         return self.object.version
 
     def id(self):
-        if not hasattr(self.object, "id"):
+        if "id" not in self.object:
             return None
         return self.object.id
 
+    def sync_lock(self):
+        """Lock of the client tracking the object, held while changing it so
+           that edits don't interleave with a sync running on another
+           thread, e.g. the one of a sync_daemon.SyncDaemon"""
+        if self.tracker is None:
+            return _UNLOCKED
+        return self.tracker.lock
+
     def update(self, change):
         if len(change.keys()) == 0:
             return
+        with self.sync_lock():
+            changed = self.apply_update(change)
+        if changed:
+            self.mark_dirty()
+
+    def apply_update(self, change):
         # TODO add some checking of the keys etc
+        if self.is_new():
+            # nothing to send the changes against, the whole object
+            # will be created on the server
+            for key, value in change.items():
+                setattr(self.object, key, value)
+            return True
+
         for key, value in change.items():
-            self.changes[key] = value
-        
-        self.status = SyncStatus.Modified
+            if self.is_unchanged(key, value):
+                # set back to the synced value
+                self.changes.pop(key, None)
+            else:
+                self.changes[key] = value
+
+        if self.changes:
+            self.status = SyncStatus.Modified
+        elif self.is_modified():
+            # every change was reverted
+            self.status = SyncStatus.Synced
+        else:
+            return False
+        return True
+
+    def is_unchanged(self, key, value):
+        """True if value is the synced value of the field, self.object
+           holds the synced values until the changes are sent"""
+        if key not in self.object:
+            return False
+        return fingerprint(getattr(self.object, key)) == fingerprint(value)
+
+    def diff(self):
+        """The changes that still differ from the synced values, conflict
+           resolution can make some of them match"""
+        return dict((key, value) for key, value in self.changes.items()
+                    if not self.is_unchanged(key, value))
+
+    def mark_dirty(self):
+        if self.tracker is not None:
+            self.tracker.mark_dirty(self)
 
     def apply_changes(self):
         if len(self.changes) == 0:
@@ -58,10 +280,7 @@ class SyncedObject:
             setattr(self.object, key, value)
 
     def to_json(self):
-        obj = {}
-        for key in vars(self.object):
-            obj[key] = getattr(self.object,key)
-        return obj
+        return self.object.to_dict()
 
     def is_deleted(self):
         return self.status == SyncStatus.Deleted
@@ -76,13 +295,60 @@ class SyncedObject:
         return self.status == SyncStatus.Synced
 
     def delete(self):
-        self.status = SyncStatus.Deleted
+        with self.sync_lock():
+            self.status = SyncStatus.Deleted
+        self.mark_dirty()
         
 class SyncedFolder(SyncedObject):
-    pass
+    """A folder and the ids of its documents
+
+       Folders created locally have a negative id until they are created on
+       the server. The api can't rename or move folders, changes to the name
+       or parent of an existing folder are overwritten by the server ones."""
+
+    __slots__ = ("document_ids", "synced_document_ids")
+
+    field_table = FieldTable(["id", "name", "parent"])
+
+    def __init__(self, obj, status=SyncStatus.New, document_ids=()):
+        SyncedObject.__init__(self, obj, status)
+        self.document_ids = set(document_ids)
+        # documents of the folder on the server at the last sync
+        self.synced_document_ids = set()
+
+    def parent(self):
+        return getattr(self.object, "parent", None)
+
+    def add_document(self, doc_id):
+        with self.sync_lock():
+            changed = doc_id not in self.document_ids
+            self.document_ids.add(doc_id)
+        if changed:
+            self.mark_dirty()
+
+    def remove_document(self, doc_id):
+        with self.sync_lock():
+            changed = doc_id in self.document_ids
+            self.document_ids.discard(doc_id)
+        if changed:
+            self.mark_dirty()
+
+    def mark_dirty(self):
+        # folders are kept in memory and diffed by sync_folders, there is
+        # nothing to save
+        if self.tracker is not None:
+            self.tracker.notify_local_change()
+
+    def to_json(self):
+        folder = {"name": self.object.name}
+        if self.parent() is not None:
+            folder["parent"] = self.parent()
+        return folder
 
 class SyncedDocument(SyncedObject):
 
+    __slots__ = ()
+
     document_fields = [
         "abstract", "advisor", "applicationNumber", "articleColumn", "arxiv", 
         "authors", "cast", "chapter", "citation_key", "city", "code", "codeNumber", 
@@ -97,17 +363,23 @@ class SyncedDocument(SyncedObject):
         "source_type", "tags", "time", "title", "translators", "type","userType", "volume", 
         "website", "year"
         ]
+    document_field_set = frozenset(document_fields)
+
+    field_table = FieldTable(["id", "version"] + document_fields)
+
+    # set by the server whatever create_document is sent
+    server_fields = frozenset(["id", "version", "lastUpdate"])
 
     def __str__(self):
         return self.object.id
 
     def to_json(self):
-        obj = {}
+        return self.object.to_dict(SyncedDocument.document_field_set)
 
-        for key in vars(self.object):
-            if key in SyncedDocument.document_fields:
-                obj[key] = getattr(self.object,key)
-        return obj
+    def creation_json(self):
+        """The fields create_document is sent to create the document"""
+        return dict((key, value) for key, value in self.to_json().items()
+                    if key not in SyncedDocument.server_fields)
 
 class ConflictResolver:
 
@@ -147,9 +419,8 @@ class SimpleConflictResolver(ConflictResolver):
 
         local_changes = local_document.changes
 
-        for key in vars(remote_document.object):
-            remote_value = getattr(remote_document.object, key)
-            if hasattr(local_document.object, key):
+        for key, remote_value in remote_document.object.items():
+            if key in local_document.object:
                 local_value = getattr(local_document.object, key)
                 if local_value == remote_value:
                     # nothing changed
@@ -176,6 +447,11 @@ class SimpleConflictResolver(ConflictResolver):
         # the local_document data now is in sync with the remote_document
         assert local_document.version() == remote_document.version()
 
+        # local changes the server already has don't need to be sent
+        for key, value in local_changes.items():
+            if local_document.is_unchanged(key, value):
+                del local_changes[key]
+
         # if no local changes are left, the document isn't modified anymore
         if len(local_changes) == 0:
             local_document.status = SyncStatus.Synced
@@ -187,25 +463,721 @@ class SimpleConflictResolver(ConflictResolver):
         # dumb "resolution", 
         return False
 
+class ThreeWayMergeResolver(SimpleConflictResolver):
+    """Merges each field changed on both sides against its synced value,
+       the base kept in the document until its local changes are sent
+
+       Elements added or removed on either side of list fields are merged,
+       for other fields resolve_conflict decides as in SimpleConflictResolver.
+       Fields only changed on one side take the value of that side."""
+
+    list_fields = frozenset(["authors", "editors", "tags", "keywords", "translators", "producers",
+                             "cast", "seriesEditor", "sections"])
+
+    def resolve_both_updated(self, local_document, remote_document):
+        assert isinstance(remote_document, SyncedDocument)
+        assert isinstance(local_document, SyncedDocument)
+
+        base = local_document.object
+        local_changes = local_document.changes
+
+        for key, remote_value in remote_document.object.items():
+            base_value = getattr(base, key, None)
+            if key in base and base_value == remote_value:
+                # not changed on the server
+                continue
+
+            # the remote value is the new base
+            setattr(base, key, remote_value)
+            if key not in local_changes:
+                continue
+
+            merged = self.merge_field(key, base_value, local_changes[key], remote_value)
+            if fingerprint(merged) == fingerprint(remote_value):
+                del local_changes[key]
+            else:
+                local_changes[key] = merged
+
+        assert local_document.version() == remote_document.version()
+
+        if len(local_changes) == 0:
+            local_document.status = SyncStatus.Synced
+
+    def merge_field(self, key, base_value, local_value, remote_value):
+        """Value of a field changed on both sides"""
+        if fingerprint(local_value) == fingerprint(remote_value):
+            return remote_value
+        if key in self.list_fields and all(isinstance(value, list) for value in
+                                           [base_value or [], local_value, remote_value]):
+            return self.merge_lists(base_value or [], local_value, remote_value)
+        if self.resolve_conflict(key, local_value, remote_value):
+            return remote_value
+        return local_value
+
+    def merge_lists(self, base, local, remote):
+        """remote without the elements removed locally, followed by the
+           elements added locally"""
+        base_keys = set(fingerprint(item) for item in base)
+        local_keys = set(fingerprint(item) for item in local)
+        removed = base_keys - local_keys
+
+        merged = []
+        merged_keys = set()
+        for item in remote:
+            key = fingerprint(item)
+            if key not in removed and key not in merged_keys:
+                merged.append(item)
+                merged_keys.add(key)
+        for item in local:
+            key = fingerprint(item)
+            if key not in base_keys and key not in merged_keys:
+                merged.append(item)
+                merged_keys.add(key)
+        return merged
+
+def folder_ancestors(folder_id, parents):
+    """Ids of the folders above folder_id, parents maps folder ids to the
+       id of their parent"""
+    ancestors = []
+    parent = parents.get(folder_id)
+    while parent is not None and parent not in ancestors:
+        ancestors.append(parent)
+        parent = parents.get(parent)
+    return ancestors
+
+class GroupApi(object):
+    """The api calls used by DummySyncedClient, with the names and arguments
+       of the personal library ones, made on the library of a group"""
+
+    def __init__(self, client, group_id):
+        self.client = client
+        self.group_id = group_id
+
+    def library(self, page, items):
+        return self.client.group_documents(self.group_id, page=page, items=items)
+
+    def document_details(self, doc_id):
+        return self.client.group_doc_details(self.group_id, doc_id)
+
+    def create_document(self, document):
+        document = dict(document)
+        document["group_id"] = self.group_id
+        return self.client.create_document(document=document)
+
+    def update_document(self, doc_id, document):
+        return self.client.update_document(doc_id, document=document)
+
+    def delete_library_document(self, doc_id):
+        return self.client.delete_group_document(self.group_id, doc_id)
+
+    def folders(self):
+        return self.client.group_folders(self.group_id)
+
+    def folder_documents(self, folder_id, page, items):
+        return self.client.group_folder_documents(self.group_id, folder_id, page=page, items=items)
+
+    def create_folder(self, folder):
+        return self.client.create_group_folder(self.group_id, folder=folder)
+
+    def delete_folder(self, folder_id):
+        return self.client.delete_group_folder(self.group_id, folder_id)
+
+    def add_document_to_folder(self, folder_id, doc_id):
+        return self.client.add_document_to_group_folder(self.group_id, folder_id, doc_id)
+
+    def delete_document_from_folder(self, folder_id, doc_id):
+        return self.client.delete_document_from_group_folder(self.group_id, folder_id, doc_id)
+
+    def download_file(self, doc_id, file_hash):
+        return self.client.download_file_group(doc_id, file_hash, self.group_id)
+
+class DocumentMap(dict):
+    """In memory documents of a DummySyncedClient, keyed by id
+
+       replica.ReplicaDocuments implements the same interface backed
+       by a local database"""
+
+    def __init__(self):
+        dict.__init__(self)
+        # set to the DummySyncedClient to notify of local modifications
+        self.tracker = None
+        self.meta = {}
+        self.last_new_key = 0
+        # ids listed by the sync in progress
+        self.listed = set()
+        # see merkle()
+        self.tree = None
+        self.versions = None
+
+    def __setitem__(self, doc_id, document):
+        dict.__setitem__(self, doc_id, document)
+        self.track_version(doc_id, document.version())
+
+    def __delitem__(self, doc_id):
+        dict.__delitem__(self, doc_id)
+        self.track_version(doc_id, None)
+
+    def merkle(self):
+        """MerkleTree of the (id, version) pairs of the documents, built on
+           first use and kept up to date afterwards"""
+        if self.tree is None:
+            self.versions = dict((doc_id, document.version()) for doc_id, document in self.items())
+            tree = MerkleTree()
+            for doc_id, version in self.versions.items():
+                tree.update(doc_id, None, version)
+            self.tree = tree
+        return self.tree
+
+    def track_version(self, doc_id, version):
+        # the versions are changed in place, the tree needs the previous one
+        if self.tree is not None:
+            self.tree.update(doc_id, self.versions.pop(doc_id, None), version)
+            if version is not None:
+                self.versions[doc_id] = version
+
+    def state(self, doc_id):
+        """(version, status) of a document"""
+        document = self[doc_id]
+        return document.version(), document.status
+
+    def states(self, doc_ids):
+        """{id: (version, status)} of the known documents among doc_ids"""
+        return dict((doc_id, self.state(doc_id)) for doc_id in doc_ids if doc_id in self)
+
+    def dirty_ids(self):
+        """(modified ids, deleted ids)"""
+        modified_ids = set(doc_id for doc_id, document in self.items() if document.is_modified())
+        deleted_ids = set(doc_id for doc_id, document in self.items() if document.is_deleted())
+        return modified_ids, deleted_ids
+
+    def clear_listed(self):
+        self.listed = set()
+
+    def add_listed(self, doc_ids):
+        """Record ids listed by a full sync"""
+        self.listed.update(doc_ids)
+
+    def count_listed(self):
+        return len(self.listed)
+
+    def unlisted_ids(self):
+        """Ids of the documents not listed, deleted on the server"""
+        return set(self).difference(self.listed)
+
+    def clear(self):
+        dict.clear(self)
+        self.meta = {}
+        self.tree = None
+
+    def load_meta(self, key, default=None):
+        """State of the sync engine saved with the documents"""
+        return self.meta.get(key, default)
+
+    def save_meta(self, key, value):
+        self.meta[key] = value
+
+    def load_sync_state(self):
+        """Watermarks of the last syncs, see DummySyncedClient.save_sync_state"""
+        return dict(self.load_meta("sync_state", {}))
+
+    def save_sync_state(self, state):
+        self.save_meta("sync_state", dict(state))
+
+    # nothing to persist
+
+    def save(self, document):
+        self.track_version(document.id(), document.version())
+
+    def save_new(self, document):
+        # identifies the new document like a replica does
+        if document.replica_key is None:
+            self.last_new_key += 1
+            document.replica_key = self.last_new_key
+
+    def remove_new(self, document):
+        pass
+
+    def commit(self):
+        pass
+
+class PushResult(object):
+    """Outcome of sending a local change, operation is "create", "update" or
+       "delete". doc_id is the id of the document after the push, None for a
+       new document that couldn't be created, version its new version and
+       error why the push failed, None if it succeeded."""
+
+    def __init__(self, operation, doc_id, version=None, error=None):
+        self.operation = operation
+        self.doc_id = doc_id
+        self.version = version
+        self.error = error
+
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.error is not None:
+            return "<PushResult %s %s failed: %s>" % (self.operation, self.doc_id, self.error)
+        return "<PushResult %s %s version %s>" % (self.operation, self.doc_id, self.version)
+
+class DownloadResult(object):
+    """Outcome of downloading a file attached to the document doc_id to the
+       attachments.AttachmentStore, error is why it failed, None if it
+       succeeded"""
+
+    def __init__(self, file_hash, doc_id, size=None, error=None):
+        self.file_hash = file_hash
+        self.doc_id = doc_id
+        self.size = size
+        self.error = error
+
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.error is not None:
+            return "<DownloadResult %s of %s failed: %s>" % (self.file_hash, self.doc_id, self.error)
+        return "<DownloadResult %s of %s, %s bytes>" % (self.file_hash, self.doc_id, self.size)
+
+def push_request(method, *args, **kwargs):
+    """Call an api method, returning the exception it raises if any so a
+       failed push doesn't abort the sync"""
+    try:
+        return method(*args, **kwargs)
+    except Exception, e:
+        return e
+
+def push_error(response, *keys):
+    """Why a push failed, None if response is a successful one with all of keys"""
+    if isinstance(response, Exception):
+        return "%s: %s" % (type(response).__name__, response)
+    if isinstance(response, dict):
+        if "error" in response:
+            return response["error"]
+        missing = [key for key in keys if key not in response]
+        if missing:
+            return "no %s in the response" % ", ".join(missing)
+        return None
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        return "status %d" % status
+    return "unexpected response %r" % (response,)
+
+class ChangeEvent(object):
+    """A change made to the local documents by a sync, sent to the
+       change_listeners of DummySyncedClient
+
+       kind: "added", "updated", "deleted" or "conflict_resolved"
+       source: "remote" for a change made on the server, "local" for a local
+               change the server accepted
+       fields: names of the fields changed, when known
+       previous_id: id of a document before it was created on the server,
+                    None for a document new locally
+       group_id: the group of the document, None in the user library"""
+
+    def __init__(self, kind, doc_id, source, version=None, fields=None, previous_id=None, group_id=None):
+        self.kind = kind
+        self.doc_id = doc_id
+        self.source = source
+        self.version = version
+        self.fields = fields
+        self.previous_id = previous_id
+        self.group_id = group_id
+
+    def to_dict(self):
+        return dict((key, value) for key, value in self.__dict__.items() if value is not None)
+
+    @staticmethod
+    def from_dict(values):
+        return ChangeEvent(**dict((str(key), value) for key, value in values.items()))
+
+    def __eq__(self, other):
+        return isinstance(other, ChangeEvent) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<ChangeEvent %s %s %s %s>" % (self.source, self.kind, self.doc_id, self.fields or "")
+
+class SyncOperation(object):
+    """A step of a SyncPlan
+
+       fetch: get a document new or changed on the server and apply it
+       conflict: a document changed on both sides, fetched to be merged, or
+                 without remote_version modified locally and deleted on the server
+       remove: remove a local document deleted on the server
+       update, delete: send a local change
+       create: send a new local document, doc_id is None"""
+
+    # requests sent by each kind of operation, a conflict on a document
+    # deleted on the server usually recreates it
+    REQUESTS = {"fetch": 1, "conflict": 1, "remove": 0, "update": 1, "delete": 1, "create": 1}
+
+    def __init__(self, kind, doc_id, remote_version=None, document=None):
+        self.kind = kind
+        self.doc_id = doc_id
+        self.remote_version = remote_version
+        self.document = document
+
+    def fetches(self):
+        return self.kind in ("fetch", "conflict") and self.remote_version is not None
+
+    def __repr__(self):
+        if self.remote_version is not None:
+            return "<SyncOperation %s %s version %s>" % (self.kind, self.doc_id, self.remote_version)
+        return "<SyncOperation %s %s>" % (self.kind, self.doc_id)
+
+def plan_operations(listed, local_states, remote_deleted_ids=(), dirty_ids=(), new_documents=()):
+    """The SyncOperations reconciling the local documents with the library,
+       in the order they are run, nothing is read or changed
+
+       listed: (id, version) of the documents listed, in library order
+       local_states: (version, status) by id of the local documents among
+                     listed, remote_deleted_ids and dirty_ids
+       remote_deleted_ids: ids of the local documents missing from the library
+       dirty_ids: ids of the local documents modified or deleted since the last sync
+       new_documents: the local documents not created on the server yet"""
+    operations = []
+    for doc_id, remote_version in listed:
+        state = local_states.get(doc_id)
+        if state is None:
+            operations.append(SyncOperation("fetch", doc_id, remote_version))
+        elif state[0] != remote_version:
+            kind = "fetch" if state[1] == SyncStatus.Synced else "conflict"
+            operations.append(SyncOperation(kind, doc_id, remote_version))
+
+    for doc_id in sorted(remote_deleted_ids):
+        if local_states[doc_id][1] == SyncStatus.Modified:
+            operations.append(SyncOperation("conflict", doc_id))
+        else:
+            operations.append(SyncOperation("remove", doc_id))
+
+    for doc_id in sorted(set(dirty_ids).difference(remote_deleted_ids)):
+        state = local_states.get(doc_id)
+        if state is None:
+            continue
+        if state[1] == SyncStatus.Deleted:
+            operations.append(SyncOperation("delete", doc_id))
+        elif state[1] == SyncStatus.Modified:
+            operations.append(SyncOperation("update", doc_id))
+
+    for document in new_documents:
+        operations.append(SyncOperation("create", None, document=document))
+    return operations
+
+class SyncPlan(object):
+    """What a sync of the documents will do, made by DummySyncedClient.plan_sync
+       from the library listing and the local documents before anything is
+       sent. The outcome of the merges isn't known yet, e.g. a conflict can
+       drop a local change, so the requests are an estimate."""
+
+    def __init__(self, full, operations, listing_requests, high_water=None, remote_deleted_ids=()):
+        self.full = full
+        self.operations = operations
+        self.listing_requests = listing_requests
+        self.high_water = high_water
+        self.remote_deleted_ids = set(remote_deleted_ids)
+
+    def counts(self):
+        """Number of operations of each kind"""
+        counts = dict((kind, 0) for kind in SyncOperation.REQUESTS)
+        for operation in self.operations:
+            counts[operation.kind] += 1
+        return counts
+
+    def estimated_requests(self):
+        """Requests of the sync, the library listing included"""
+        return self.listing_requests + sum(SyncOperation.REQUESTS[operation.kind] for operation in self.operations)
+
+    def __repr__(self):
+        counts = ", ".join("%d %s" % (count, kind) for kind, count in sorted(self.counts().items()) if count)
+        return "<SyncPlan %s: %s, ~%d requests>" % ("full" if self.full else "incremental",
+                                                   counts or "nothing to do", self.estimated_requests())
+
+class LibraryComparison(object):
+    """Compares the pages of a library listing with the local documents of a
+       DummySyncedClient and turns them into SyncOperations with
+       plan_operations, page by page as they are listed. plan_sync and the
+       sync_pipeline.DocumentSyncPipeline of sync_documents both compare the
+       library with it, so a dry run plans what a sync does.
+
+       Unless full, the documents listed with a version below the watermark
+       are skipped and deletions on the server are only looked for when the
+       number of listed documents doesn't match the local ones. The Merkle
+       tree of the whole listing, skipped documents included, is also
+       compared with the local one updated with the documents compared, if
+       they differ a document changed below the watermark. needs_full is set
+       in both cases, the full comparison then finds what changed.
+
+       state is what a checkpoint of an interrupted sync keeps, a comparison
+       resumed from it lists the library from state["page"]."""
+
+    def __init__(self, sclient, full, state=None):
+        self.sclient = sclient
+        documents = sclient.documents
+        if state is None:
+            watermark = None if full else sclient.watermark
+            state = {"page": 0, "page_size": sclient.page_size, "full": full,
+                     "watermark": watermark, "high_water": watermark, "total_results": None,
+                     "listed_count": 0, "new_count": 0, "listed_local_count": 0}
+        self.state = dict(state)
+        self.full = state["full"]
+        self.first_page = state["page"]
+        # listed before the sync was interrupted
+        self.resumed_count = state["listed_count"]
+        # set when the library lost documents or changed below the
+        # watermark and only a full comparison finds which
+        self.needs_full = False
+        self.remote_deleted_ids = set()
+        # listed documents skipped by the watermark
+        self.skipped = 0
+        # the trees need the whole listing
+        self.verified = not self.full and self.first_page == 0
+        with sclient.lock:
+            # the new documents listed before are now local
+            self.local_count = len(documents) - state["new_count"]
+            self.dirty_ids = sclient.modified_ids | sclient.deleted_ids
+            documents.clear_listed()
+            if self.verified:
+                tree = documents.merkle()
+                # the local tree once the documents compared are fetched
+                self.expected_tree = copy.deepcopy(tree)
+                self.remote_tree = MerkleTree(tree.depth, tree.fanout)
+
+    def checkpoint(self, page_number):
+        """The state to save once every operation of the page is done"""
+        return dict(self.state, page=page_number + 1)
+
+    def compare_page(self, remote_page):
+        """The operations of a page, None if the library changed while it was
+           listed"""
+        state = self.state
+        if state["total_results"] is None:
+            state["total_results"] = remote_page["total_results"]
+        elif remote_page["total_results"] != state["total_results"]:
+            return None
+
+        watermark = state["watermark"]
+        listed_ids = []
+        compared = []
+        for remote_document_dict in remote_page["documents"]:
+            remote_id = remote_document_dict["id"]
+            remote_version = remote_document_dict.get("version")
+            listed_ids.append(remote_id)
+            if self.verified:
+                self.remote_tree.update(remote_id, None, remote_version)
+            if watermark is not None and remote_version < watermark:
+                # unchanged since before the previous sync
+                self.skipped += 1
+                continue
+            if state["high_water"] is None or remote_version > state["high_water"]:
+                state["high_water"] = remote_version
+            compared.append((remote_id, remote_version))
+        state["listed_count"] += len(listed_ids)
+
+        # the documents of a page are compared at once, with a replica they
+        # are looked up by a single query
+        dirty_ids = self.dirty_ids.intersection(listed_ids)
+        with self.sclient.lock:
+            if self.full:
+                self.sclient.documents.add_listed(listed_ids)
+            local_states = self.sclient.documents.states([remote_id for remote_id, remote_version in compared] +
+                                                         list(dirty_ids))
+        for remote_id, remote_version in compared:
+            local_state = local_states.get(remote_id)
+            if self.verified:
+                self.expected_tree.update(remote_id, local_state[0] if local_state is not None else None,
+                                          remote_version)
+            if local_state is None:
+                state["new_count"] += 1
+                continue
+            state["listed_local_count"] += 1
+            # server can't know about new documents
+            assert local_state[1] != SyncStatus.New
+        return plan_operations(compared, local_states, (), dirty_ids)
+
+    def finish(self):
+        """The operations of the documents deleted on the server and of the
+           new documents once the whole library is listed, None if the
+           library changed while it was listed"""
+        sclient = self.sclient
+        documents = sclient.documents
+        state = self.state
+        total_results = state["total_results"]
+        try:
+            if self.full:
+                # pages shift when documents are added or removed while
+                # listing, which can skip or repeat documents
+                with sclient.lock:
+                    listed_ids_count = documents.count_listed()
+                if self.resumed_count + listed_ids_count != total_results:
+                    return None
+                if state["listed_local_count"] != self.local_count and self.first_page > 0:
+                    # the ids listed before the sync was interrupted aren't
+                    # kept, list the whole library again
+                    return None
+            else:
+                if state["listed_count"] != total_results:
+                    return None
+                # the skipped documents are all known locally, unless the
+                # library lost some there is one listed document per local
+                # and new one
+                if (total_results != self.local_count + state["new_count"] or
+                    self.verified and self.expected_tree.root() != self.remote_tree.root()):
+                    self.needs_full = True
+                    return None
+
+            with sclient.lock:
+                if self.full and state["listed_local_count"] != self.local_count:
+                    # the documents added meanwhile by a sync are all listed
+                    self.remote_deleted_ids = documents.unlisted_ids()
+                local_states = documents.states(list(self.remote_deleted_ids))
+                new_documents = list(sclient.new_documents)
+            return plan_operations([], local_states, self.remote_deleted_ids, (), new_documents)
+        finally:
+            with sclient.lock:
+                documents.clear_listed()
+
+    def high_water(self):
+        return self.state["high_water"]
+
 class DummySyncedClient:
 
-    def __init__(self, config_file="config.json", conflict_resolver=SimpleConflictResolver()):
-        self.client = create_client(config_file)
+    def __init__(self, config_file="config.json", conflict_resolver=ThreeWayMergeResolver(), client=None,
+                 page_size=500, concurrency=8, replica=None, full_sync_interval=10, attachments=None):
+        # an already configured client can be given instead of a config file,
+        # e.g. one created by local_server.create_local_client
+        if client is None:
+            client = create_client(config_file)
+        self.client = client
+        # SyncedFolder by id, not kept in the replica
         self.folders = {}
-        self.documents = {}
-        self.new_documents = []
+        self.last_local_folder_id = 0
+
+        # documents are kept in memory unless a replica.DocumentReplica is given,
+        # in which case they are loaded from it when needed and every change is saved to it
+        self.replica = replica
+        if replica is not None:
+            self.documents = replica.documents()
+            self.new_documents = replica.load_new_documents()
+        else:
+            self.documents = DocumentMap()
+            self.new_documents = []
+        self.documents.tracker = self
+        for document in self.new_documents:
+            document.tracker = self
+
+        # ids of the documents in self.documents modified or deleted
+        # locally since the last sync, maintained by mark_dirty
+        self.modified_ids, self.deleted_ids = self.documents.dirty_ids()
         assert isinstance(conflict_resolver, ConflictResolver)
         self.conflict_resolver = conflict_resolver
+        # items per library page and number of requests sent in parallel
+        self.page_size = page_size
+        self.concurrency = concurrency
+        # held while changing the local documents during a sync, the
+        # stages of a DocumentSyncPipeline change them from several threads
+        self.lock = threading.RLock()
+        # documents new or changed on the server applied so far
+        self.remote_changes = 0
+        # PushResult of every local change sent by the last sync
+        self.push_results = []
+        # documents sent to create_document whose response isn't saved yet,
+        # see claim_pending_create
+        self.pending_creates = self.documents.load_meta("pending_creates", {})
+        # functions called without arguments on every local change,
+        # e.g. by sync_daemon.SyncDaemon
+        self.local_change_listeners = []
+        # functions called with a ChangeEvent for every change a sync makes
+        # to the documents, on the threads of the sync, see change_events.py
+        self.change_listeners = []
+        # set on the clients of the groups, see add_group
+        self.group_id = None
+        # attachments.AttachmentStore the files of the documents are
+        # downloaded to after every sync, None to only sync the metadata
+        self.attachments = attachments
+        # DownloadResult of every file downloaded by the last sync
+        self.download_results = []
+        # {file hash: [doc_id, file_size]} of the files attached to the
+        # documents fetched since the last downloads, or whose download
+        # failed, None until the documents are first looked through
+        self.missing_files = self.documents.load_meta("missing_files")
+
+        # library listings only compare the documents with a version at least
+        # the watermark, the whole library is still compared every
+        # full_sync_interval syncs to catch anything missed
+        self.full_sync_interval = full_sync_interval
+        self.load_sync_state()
+
+        # DummySyncedClient of each group added with add_group, the
+        # requests of all the groups share a budget of concurrency
+        # requests in flight
+        self.groups = {}
+        self.budget = threading.BoundedSemaphore(concurrency)
+
+    def sync(self, full=False, dry_run=False):
+        """full: compare every document of the library instead of only
+           those changed since the previous syncs
+           dry_run: change nothing, return the SyncPlan of the documents"""
+        if dry_run:
+            plan = self.plan_sync(full)
+            while plan is None:
+                self.record_retry()
+                plan = self.plan_sync(full)
+            return plan
 
-    def sync(self):
         success = False
         
         while True:
-            # if not self.sync_folders():
-            #     continue
-            if not self.sync_documents():
+            if not self.sync_documents(full):
+                self.record_retry()
                 continue
+            # after the documents so the documents of the folders all exist
+            self.sync_folders()
             break
+        # before the groups, which then skip the files they share with the
+        # user library
+        if self.attachments is not None:
+            self.sync_attachments()
+        self.sync_groups(full)
+
+    def record_retry(self):
+        # the library changed while it was listed, it is listed again
+        if metrics.registry.enabled:
+            metrics.registry.record_retry("library")
+
+    def load_sync_state(self):
+        state = self.documents.load_sync_state()
+        # documents listed with an older version haven't changed since
+        # before the previous sync started
+        self.watermark = state.get("watermark")
+        # highest version listed by the previous sync, watermark of the next
+        self.high_water = state.get("high_water")
+        self.syncs_since_full = state.get("syncs_since_full", 0)
+        # highest version listed by the current sync
+        self.listed_high_water = None
+
+    def save_sync_state(self, full):
+        """Called after a successful sync to move the watermarks forward
+
+           The watermark lags one sync behind the versions listed, documents
+           updated on the server while the library was listed can have a lower
+           version than others listed after them, they will still be above the
+           watermark of the next sync."""
+        self.watermark = self.high_water
+        self.high_water = self.listed_high_water
+        if full:
+            self.syncs_since_full = 0
+        else:
+            self.syncs_since_full += 1
+        self.documents.save_sync_state({"watermark": self.watermark,
+                                        "high_water": self.high_water,
+                                        "syncs_since_full": self.syncs_since_full})
+        self.documents.commit()
+
+    def full_sync_due(self):
+        return self.watermark is None or self.syncs_since_full >= self.full_sync_interval
 
     def fetch_document(self, remote_id):
         details = self.client.document_details(remote_id)
@@ -213,157 +1185,757 @@ class DummySyncedClient:
         assert details["id"] == remote_id  
         return SyncedDocument(details, SyncStatus.Synced)
 
+    def push_change(self, change):
+        """Send a ("create" | "update" | "delete", document) local change,
+           returns its PushResult"""
+        operation, local_document = change
+        if operation == "update":
+            return self.push_update(local_document)
+        if operation == "delete":
+            return self.push_delete(local_document)
+        return self.push_new_local_document(local_document)
+
+    def record_push(self, result):
+        with self.lock:
+            self.push_results.append(result)
+        return result
+
+    def push_failed(self, operation, local_document, doc_id, error):
+        # the change stays to be sent by the next sync, new documents stay
+        # in new_documents
+        with self.lock:
+            if local_document.is_modified():
+                self.modified_ids.add(doc_id)
+            elif local_document.is_deleted():
+                self.deleted_ids.add(doc_id)
+        return self.record_push(PushResult(operation, doc_id, error=error))
+
     def push_new_local_document(self, local_document):
         # create the local document on the remote
         existing_id = local_document.id()
 
         # it's a new document, or the conflict resolver decided 
         # to keep the local version so needs to be reset
-        response = self.client.create_document(document=local_document.to_json())
-        assert "error" not in response
+        sent = local_document.creation_json()
+        with self.lock:
+            # saved before sending, if the response is lost the document is
+            # found in the library instead of being created again
+            if existing_id is not None:
+                token = "id:%s" % existing_id
+            else:
+                token = "new:%s" % local_document.replica_key
+            self.pending_creates[token] = {"id": existing_id, "new": local_document.replica_key,
+                                           "document": sent}
+            self.documents.save_meta("pending_creates", self.pending_creates)
+            self.documents.commit()
+
+        response = push_request(self.client.create_document, document=sent)
+        error = push_error(response, "document_id", "version")
+        if error is not None:
+            if not isinstance(response, Exception):
+                # the server answered, nothing was created
+                with self.lock:
+                    self.pending_creates.pop(token, None)
+                    self.documents.save_meta("pending_creates", self.pending_creates)
+            return self.push_failed("create", local_document, existing_id, error)
+
+        with self.lock:
+            self.pending_creates.pop(token, None)
+            self.documents.save_meta("pending_creates", self.pending_creates)
+            was_new = local_document.is_new()
+            local_document.object.version = response["version"]
+            local_document.object.id = response["document_id"]
+            local_document.status = SyncStatus.Synced
 
-        local_document.object.version = response["version"]
-        local_document.object.id = response["document_id"]
-        local_document.status = SyncStatus.Synced
+            if existing_id is not None:
+                del self.documents[existing_id]
+            if was_new:
+                self.documents.remove_new(local_document)
+            self.add_document(local_document)
+            self.documents.commit()
+            self.emit_change("added", local_document, "local", previous_id=existing_id)
+        return self.record_push(PushResult("create", local_document.id(), local_document.version()))
+
+    def push_update(self, local_document):
+        """Send the changes of a locally modified document, only the fields
+           that really changed, nothing at all if they all match the synced values"""
+        doc_id = local_document.id()
+        with self.lock:
+            changes = local_document.diff()
+            # the synced values replaced, in case a change is set back
+            # while the request is in flight
+            replaced = local_document.object.to_dict(frozenset(changes))
+        if changes:
+            response = push_request(self.client.update_document, doc_id, document=changes)
+            error = push_error(response, "version")
+            if error is not None:
+                return self.push_failed("update", local_document, doc_id, error)
+
+        with self.lock:
+            if changes:
+                local_document.object.version = response["version"]
+            # only the changes still as sent are done, the document may have
+            # been edited again since
+            pending = local_document.changes
+            for key, value in changes.items():
+                setattr(local_document.object, key, value)
+                if key not in pending:
+                    if key in replaced:
+                        pending[key] = replaced[key]
+                elif fingerprint(pending[key]) == fingerprint(value):
+                    del pending[key]
+            if not local_document.is_deleted():
+                if pending:
+                    local_document.status = SyncStatus.Modified
+                    self.modified_ids.add(doc_id)
+                else:
+                    local_document.status = SyncStatus.Synced
+                    self.modified_ids.discard(doc_id)
+            self.documents.save(local_document)
+            self.documents.commit()
+            if changes:
+                self.emit_change("updated", local_document, "local", fields=sorted(changes))
+        return self.record_push(PushResult("update", doc_id, local_document.version()))
+
+    def push_delete(self, local_document):
+        doc_id = local_document.id()
+        response = push_request(self.client.delete_library_document, doc_id)
+        if response is not True:
+            return self.push_failed("delete", local_document, doc_id, push_error(response))
+        with self.lock:
+            del self.documents[doc_id]
+            self.documents.commit()
+            self.emit_change("deleted", local_document, "local", doc_id=doc_id)
+        return self.record_push(PushResult("delete", doc_id))
+
+    def add_document(self, document):
+        document.tracker = self
+        self.documents[document.id()] = document
+
+    def mark_dirty(self, document):
+        with self.lock:
+            if document.is_new():
+                self.documents.save_new(document)
+                self.documents.commit()
+            else:
+                doc_id = document.id()
+                if document.is_deleted():
+                    self.modified_ids.discard(doc_id)
+                    self.deleted_ids.add(doc_id)
+                elif document.is_modified():
+                    self.deleted_ids.discard(doc_id)
+                    self.modified_ids.add(doc_id)
+                else:
+                    # local changes reverted
+                    self.deleted_ids.discard(doc_id)
+                    self.modified_ids.discard(doc_id)
+                self.documents.save(document)
+                self.documents.commit()
+        self.notify_local_change()
+
+    def view_if_listened(self, document):
+        # the fields before a change, only copied if someone gets the events
+        if self.change_listeners:
+            return document_view(document)
+        return None
+
+    def emit_change(self, kind, document, source, before=None, fields=None, doc_id=None, previous_id=None):
+        """Send a ChangeEvent to the change_listeners, the changed fields
+           are those of document differing from before if given"""
+        if not self.change_listeners:
+            return
+        if before is not None:
+            fields = changed_fields(before, document_view(document))
+        event = ChangeEvent(kind, doc_id if doc_id is not None else document.id(), source,
+                            document.version(), fields, previous_id, self.group_id)
+        for listener in self.change_listeners:
+            listener(event)
 
-        if existing_id is not None:
-            del self.documents[existing_id]
-        self.documents[local_document.id()] = local_document
-        return local_document.id()
+    def notify_local_change(self):
+        for listener in self.local_change_listeners:
+            listener()
+
+    def count_remote_changes(self):
+        """Documents changed on the server applied so far, groups included"""
+        return self.remote_changes + sum(group.count_remote_changes() for group in self.groups.values())
 
     def add_new_local_document(self, document_details):
         document = SyncedDocument(document_details)
-        self.new_documents.append(document)
+        document.tracker = self
+        with self.lock:
+            self.new_documents.append(document)
+            self.documents.save_new(document)
+            self.documents.commit()
+        self.notify_local_change()
         return document
 
-    def sync_documents(self):
-        # TODO fetch the whole library with paging
-        # validate folders before storing, restart sync if unknown folder
-
-        remote_documents = self.client.library()
-        assert "error" not in remote_documents
-        remote_ids = []
-
-        def sync_remote_changes():
+    def fetch_library_pages(self, first=0):
+        """Yield the pages of the library in order from the page first, with
+           up to self.concurrency pages being fetched at once"""
+        first_page = self.client.library(page=first, items=self.page_size)
+        assert "error" not in first_page
+        yield first_page
+
+        fetch_page = lambda page: self.client.library(page=page, items=self.page_size)
+        for page in bounded_imap(fetch_page, xrange(first + 1, first_page["total_pages"]), self.concurrency):
+            assert "error" not in page
+            yield page
+
+    def apply_remote_document(self, remote_document, conflicts=None):
+        """Merge a document fetched because it is new or has a different
+           version on the server into the local documents
+
+           Documents modified on both sides are appended to conflicts to be
+           resolved later by resolve_conflicts if a list is given"""
+        self.remote_changes += 1
+        self.add_missing_files(remote_document)
+        remote_id = remote_document.id()
+        if remote_id not in self.documents:
+            pending = self.claim_pending_create(remote_document)
+            if pending is not None:
+                self.adopt_created_document(pending[0], pending[1], remote_document)
+                return
+            # new document
+            self.add_document(remote_document)
+            self.emit_change("added", remote_document, "remote")
+            return
 
-            for remote_document_dict in remote_documents["documents"]:
-                remote_id = remote_document_dict["id"]
-                remote_document = SyncedDocument(remote_document_dict, SyncStatus.Synced)
-                remote_ids.append(remote_id)
-                if remote_id not in self.documents:
-                    # new document
-                    self.documents[remote_id] = self.fetch_document(remote_id)
-                    assert self.documents[remote_id].object.id == remote_id
-                    continue
+        local_document = self.documents[remote_id]
+
+        if local_document.is_deleted():
+            keep_remote = self.conflict_resolver.resolve_local_delete_remote_update(local_document, remote_document)
+            if keep_remote:
+                before = self.view_if_listened(local_document)
+                local_document.reset(remote_document, SyncStatus.Synced)
+                self.documents.save(local_document)
+                self.emit_change("conflict_resolved", local_document, "remote", before)
+            else:
+                # will be deleted later
+                pass
+            return
 
-                local_document = self.documents[remote_id]
-
-                # server can't know about new documents
-                assert not local_document.is_new()
-
-                # if remote version is more recent
-                if local_document.version() != remote_document.version():
-                    remote_document = self.fetch_document(remote_id)
-                    if local_document.is_deleted():
-                        keep_remote = self.conflict_resolver.resolve_local_delete_remote_update(local_document, remote_document)
-                        if keep_remote:
-                            self.documents[remote_id].reset(remote_document, SyncStatus.Synced)
-                        else:
-                            # will be deleted later
-                            pass
-                        continue
-
-                    if local_document.is_synced():
-                        # update from remote
-                        local_document.reset(remote_document, SyncStatus.Synced)
-                        continue
-
-                    if local_document.is_modified():
-                        # both documents are modified, resolve the conflict
-                        # by handling the remote changes required and leave the local 
-                        # changes to be synced later
-                        self.conflict_resolver.resolve_both_updated(local_document, remote_document)
-                        assert isinstance(local_document, SyncedDocument)
-                        assert isinstance(remote_document, SyncedDocument)
-                        assert local_document.version() == remote_document.version()
-                        continue
-
-                    # all cases should have been handled
-                    assert False
-
-                # both have the same version, so only local changes possible
-                else:
-                    if local_document.is_synced():
-                        # nothing to do
-                        # assert remote_document == local_document
-                        continue
-
-                    if local_document.is_deleted():
-                        # nothing to do, will be deleted
-                        continue
-
-                    if local_document.is_modified():
-                        # nothing to do, changes will be sent in the update loop
-                        continue
-
-                    # all cases should have been handled
-                    assert False
-    
-        def sync_local_changes():
-            # deal with local changes or remote deletion
-            for doc_id in self.documents.keys():
-                local_document = self.documents[doc_id]
-                assert local_document.id() == doc_id
-
-                # new documents are handled later
-                assert not local_document.is_new()
-
-                if doc_id not in remote_ids:
-                    # was deleted on the server         
-                    if local_document.is_modified():
-                        recreate_local = self.conflict_resolver.resolve_local_update_remote_delete(local_document)
-                        if recreate_local:
-                            remote_ids.append(self.push_new_local_document(local_document))
-                            continue
-                    del self.documents[doc_id]
-                    continue   
-
-                if local_document.is_synced():
-                    continue                 
-
-                if local_document.is_deleted():
-                    assert self.client.delete_library_document(doc_id)
-                    del self.documents[doc_id]
-                    continue
+        if local_document.is_synced():
+            # update from remote
+            before = self.view_if_listened(local_document)
+            local_document.reset(remote_document, SyncStatus.Synced)
+            self.documents.save(local_document)
+            self.emit_change("updated", local_document, "remote", before)
+            return
 
-                if local_document.is_modified():
-                    response = self.client.update_document(doc_id, document=local_document.changes)
-                    assert "error" not in response
-                    local_document.status = SyncStatus.Synced
-                    local_document.object.version = response["version"]
-                    local_document.apply_changes()
-                    continue
+        if local_document.is_modified():
+            if conflicts is not None:
+                conflicts.append((local_document, remote_document))
+            else:
+                self.resolve_conflicts([(local_document, remote_document)])
+            return
 
-                assert False
+        # all cases should have been handled
+        assert False
+
+    def apply_remote_delete(self, doc_id):
+        """Remove a local document deleted on the server, unless it's modified
+           locally and the conflict resolver keeps it, then returns the
+           ("create", document) change recreating it"""
+        self.modified_ids.discard(doc_id)
+        self.deleted_ids.discard(doc_id)
+        local_document = self.documents[doc_id]
+        if local_document.is_modified():
+            if self.conflict_resolver.resolve_local_update_remote_delete(local_document):
+                return ("create", local_document)
+        del self.documents[doc_id]
+        self.emit_change("deleted", local_document, "remote", doc_id=doc_id)
+        return None
+
+    def claim_pending_create(self, remote_document):
+        """(local document, fields sent) of the create_document call that
+           created remote_document, if it was sent by this client and the
+           sync stopped before its response was saved, else None
+
+           The api has no idempotency key, the document is recognized by the
+           fields sent all having the same value on the server, the fields the
+           server sets aside. A document with the same fields created by
+           someone else while the response was lost is taken for it too."""
+        for token, entry in self.pending_creates.items():
+            sent = entry["document"]
+            if sent and all(key in remote_document.object and
+                            fingerprint(getattr(remote_document.object, key)) == fingerprint(value)
+                            for key, value in sent.items() if key not in SyncedDocument.server_fields):
+                break
+        else:
+            return None
 
-        def send_new_documents():
-            # create new local documents on the server
+        del self.pending_creates[token]
+        self.documents.save_meta("pending_creates", self.pending_creates)
+        if entry["id"] is not None:
+            local_document = self.documents.get(entry["id"])
+        else:
+            local_document = None
             for new_document in self.new_documents:
-                assert new_document.is_new()
-                doc_id = self.push_new_local_document(new_document)
-                assert doc_id > 0
-            self.new_documents = []
+                if new_document.is_new() and new_document.replica_key == entry["new"]:
+                    local_document = new_document
+        if local_document is None:
+            return None
+        return local_document, sent
 
-            
-        sync_remote_changes()
-        sync_local_changes()
-        send_new_documents()
+    def adopt_created_document(self, local_document, sent, remote_document):
+        """Make a local document the one created from it on the server"""
+        existing_id = local_document.id()
+        current = local_document.creation_json()
+        if local_document.is_new():
+            self.documents.remove_new(local_document)
+            self.new_documents.remove(local_document)
+        elif existing_id is not None:
+            self.modified_ids.discard(existing_id)
+            self.deleted_ids.discard(existing_id)
+            del self.documents[existing_id]
+        local_document.reset(remote_document, SyncStatus.Synced)
+        self.add_document(local_document)
+        self.emit_change("added", local_document, "local", previous_id=existing_id)
+        # edited again after it was sent
+        local_document.update(dict((key, value) for key, value in current.items()
+                                   if key not in sent or fingerprint(sent[key]) != fingerprint(value)))
+
+    def resolve_conflicts(self, conflicts):
+        """Resolve the (local document, remote document) pairs of documents
+           modified on both sides, the remote documents are already fetched"""
+        for local_document, remote_document in conflicts:
+            # both documents are modified, resolve the conflict
+            # by handling the remote changes required and leave the local 
+            # changes to be synced later
+            before = self.view_if_listened(local_document)
+            self.conflict_resolver.resolve_both_updated(local_document, remote_document)
+            assert isinstance(local_document, SyncedDocument)
+            assert isinstance(remote_document, SyncedDocument)
+            assert local_document.version() == remote_document.version()
+            self.documents.save(local_document)
+            self.emit_change("conflict_resolved", local_document, "remote", before)
+
+    def sync_documents(self, full=False):
+        # TODO validate folders before storing, restart sync if unknown folder
+
+        full = full or self.full_sync_due()
+        self.push_results = []
+        try:
+            pipeline = DocumentSyncPipeline(self, self.compare_library(full))
+            # resumes an interrupted sync in its own mode
+            full = pipeline.comparison.full
+            if not pipeline.run():
+                return False
+        except Exception:
+            # changes taken to be sent and not sent are still in the documents
+            with self.lock:
+                self.modified_ids, self.deleted_ids = self.documents.dirty_ids()
+            raise
+        self.save_sync_state(full)
 
         return True
 
+    def compare_library(self, full, resume=True):
+        """The LibraryComparison of the next sync, resuming the interrupted
+           one if resume and a checkpoint was saved"""
+        checkpoint = self.documents.load_meta("checkpoint") if resume else None
+        if checkpoint is not None and checkpoint["page_size"] != self.page_size:
+            checkpoint = None
+        return LibraryComparison(self, full, checkpoint)
+
+    def plan_sync(self, full=False, resume=True):
+        """List the library and return the SyncPlan of the documents without
+           changing anything, the dry run of sync_documents, see
+           LibraryComparison
+
+           Returns None if the library changed while it was listed"""
+        comparison = self.compare_library(full or self.full_sync_due(), resume)
+        listing_requests = 0
+        operations = []
+        for remote_page in self.fetch_library_pages(comparison.first_page):
+            listing_requests += 1
+            page_operations = comparison.compare_page(remote_page)
+            if page_operations is None:
+                # the library changed while it was listed, start again
+                return None
+            operations.extend(page_operations)
+
+        last_operations = comparison.finish()
+        if last_operations is None:
+            if comparison.needs_full:
+                return self.plan_sync(True, False)
+            return None
+        operations.extend(last_operations)
+        return SyncPlan(comparison.full, operations, listing_requests, comparison.high_water(),
+                        comparison.remote_deleted_ids)
+
+    def library_fingerprint(self):
+        """Root hash of the Merkle tree of the (id, version) pairs of the
+           documents, equal for libraries with the same synced documents"""
+        return self.documents.merkle().root()
+
+    def execute_plan(self, plan):
+        """Run the operations of a plan_sync plan, the documents are fetched
+           and the local changes sent concurrently. Returns the PushResults
+           of the changes sent."""
+        self.apply_remote_operations(plan.operations)
+        self.listed_high_water = plan.high_water
+        results = self.push_operations(plan.operations) + self.send_new_documents()
+        with self.lock:
+            # as after a sync, the next one starts over from the watermark
+            self.documents.save_meta("checkpoint", None)
+        self.save_sync_state(plan.full)
+        return results
+
+    def apply_remote_operations(self, operations):
+        """Fetch the documents of the fetch and conflict operations and merge
+           them into the local documents"""
+        # fetched in parallel, they are applied in library order and the
+        # conflicts resolved once they all arrived
+        fetched_ids = [operation.doc_id for operation in operations if operation.fetches()]
+        conflicts = []
+        for i, remote_document in enumerate(bounded_imap(self.fetch_document, fetched_ids, self.concurrency)):
+            self.apply_remote_document(remote_document, conflicts)
+            if i % self.page_size == self.page_size - 1:
+                # not fetched again if the sync is interrupted
+                self.documents.commit()
+        self.resolve_conflicts(conflicts)
+        self.documents.commit()
+
+    def push_operations(self, operations):
+        """Handle the documents deleted on the server and send the local
+           updates and deletions of operations concurrently, returns their
+           PushResults. The documents are looked at again as merges since
+           the plan was made can have changed them."""
+        changes = []
+        for operation in operations:
+            if operation.kind not in ("remove", "conflict") or operation.remote_version is not None:
+                continue
+            with self.lock:
+                change = self.apply_remote_delete(operation.doc_id)
+            if change is not None:
+                changes.append(change)
+        self.documents.commit()
+
+        for operation in operations:
+            if operation.kind in ("update", "delete"):
+                change = self.take_local_change(operation.doc_id)
+                if change is not None:
+                    changes.append(change)
+
+        return list(bounded_imap(self.push_change, changes, self.concurrency))
+
+    def take_local_change(self, doc_id):
+        """The ("update" | "delete", document) change of a document planned
+           to be sent, None if a merge since dropped it or it was taken
+           already. The document isn't dirty anymore, a failed push marks it
+           again."""
+        with self.lock:
+            if doc_id not in self.modified_ids and doc_id not in self.deleted_ids:
+                return None
+            self.deleted_ids.discard(doc_id)
+            self.modified_ids.discard(doc_id)
+            local_document = self.documents.get(doc_id)
+        if local_document is None or local_document.is_synced():
+            # the conflict resolution dropped the local changes
+            return None
+        assert local_document.id() == doc_id
+        if local_document.is_deleted():
+            return ("delete", local_document)
+        assert local_document.is_modified()
+        return ("update", local_document)
+
+    def sync_remote_changes(self, full=True):
+        """Apply the changes made on the server to the local documents
+
+           Returns the set of ids of the local documents deleted on the server,
+           or None if the library changed while it was listed"""
+        plan = self.plan_sync(full)
+        if plan is None:
+            return None
+        self.apply_remote_operations(plan.operations)
+        self.listed_high_water = plan.high_water
+        return plan.remote_deleted_ids
+
+    def sync_local_changes(self, remote_deleted_ids):
+        """Send the local updates and deletions and handle the documents
+           deleted on the server, only the documents marked dirty are looked at
+
+           The changes are sent concurrently, returns their PushResults"""
+        with self.lock:
+            dirty_ids = self.deleted_ids | self.modified_ids
+        local_states = self.documents.states(list(remote_deleted_ids | dirty_ids))
+        operations = plan_operations([], local_states, remote_deleted_ids, dirty_ids)
+        return self.push_operations(operations)
+
+    def send_new_documents(self):
+        """Create the new local documents on the server concurrently,
+           returns their PushResults"""
+        changes = [("create", new_document) for new_document in self.new_documents]
+        results = list(bounded_imap(self.push_change, changes, self.concurrency))
+        # the failed ones are sent again by the next sync
+        self.new_documents = [new_document for new_document in self.new_documents if new_document.is_new()]
+        return results
+
+    # Folders #
+
+    def add_new_local_folder(self, name, parent=None):
+        """Create a folder in the folder with the id parent or at the top
+           level, the parent can be a new folder too"""
+        assert parent is None or parent in self.folders
+        self.last_local_folder_id -= 1
+        folder = SyncedFolder({"id": self.last_local_folder_id, "name": name}, SyncStatus.New)
+        folder.tracker = self
+        if parent is not None:
+            folder.object.parent = parent
+        self.folders[folder.id()] = folder
+        self.notify_local_change()
+        return folder
+
+    def fetch_folder_document_ids(self, folder_id):
+        first_page = self.client.folder_documents(folder_id, page=0, items=self.page_size)
+        assert "error" not in first_page
+        document_ids = set(first_page["document_ids"])
+        for page in xrange(1, first_page["total_pages"]):
+            response = self.client.folder_documents(folder_id, page=page, items=self.page_size)
+            assert "error" not in response
+            document_ids.update(response["document_ids"])
+        return document_ids
+
+    def sync_folders(self):
+        """Diff the local and remote folder trees and the documents of each
+           folder against the last sync, and send the local changes"""
+        remote_folders = self.client.folders()
+        assert isinstance(remote_folders, list)
+        remote_folders = dict((folder["id"], folder) for folder in remote_folders)
+        parents = dict((folder_id, folder.get("parent")) for folder_id, folder in remote_folders.items())
+
+        # deleting a folder on the server deletes its subfolders,
+        # only the topmost ones need to be deleted
+        deleted_ids = set(folder_id for folder_id, folder in self.folders.items() if folder.is_deleted())
+        topmost_ids = [folder_id for folder_id in deleted_ids if folder_id in remote_folders and
+                       not deleted_ids.intersection(folder_ancestors(folder_id, parents))]
+        delete = lambda folder_id: push_request(self.client.delete_folder, folder_id)
+        for folder_id, response in zip(topmost_ids, bounded_imap(delete, topmost_ids, self.concurrency)):
+            if response is not True:
+                # stays deleted locally to be sent again by the next sync,
+                # with the folders inside it
+                deleted_ids.discard(folder_id)
+        for folder_id in remote_folders.keys():
+            if folder_id in deleted_ids or deleted_ids.intersection(folder_ancestors(folder_id, parents)):
+                del remote_folders[folder_id]
+
+        # folders deleted on either side, and new local folders inside them
+        for folder_id, folder in self.folders.items():
+            if folder_id not in remote_folders and not folder.is_new():
+                del self.folders[folder_id]
+        orphans = True
+        while orphans:
+            orphans = [folder_id for folder_id, folder in self.folders.items()
+                       if folder.parent() is not None and folder.parent() not in self.folders and
+                       folder.parent() not in remote_folders]
+            for folder_id in orphans:
+                del self.folders[folder_id]
+
+        # folders created, renamed or moved on the server
+        for folder_id, remote_folder in remote_folders.items():
+            fields = {"id": folder_id, "name": remote_folder["name"]}
+            if remote_folder.get("parent") is not None:
+                fields["parent"] = remote_folder["parent"]
+            local_folder = self.folders.get(folder_id)
+            if local_folder is None:
+                local_folder = self.folders[folder_id] = SyncedFolder(fields, SyncStatus.Synced)
+                local_folder.tracker = self
+            elif not local_folder.is_deleted():
+                local_folder.reset(fields, SyncStatus.Synced)
+
+        created_ids = self.send_new_folders()
+        self.sync_folder_documents(remote_folders, created_ids)
+
+    def send_new_folders(self):
+        """Create the new local folders on the server, parents before their
+           children and the folders of a level in parallel, returns their ids"""
+        created_ids = set()
+        # those inside a folder whose deletion failed wait for it to be deleted
+        new_folders = [folder for folder in self.folders.values()
+                       if folder.is_new() and not self.in_deleted_folder(folder)]
+        while new_folders:
+            ready = [folder for folder in new_folders
+                     if folder.parent() is None or not self.folders[folder.parent()].is_new()]
+            assert ready
+            create = lambda folder: self.client.create_folder(folder=folder.to_json())
+            for folder, response in zip(ready, bounded_imap(create, ready, self.concurrency)):
+                assert "error" not in response
+                local_id = folder.id()
+                del self.folders[local_id]
+                folder.object.id = response["folder_id"]
+                folder.status = SyncStatus.Synced
+                self.folders[folder.id()] = folder
+                created_ids.add(folder.id())
+                for child in new_folders:
+                    if child.parent() == local_id:
+                        child.object.parent = folder.id()
+            new_folders = [folder for folder in new_folders if folder.is_new()]
+        return created_ids
+
+    def in_deleted_folder(self, folder):
+        parent = folder.parent()
+        while parent is not None and parent in self.folders:
+            if self.folders[parent].is_deleted():
+                return True
+            parent = self.folders[parent].parent()
+        return False
+
+    def sync_folder_documents(self, remote_folders, created_ids):
+        """Three-way merge of the documents of each folder, the documents
+           added or removed on the server and locally since the last sync are
+           applied to both sides"""
+        # no need to list empty or just created folders
+        # nor the folders still to be deleted or created
+        synced = dict((folder_id, folder) for folder_id, folder in self.folders.items()
+                      if folder.is_synced())
+        listed = [folder for folder_id, folder in synced.items()
+                  if folder_id not in created_ids and remote_folders[folder_id].get("size") != 0]
+        remote_ids = dict((folder_id, set()) for folder_id in synced)
+        fetched = bounded_imap(self.fetch_folder_document_ids, [folder.id() for folder in listed], self.concurrency)
+        for folder, document_ids in zip(listed, fetched):
+            remote_ids[folder.id()] = document_ids
+
+        operations = []
+        for folder_id, folder in synced.items():
+            added = set(doc_id for doc_id in folder.document_ids - folder.synced_document_ids
+                        if doc_id in self.documents)
+            removed = folder.synced_document_ids - folder.document_ids
+            operations.extend(("add", folder_id, doc_id) for doc_id in added - remote_ids[folder_id])
+            operations.extend(("remove", folder_id, doc_id) for doc_id in removed & remote_ids[folder_id])
+            folder.document_ids = (remote_ids[folder_id] | added) - removed
+            folder.synced_document_ids = set(folder.document_ids)
+
+        for (action, folder_id, doc_id), done in zip(operations, bounded_imap(self.send_folder_operation, operations,
+                                                                              self.concurrency)):
+            if not done and action == "add":
+                # the document was deleted on the server in the meantime
+                self.folders[folder_id].document_ids.discard(doc_id)
+                self.folders[folder_id].synced_document_ids.discard(doc_id)
+
+    def send_folder_operation(self, operation):
+        action, folder_id, doc_id = operation
+        if action == "add":
+            response = self.client.add_document_to_folder(folder_id, doc_id)
+            return isinstance(response, dict) and "error" not in response
+        return self.client.delete_document_from_folder(folder_id, doc_id)
+
+    # Groups #
+
+    def add_group(self, group_id):
+        """Sync the library of a group too, its documents and folders are in
+           self.groups[group_id] and kept in their own replica partition"""
+        if group_id in self.groups:
+            return self.groups[group_id]
+        replica = None
+        if self.replica is not None:
+            replica = self.replica.partition("group_%s" % group_id)
+        group = DummySyncedClient(client=Budgeted(GroupApi(self.client, group_id), self.budget),
+                                  conflict_resolver=self.conflict_resolver, page_size=self.page_size,
+                                  concurrency=self.concurrency, replica=replica,
+                                  full_sync_interval=self.full_sync_interval, attachments=self.attachments)
+        # the events of the groups go to the listeners of the user library
+        group.group_id = group_id
+        group.change_listeners = self.change_listeners
+        self.groups[group_id] = group
+        return group
+
+    def add_all_groups(self):
+        """add_group for every group of the user"""
+        groups = self.client.groups()
+        assert isinstance(groups, list)
+        for group in groups:
+            self.add_group(group["id"])
+
+    def sync_groups(self, full=False):
+        """Sync the groups added with add_group in parallel, concurrency of
+           them at a time as their requests share the budget anyway"""
+        sync_group = lambda group: group.sync(full)
+        workers = min(self.concurrency, len(self.groups))
+        for synced in bounded_imap(sync_group, self.groups.values(), workers):
+            pass
+
+    def add_missing_files(self, remote_document):
+        # must be called with the lock held, the files of a document fetched
+        # from the server not in the store are downloaded after the sync
+        if self.attachments is None or self.missing_files is None or "files" not in remote_document.object:
+            return
+        added = False
+        for attached in remote_document.object.files or ():
+            file_hash = attached["file_hash"]
+            if file_hash not in self.missing_files and file_hash not in self.attachments:
+                self.missing_files[file_hash] = [remote_document.id(), attached.get("file_size")]
+                added = True
+        if added:
+            self.documents.save_meta("missing_files", self.missing_files)
+
+    def attached_files(self):
+        """(doc_id, file_hash, file_size) of the files attached to the
+           documents, file_size being None if unknown
+
+           Every document is looked through once, after that only the files
+           of the documents fetched since are, see add_missing_files"""
+        with self.lock:
+            if self.missing_files is not None:
+                missing = sorted(self.missing_files.items())
+                states = self.documents.states(list(set(doc_id for file_hash, (doc_id, size) in missing)))
+                return [(doc_id, file_hash, size) for file_hash, (doc_id, size) in missing
+                        if doc_id in states and states[doc_id][1] != SyncStatus.Deleted]
+
+        attached_files = []
+        for doc_id, document in self.documents.items():
+            if document.is_deleted() or "files" not in document.object:
+                continue
+            for attached in document.object.files or ():
+                attached_files.append((doc_id, attached["file_hash"], attached.get("file_size")))
+        return attached_files
+
+    def sync_attachments(self):
+        """Download the files of the documents missing from self.attachments,
+           concurrency at a time. A file that failed stays missing and is
+           downloaded by the next sync."""
+        missing = {}
+        for doc_id, file_hash, size in self.attached_files():
+            if file_hash not in self.attachments and file_hash not in missing:
+                missing[file_hash] = DownloadResult(file_hash, doc_id, size)
+        missing = sorted(missing.values(), key=lambda result: result.file_hash)
+        self.download_results = list(bounded_imap(self.download_attachment, missing, self.concurrency))
+        with self.lock:
+            self.missing_files = dict((result.file_hash, [result.doc_id, result.size])
+                                      for result in self.download_results if not result.succeeded())
+            self.documents.save_meta("missing_files", self.missing_files)
+            self.documents.commit()
+        return self.download_results
+
+    def download_attachment(self, result):
+        if not valid_file_hash(result.file_hash):
+            # never downloaded, the store has no place for it
+            result.error = "invalid file hash"
+            return result
+        # the size listed with the document reserves the bandwidth before
+        # the download, the size downloaded after it otherwise
+        if result.size is not None:
+            self.attachments.throttle(result.size)
+        response = push_request(self.client.download_file, result.doc_id, result.file_hash)
+        result.error = push_error(response, "data")
+        if result.error is None:
+            data = response["data"]
+            if result.size is None:
+                self.attachments.throttle(len(data))
+            result.size = len(data)
+            error = push_request(self.attachments.add, result.file_hash, chunked(data))
+            if error is not None:
+                result.error = push_error(error)
+        return result
+
     def reset(self):
-        self.documents = {}
+        self.documents.clear()
         self.folders = {}
+        self.modified_ids = set()
+        self.deleted_ids = set()
+        self.pending_creates = {}
+        self.missing_files = None
+        self.load_sync_state()
 
     def dump_status(self,outf):
         outf.write( "\n")
@@ -0,0 +1,221 @@
+"""
+Request phase tracing for the Mendeley Open API client
+
+Each api call is recorded as a tree of spans: the call itself, url building,
+queueing (when calls are dispatched from a worker pool), connection
+acquisition, sending up to the first response byte, reading the body and
+decoding it. Every span carries the name of the api method from
+apidefinitions.
+
+Spans are delivered to hooks (see TraceHook). ChromeTraceWriter collects them
+in the Chrome trace event format, which can be loaded in chrome://tracing,
+Perfetto or speedscope:
+
+    import tracing
+    with tracing.trace_to_file("sync.trace.json"):
+        sclient.sync()
+
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+class Span(object):
+
+    def __init__(self, name, start, args, parent=None):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.args = args
+        self.parent = parent
+        self.thread_id = threading.current_thread().ident
+
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def method(self):
+        return self.args.get("method")
+
+class TraceHook(object):
+    """Base class of the objects receiving spans from a Tracer"""
+
+    def span_started(self, span):
+        pass
+
+    def span_finished(self, span):
+        pass
+
+class _NullSpan(object):
+    """Returned by Tracer.span when tracing is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _ActiveSpan(object):
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.span = None
+
+    def __enter__(self):
+        self.span = self.tracer._start(self.name, self.args)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.span.args["error"] = exc_type.__name__
+        self.tracer._finish(self.span)
+        return False
+
+class Tracer(object):
+    """Creates spans and hands them to the registered hooks
+
+       Spans opened on a thread while another span is open on the same
+       thread become its children and inherit its method name."""
+
+    def __init__(self):
+        self.enabled = False
+        self.hooks = []
+        self._local = threading.local()
+
+    def add_hook(self, hook):
+        assert isinstance(hook, TraceHook)
+        self.hooks.append(hook)
+        self.enabled = True
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+        self.enabled = len(self.hooks) > 0
+
+    def span(self, name, **args):
+        """Context manager recording the enclosed block as a span"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _ActiveSpan(self, name, args)
+
+    def add_span(self, name, start, duration, **args):
+        """Record a span measured by the caller, e.g. the time a call
+           spent waiting in a queue"""
+        if not self.enabled:
+            return
+        span = Span(name, start, self._inherit(args), self._current())
+        span.end = start + duration
+        for hook in self.hooks:
+            hook.span_started(span)
+        for hook in self.hooks:
+            hook.span_finished(span)
+
+    def queued(self, submitted):
+        """Called on a worker thread picking up a call submitted at
+           submitted, None once it's done. The time spent in the queue is
+           recorded by the next api call of the thread, see add_queue_span,
+           so the span carries its method name."""
+        if submitted is None:
+            self._local.queued = None
+        else:
+            self._local.queued = (submitted, time.time())
+
+    def add_queue_span(self):
+        """Record the queue span of the call picked up by this thread, once"""
+        queued = getattr(self._local, "queued", None)
+        if queued is None:
+            return
+        self._local.queued = None
+        submitted, picked = queued
+        self.add_span("queue", submitted, picked - submitted)
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _current(self):
+        stack = self._stack()
+        if stack:
+            return stack[-1]
+        return None
+
+    def _inherit(self, args):
+        parent = self._current()
+        if parent is not None and "method" not in args and parent.method() is not None:
+            args["method"] = parent.method()
+        return args
+
+    def _start(self, name, args):
+        span = Span(name, time.time(), self._inherit(args), self._current())
+        self._stack().append(span)
+        for hook in self.hooks:
+            hook.span_started(span)
+        return span
+
+    def _finish(self, span):
+        span.end = time.time()
+        stack = self._stack()
+        assert stack[-1] is span
+        stack.pop()
+        for hook in self.hooks:
+            hook.span_finished(span)
+
+class ChromeTraceWriter(TraceHook):
+    """Collect spans as Chrome trace "complete" events"""
+
+    def __init__(self, filename=None, process_name="mendeley client"):
+        self.filename = filename
+        self.process_name = process_name
+        self.events = []
+        self._lock = threading.Lock()
+
+    def span_finished(self, span):
+        event = {"name": span.name,
+                 "cat": span.method() or "client",
+                 "ph": "X",
+                 # chrome traces use microseconds
+                 "ts": int(span.start * 1000000),
+                 "dur": int(span.duration() * 1000000),
+                 "pid": os.getpid(),
+                 "tid": span.thread_id,
+                 "args": span.args}
+        with self._lock:
+            self.events.append(event)
+
+    def to_json(self):
+        with self._lock:
+            events = list(self.events)
+        metadata = {"name": "process_name", "ph": "M", "pid": os.getpid(),
+                    "args": {"name": self.process_name}}
+        return {"traceEvents": [metadata] + events, "displayTimeUnit": "ms"}
+
+    def write(self, filename=None):
+        filename = filename or self.filename
+        if not filename:
+            raise Exception("Need to specify a filename for this trace")
+        with open(filename, "w") as outf:
+            json.dump(self.to_json(), outf)
+
+@contextmanager
+def trace_to_file(filename, target=None):
+    """Trace the enclosed block and write it to filename as a Chrome trace"""
+    target = target or tracer
+    writer = ChromeTraceWriter(filename)
+    target.add_hook(writer)
+    try:
+        yield writer
+    finally:
+        target.remove_hook(writer)
+        writer.write()
+
+# process wide tracer used by MendeleyRemoteMethod and OAuthClient
+tracer = Tracer()
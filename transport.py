@@ -0,0 +1,176 @@
+"""
+Transports used by OAuthClient to send its requests
+
+HttpTransport sends them over the network with requests. RecordingTransport
+wraps another transport and saves every request/response pair to a cassette
+file, ReplayTransport answers from a cassette without any network access, with
+optional simulated latency and bandwidth. Replaying a recorded sync() lets
+optimizations be compared on identical inputs:
+
+    recorder = RecordingTransport("sync.cassette")
+    client = MendeleyClient(client_id, client_secret, {"transport": recorder})
+    ...
+    recorder.close()
+
+    replay = ReplayTransport("sync.cassette", latency=0.05, bandwidth=1024*1024)
+    client = MendeleyClient(client_id, client_secret, {"transport": replay})
+
+Cassettes are gzipped json lines, one request/response pair per line.
+Requests are matched on their http method, url and the sha1 of their body.
+Identical requests are answered in the order they were recorded, the last
+answer is repeated once they are exhausted.
+
+"""
+
+import base64
+import datetime
+import gzip
+import hashlib
+import json
+import threading
+import time
+import urllib
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+class ReplayMissError(Exception):
+    """The cassette has no response for a request"""
+    pass
+
+def body_hash(body):
+    if body is None:
+        body = ""
+    elif isinstance(body, dict):
+        # form posts, the order of the parameters doesn't matter
+        body = urllib.urlencode(sorted(body.items()))
+    elif isinstance(body, unicode):
+        body = body.encode("utf-8")
+    return hashlib.sha1(body).hexdigest()
+
+def request_key(method, url, body):
+    return (method, url, body_hash(body))
+
+class HttpTransport(object):
+    """Send requests over the network through a rauth session"""
+
+    def send(self, session, method, url, body=None, extra_headers=None):
+        # common arguments for the requests call
+        # disables automatic redirections following as requests
+        # to use resolve_http_redirect(..) in mendeley_client
+        requests_args = {"allow_redirects":False}
+
+        if method == 'GET':
+            return session.get(url, **requests_args)
+
+        if method == 'POST':
+            return session.post(url, data=body, headers={"Content-type": "application/x-www-form-urlencoded"},**requests_args )
+
+        elif method == 'DELETE':
+            return session.delete(url, **requests_args)
+
+        elif method == 'PUT':
+            return session.put(url, data=body, headers=extra_headers, **requests_args)
+
+        assert False
+
+class RecordingTransport(object):
+    """Send requests with another transport and append them with their
+       responses to a cassette file"""
+
+    def __init__(self, filename, transport=None):
+        self.filename = filename
+        self.transport = transport or HttpTransport()
+        self.cassette = gzip.open(filename, "wb")
+        self._lock = threading.Lock()
+
+    def send(self, session, method, url, body=None, extra_headers=None):
+        response = self.transport.send(session, method, url, body, extra_headers)
+        entry = {"method": method,
+                 "url": url,
+                 "body_sha1": body_hash(body),
+                 "status": response.status_code,
+                 "headers": dict(response.headers),
+                 "elapsed": response.elapsed.total_seconds()}
+        content = response.content
+        try:
+            entry["content"] = content.decode("utf-8")
+        except UnicodeDecodeError:
+            entry["content_base64"] = base64.b64encode(content)
+
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            self.cassette.write(line)
+        return response
+
+    def close(self):
+        with self._lock:
+            self.cassette.close()
+
+class ReplayTransport(object):
+    """Answer requests from a cassette recorded by RecordingTransport
+
+       latency: seconds to wait before answering, None to wait as long as the
+       recorded time to first byte, 0 to answer immediately
+       bandwidth: bytes per second used to delay the responses by their size,
+       None for no limit"""
+
+    def __init__(self, filename, latency=0, bandwidth=None):
+        self.filename = filename
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.entries = {}
+        self.positions = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        cassette = gzip.open(self.filename, "rb")
+        try:
+            for line in cassette:
+                entry = json.loads(line)
+                key = (entry["method"], entry["url"], entry["body_sha1"])
+                self.entries.setdefault(key, []).append(entry)
+        finally:
+            cassette.close()
+
+    def next_entry(self, method, url, body):
+        key = request_key(method, url, body)
+        with self._lock:
+            entries = self.entries.get(key)
+            if not entries:
+                raise ReplayMissError("No recorded response for %s %s" % (method, url))
+            position = self.positions.get(key, 0)
+            self.positions[key] = position + 1
+            return entries[min(position, len(entries) - 1)]
+
+    def send(self, session, method, url, body=None, extra_headers=None):
+        entry = self.next_entry(method, url, body)
+        if "content" in entry:
+            content = entry["content"].encode("utf-8")
+        else:
+            content = base64.b64decode(entry["content_base64"])
+
+        latency = entry["elapsed"] if self.latency is None else self.latency
+        delay = latency
+        if self.bandwidth:
+            delay += len(content) / float(self.bandwidth)
+        if delay > 0:
+            time.sleep(delay)
+
+        request = requests.PreparedRequest()
+        request.method = method
+        request.url = url
+        request.headers = CaseInsensitiveDict(extra_headers or {})
+        request.body = urllib.urlencode(body) if isinstance(body, dict) else body
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = url
+        response.request = request
+        response.elapsed = datetime.timedelta(seconds=latency)
+        response._content = content
+        return response
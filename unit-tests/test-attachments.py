@@ -0,0 +1,194 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from attachments import AttachmentError, AttachmentStore, BandwidthLimiter, chunked
+from local_server import create_local_client
+from replica import DocumentReplica
+from synced_client import *
+from utils import LocalServerTest, request_counts
+
+class TestAttachmentStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store(self):
+        store = AttachmentStore(self.directory)
+        data = "pdf" * 100000
+        file_hash = hashlib.sha1(data).hexdigest()
+        self.assertFalse(file_hash in store)
+        self.assertRaises(AttachmentError, store.add, file_hash, chunked(data[1:]))
+        self.assertFalse(file_hash in store)
+        self.assertEqual(os.listdir(os.path.dirname(store.path(file_hash))), [])
+
+        store.add(file_hash, chunked(data))
+        self.assertTrue(file_hash in store)
+        with open(store.path(file_hash), "rb") as inf:
+            self.assertEqual(inf.read(), data)
+
+        # remembered by the next runs, the partial files of a killed run are removed
+        partial = store.path(file_hash) + "x.part"
+        open(partial, "wb").write("partial")
+        store = AttachmentStore(self.directory)
+        self.assertEqual(len(store), 1)
+        self.assertTrue(file_hash in store)
+        self.assertFalse(os.path.exists(partial))
+
+    def test_invalid_hashes(self):
+        store = AttachmentStore(self.directory)
+        for file_hash in ["../" + "a" * 37, "A" * 40, "a" * 39, "a" * 40 + "\n", None]:
+            self.assertRaises(AttachmentError, store.path, file_hash)
+            self.assertRaises(AttachmentError, store.add, file_hash, chunked("data"))
+        self.assertEqual(os.listdir(self.directory), [])
+
+        # only sha1 names are stored files
+        os.mkdir(os.path.join(self.directory, "aa"))
+        for filename in ["a" * 40, "A" * 40, "notes.txt"]:
+            open(os.path.join(self.directory, "aa", filename), "wb").write("data")
+        store = AttachmentStore(self.directory)
+        self.assertEqual(len(store), 1)
+        self.assertTrue("a" * 40 in store)
+
+    def test_limiter(self):
+        limiter = BandwidthLimiter(1000)
+        start = time.time()
+        for i in range(4):
+            limiter.reserve(100)
+        self.assertTrue(time.time() - start >= 0.29)
+
+class TestAttachmentSync(LocalServerTest):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(10)
+        self.files = {}
+        for i in range(4):
+            self.attach(self.ids[i], "file %d " % i * 1000)
+        # the same file attached to another document
+        self.attach(self.ids[4], "file 0 " * 1000)
+
+    def tearDown(self):
+        LocalServerTest.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def attach(self, doc_id, data, group_id=None):
+        file_hash = self.library.add_file(doc_id, "%s.pdf" % doc_id, data, group_id)
+        self.files[file_hash] = data
+        return file_hash
+
+    def create_client(self, store, replica=None, concurrency=4):
+        if replica is not None:
+            replica = DocumentReplica(os.path.join(self.directory, replica))
+        return DummySyncedClient(client=create_local_client(self.server.base_url), page_size=4,
+                                 concurrency=concurrency, replica=replica, attachments=store)
+
+    def downloads(self):
+        counts = request_counts(reset=True)
+        return sum(count for name, count in counts.items() if name.startswith("download_file"))
+
+    def check_store(self, store):
+        for file_hash, data in self.files.items():
+            self.assertTrue(file_hash in store)
+            with open(store.path(file_hash), "rb") as inf:
+                self.assertEqual(inf.read(), data)
+
+    def test_sync(self):
+        store = AttachmentStore(os.path.join(self.directory, "files"))
+        sclient = self.create_client(store, "replica.db")
+        sclient.sync()
+        self.assertEqual(len(sclient.download_results), 4)
+        self.assertTrue(all(result.succeeded() for result in sclient.download_results))
+        self.assertEqual(self.downloads(), 4)
+        self.check_store(store)
+
+        # only the new files are downloaded, also by the next runs
+        sclient.sync()
+        self.assertEqual(sclient.download_results, [])
+        self.attach(self.ids[5], "new file")
+        sclient = self.create_client(AttachmentStore(os.path.join(self.directory, "files")), "replica.db")
+        sclient.sync()
+        self.assertEqual([result.doc_id for result in sclient.download_results], [self.ids[5]])
+        self.assertEqual(self.downloads(), 1)
+        self.check_store(sclient.attachments)
+
+    def test_only_fetched_documents_looked_at(self):
+        store = AttachmentStore(os.path.join(self.directory, "files"))
+        sclient = self.create_client(store)
+        sclient.sync()
+        sclient.sync()
+        self.attach(self.ids[5], "new file")
+        # the fingerprint an incremental sync checks is built once
+        sclient.library_fingerprint()
+        def items():
+            raise AssertionError("every document looked at")
+        sclient.documents.items = items
+        sclient.sync()
+        self.assertEqual([result.doc_id for result in sclient.download_results], [self.ids[5]])
+        self.check_store(store)
+
+    def test_failed_downloads(self):
+        store = AttachmentStore(os.path.join(self.directory, "files"))
+        file_hash = self.attach(self.ids[6], "lost")
+        del self.library.files[file_hash]
+        sclient = self.create_client(store, concurrency=1)
+        sclient.sync()
+        failed = [result for result in sclient.download_results if not result.succeeded()]
+        self.assertEqual([(result.file_hash, result.error) for result in failed], [(file_hash, "status 404")])
+        self.assertFalse(file_hash in store)
+
+        # retried by the next sync
+        self.library.files[file_hash] = ("lost.pdf", "lost")
+        sclient.sync()
+        self.assertEqual([(result.file_hash, result.error) for result in sclient.download_results],
+                         [(file_hash, None)])
+        self.check_store(store)
+
+    def test_invalid_hash_not_downloaded(self):
+        store = AttachmentStore(os.path.join(self.directory, "files"))
+        file_hash = self.attach(self.ids[7], "escaped")
+        bad_hash = "../../" + file_hash[6:]
+        del self.files[file_hash]
+        self.library.files[bad_hash] = self.library.files.pop(file_hash)
+        self.library.document_data(self.ids[7])["files"][0]["file_hash"] = bad_hash
+        sclient = self.create_client(store, concurrency=1)
+        sclient.sync()
+        failed = [result for result in sclient.download_results if not result.succeeded()]
+        self.assertEqual([(result.file_hash, result.error) for result in failed], [(bad_hash, "invalid file hash")])
+        self.assertEqual(self.downloads(), 4)
+        self.check_store(store)
+        self.assertEqual(len(store), 4)
+
+    def test_groups(self):
+        group_id = self.library.create_group({"name": "group"})
+        group_ids = self.library.seed_documents(2, group_id)
+        group_hash = self.attach(group_ids[0], "group file", group_id)
+        # already downloaded for the user library
+        self.attach(group_ids[1], "file 1 " * 1000, group_id)
+        store = AttachmentStore(os.path.join(self.directory, "files"))
+        sclient = self.create_client(store)
+        sclient.add_group(group_id)
+        sclient.sync()
+        self.check_store(store)
+        self.assertEqual([result.file_hash for result in sclient.groups[group_id].download_results], [group_hash])
+        self.assertEqual(self.downloads(), 5)
+
+    def test_bandwidth(self):
+        store = AttachmentStore(os.path.join(self.directory, "files"), bandwidth=28000)
+        start = time.time()
+        self.create_client(store).sync()
+        # 4 files of 7000 bytes, the first one starts right away
+        self.assertTrue(time.time() - start >= 0.74)
+        self.check_store(store)
+
+if __name__ == "__main__":
+    unittest.main()
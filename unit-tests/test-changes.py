@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from change_events import ChangeLog, ChangeQueue
+from local_server import create_local_client
+from synced_client import *
+from utils import LocalServerTest
+
+class TestChangeEvents(LocalServerTest):
+
+    def setUp(self):
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(10)
+
+    def create_client(self, concurrency):
+        sclient = DummySyncedClient(client=create_local_client(self.server.base_url),
+                                    page_size=4, concurrency=concurrency)
+        sclient.sync()
+        self.events = []
+        sclient.change_listeners.append(self.events.append)
+        return sclient
+
+    def summary(self):
+        return sorted((event.source, event.kind, event.doc_id, tuple(event.fields or ())) for event in self.events)
+
+    def check_events(self, concurrency):
+        sclient = self.create_client(concurrency)
+        sclient.sync()
+        self.assertEqual(self.events, [])
+
+        added, _ = self.library.create_document({"type": "Book", "title": "remote"})
+        self.library.update_document(self.ids[0], {"title": "remote"})
+        self.library.delete_document(self.ids[1])
+        self.library.update_document(self.ids[2], {"year": 1999})
+        sclient.documents[self.ids[2]].update({"title": "local"})
+        sclient.documents[self.ids[3]].update({"title": "local"})
+        sclient.documents[self.ids[4]].delete()
+        new_document = sclient.add_new_local_document({"type": "Book", "title": "new"})
+        sclient.sync(full=True)
+
+        self.assertEqual(self.summary(), sorted([
+            ("remote", "added", added, ()),
+            ("remote", "updated", self.ids[0], ("lastUpdate", "title")),
+            ("remote", "deleted", self.ids[1], ()),
+            ("remote", "conflict_resolved", self.ids[2], ("lastUpdate", "year")),
+            ("local", "updated", self.ids[2], ("title",)),
+            ("local", "updated", self.ids[3], ("title",)),
+            ("local", "deleted", self.ids[4], ()),
+            ("local", "added", new_document.id(), ())]))
+        # the last event of a document has its current version
+        last_events = dict((event.doc_id, event) for event in self.events)
+        for event in last_events.values():
+            if event.kind != "deleted":
+                self.assertEqual(event.version, self.library.versions[event.doc_id])
+        for event in self.events:
+            self.assertEqual(event.previous_id, None)
+            self.assertEqual(event.group_id, None)
+
+    def test_one_worker(self):
+        self.check_events(1)
+
+    def test_pipelined(self):
+        self.check_events(4)
+
+    def test_recreated(self):
+        sclient = self.create_client(4)
+        sclient.documents[self.ids[5]].update({"title": "local"})
+        self.library.delete_document(self.ids[5])
+        sclient.sync(full=True)
+        self.assertEqual(len(self.events), 1)
+        event = self.events[0]
+        self.assertEqual((event.source, event.kind, event.previous_id), ("local", "added", self.ids[5]))
+        self.assertTrue(event.doc_id in sclient.documents)
+
+    def test_groups(self):
+        group_id = self.library.create_group({"name": "group"})
+        sclient = self.create_client(4)
+        sclient.add_group(group_id)
+        group_ids = self.library.seed_documents(3, group_id)
+        sclient.sync()
+        self.assertEqual(sorted((event.kind, event.doc_id, event.group_id) for event in self.events),
+                         [("added", doc_id, group_id) for doc_id in sorted(group_ids)])
+
+class TestConsumers(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "changes.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_queue(self):
+        queue = ChangeQueue(maxsize=2)
+        events = [ChangeEvent("added", i, "remote", version=i) for i in range(10)]
+        producer = threading.Thread(target=lambda: map(queue, events))
+        producer.start()
+        received = [queue.get(5) for i in range(10)]
+        producer.join()
+        self.assertEqual(received, events)
+        self.assertEqual(queue.drain(), [])
+
+    def test_log(self):
+        log = ChangeLog(self.filename)
+        events = [ChangeEvent("updated", i, "remote", version=i, fields=["title"]) for i in range(5)]
+        for event in events[:3]:
+            log(event)
+        read = list(log.read())
+        self.assertEqual([event for offset, event in read], events[:3])
+        self.assertEqual(read[-1][0], log.end_offset())
+
+        # a consumer resumes after the last event it processed
+        offset = read[1][0]
+        for event in events[3:]:
+            log(event)
+        self.assertEqual([event for offset, event in log.read(offset)], events[2:])
+        log.close()
+
+        # a line cut short by a crash is dropped when the log is opened again
+        with open(self.filename, "ab") as outf:
+            outf.write('{"kind": "add')
+        self.assertEqual(len(list(ChangeLog(self.filename).read())), 5)
+        log = ChangeLog(self.filename, fsync=True)
+        log(ChangeEvent("deleted", 7, "local", group_id="group"))
+        self.assertEqual([event for offset, event in log.read(offset)][-1],
+                         ChangeEvent("deleted", 7, "local", group_id="group"))
+        log.close()
+
+if __name__ == "__main__":
+    unittest.main()
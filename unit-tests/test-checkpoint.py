@@ -0,0 +1,176 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import create_local_client
+from replica import DocumentReplica
+from synced_client import *
+from utils import LocalServerTest, request_counts
+
+class Interrupted(Exception):
+    pass
+
+class TestCheckpoints(LocalServerTest):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "replica.db")
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(100)
+        self.replicas = []
+
+    def tearDown(self):
+        for replica in self.replicas:
+            replica.close()
+        LocalServerTest.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def create_client(self):
+        replica = DocumentReplica(self.filename)
+        self.replicas.append(replica)
+        return DummySyncedClient(client=create_local_client(self.server.base_url), replica=replica,
+                                 page_size=10, concurrency=4)
+
+    def kill(self, sclient):
+        # what a killed process leaves in the database
+        sclient.replica.connection.rollback()
+
+    def test_resume_listing(self):
+        sclient = self.create_client()
+        document_details = sclient.client.document_details
+        def failing_document_details(doc_id):
+            if doc_id == self.ids[65]:
+                raise Interrupted()
+            return document_details(doc_id)
+        sclient.client.document_details = failing_document_details
+        self.assertRaises(Interrupted, sclient.sync)
+        self.kill(sclient)
+
+        checkpoint = self.replicas[0].load_meta("checkpoint")
+        self.assertTrue(4 <= checkpoint["page"] <= 6)
+        self.assertEqual(checkpoint["new_count"], checkpoint["page"] * 10)
+
+        request_counts(reset=True)
+        restarted = self.create_client()
+        self.assertTrue(len(restarted.documents) >= checkpoint["page"] * 10)
+        restarted.sync()
+        self.assertEqual(request_counts()["library"], 10 - checkpoint["page"])
+        self.assertTrue(request_counts()["document_details"] <= 100 - checkpoint["page"] * 10)
+        self.assertEqual(sorted(restarted.documents.keys()), self.ids)
+        for doc_id in self.ids:
+            self.assertEqual(restarted.documents[doc_id].version(), self.library.versions[doc_id])
+        self.assertEqual(self.replicas[1].load_meta("checkpoint"), None)
+
+        # the next sync lists everything again
+        request_counts(reset=True)
+        restarted.sync()
+        self.assertEqual(request_counts()["library"], 10)
+        self.assertEqual(request_counts()["document_details"], 0)
+
+    def test_resumed_full_sync_finds_deletions(self):
+        sclient = self.create_client()
+        sclient.sync()
+        sclient.sync(full=True)
+        self.library.delete_document(self.ids[5])
+        self.library.update_document(self.ids[70], {"title": "remote"})
+        document_details = sclient.client.document_details
+        def failing_document_details(doc_id):
+            if doc_id == self.ids[70]:
+                raise Interrupted()
+            return document_details(doc_id)
+        sclient.client.document_details = failing_document_details
+        self.assertRaises(Interrupted, sclient.sync, True)
+        self.kill(sclient)
+        self.assertTrue(self.replicas[0].load_meta("checkpoint")["page"] > 0)
+
+        restarted = self.create_client()
+        restarted.sync()
+        self.assertTrue(self.ids[5] not in restarted.documents)
+        self.assertEqual(restarted.documents[self.ids[70]].object.title, "remote")
+        self.assertEqual(len(restarted.documents), 99)
+
+    def test_local_changes_kept_after_failure(self):
+        sclient = self.create_client()
+        sclient.sync()
+        sclient.documents[self.ids[3]].update({"title": "local"})
+        self.library.update_document(self.ids[80], {"title": "remote"})
+        document_details = sclient.client.document_details
+        def failing_document_details(doc_id):
+            raise Interrupted()
+        sclient.client.document_details = failing_document_details
+        self.assertRaises(Interrupted, sclient.sync)
+
+        sclient.client.document_details = document_details
+        sclient.sync()
+        self.assertEqual(self.library.document_details(self.ids[3])["title"], "local")
+        self.assertEqual(sclient.documents[self.ids[80]].object.title, "remote")
+
+class TestIdempotentCreate(LocalServerTest):
+
+    def setUp(self):
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(5)
+        self.sclient = DummySyncedClient(client=create_local_client(self.server.base_url))
+        self.sclient.sync()
+
+    def lose_create_responses(self):
+        create_document = self.sclient.client.create_document
+        def lost_create_document(document):
+            create_document(document=document)
+            raise IOError("timed out")
+        self.sclient.client.create_document = lost_create_document
+        return lambda: setattr(self.sclient.client, "create_document", create_document)
+
+    def titles(self):
+        return sorted(self.library.document_details(doc_id)["title"] for doc_id in self.library.library.all())
+
+    def test_created_once(self):
+        document = self.sclient.add_new_local_document({"type": "Book", "title": "new", "year": 2001})
+        repair = self.lose_create_responses()
+        self.sclient.sync()
+        self.assertFalse(self.sclient.push_results[0].succeeded())
+        self.assertTrue(document.is_new())
+        self.assertEqual(len(self.sclient.pending_creates), 1)
+
+        repair()
+        self.sclient.sync()
+        self.assertEqual(self.titles().count("new"), 1)
+        self.assertTrue(document.is_synced())
+        self.assertEqual(self.sclient.documents[document.id()] is document, True)
+        self.assertEqual(self.sclient.new_documents, [])
+        self.assertEqual(self.sclient.pending_creates, {})
+        self.assertEqual(self.sclient.push_results, [])
+
+    def test_recreated_once(self):
+        # updated locally and deleted on the server, recreated by the resolver
+        doc_id = self.ids[0]
+        self.sclient.documents[doc_id].update({"title": "recreated"})
+        self.library.delete_document(doc_id)
+        repair = self.lose_create_responses()
+        self.sclient.sync()
+        self.assertEqual(len(self.sclient.pending_creates), 1)
+
+        repair()
+        self.sclient.sync()
+        self.assertEqual(len(self.library.library), 5)
+        self.assertEqual(self.sclient.pending_creates, {})
+        self.assertTrue(doc_id not in self.sclient.documents)
+        self.assertEqual(len(self.sclient.documents), 5)
+
+    def test_edited_after_lost_response(self):
+        document = self.sclient.add_new_local_document({"type": "Book", "title": "new"})
+        repair = self.lose_create_responses()
+        self.sclient.sync()
+        document.update({"title": "renamed"})
+        repair()
+        self.sclient.sync()
+        self.assertEqual(self.titles().count("new"), 0)
+        self.assertEqual(self.titles().count("renamed"), 1)
+        self.assertTrue(document.is_synced())
+        self.assertEqual(self.library.document_details(document.id())["title"], "renamed")
+
+if __name__ == "__main__":
+    unittest.main()
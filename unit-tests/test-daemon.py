@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import LocalServer, create_local_client
+from sync_daemon import SyncDaemon
+from synced_client import *
+from utils import LocalServerTest
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class TestSchedule(unittest.TestCase):
+
+    def setUp(self):
+        self.sclient = DummySyncedClient(client=object())
+        self.daemon = SyncDaemon(self.sclient, min_interval=10, max_interval=100, backoff=2,
+                                 debounce=2, max_debounce=5, jitter=0.1, seed=1)
+        self.daemon.watch(self.sclient)
+
+    def test_interval(self):
+        intervals = []
+        for changed in [False, False, False, False, True, False]:
+            self.daemon.interval = self.daemon.next_interval(changed)
+            intervals.append(self.daemon.interval)
+        self.assertEqual(intervals, [20, 40, 80, 100, 10, 20])
+
+    def test_jitter(self):
+        values = [self.daemon.jittered(10) for i in range(100)]
+        self.assertTrue(all(9 <= value <= 11 for value in values))
+        self.assertTrue(len(set(values)) > 1)
+        other = SyncDaemon(self.sclient, jitter=0.1, seed=1)
+        self.assertEqual([other.jittered(10) for i in range(100)], values)
+
+    def test_debounce(self):
+        start = time.time()
+        self.daemon.scheduled = self.daemon.due = start + 60
+        self.sclient.add_new_local_document({"title": "new"})
+        self.assertTrue(start + 2 <= self.daemon.due <= time.time() + 2)
+
+        # a later edit pushes the sync back
+        self.daemon.first_change = start - 1
+        self.daemon.due = start + 1
+        self.sclient.add_new_local_document({"title": "other"})
+        self.assertTrue(self.daemon.due >= start + 2)
+
+        # up to max_debounce after the first
+        self.daemon.first_change = start - 4
+        self.sclient.add_new_local_document({"title": "other"})
+        self.assertTrue(self.daemon.due <= start + 1)
+
+        # and never after the next scheduled sync
+        self.daemon.first_change = None
+        self.daemon.scheduled = start + 1
+        self.sclient.add_new_local_document({"title": "other"})
+        self.assertEqual(self.daemon.due, start + 1)
+
+class TestDaemon(LocalServerTest):
+
+    def setUp(self):
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(10)
+        self.sclient = DummySyncedClient(client=create_local_client(self.server.base_url))
+        self.synced = []
+        sync = self.sclient.sync
+        def recording_sync(full=False):
+            sync(full)
+            self.synced.append(time.time())
+        self.sclient.sync = recording_sync
+
+    def tearDown(self):
+        self.daemon.stop()
+        LocalServerTest.tearDown(self)
+
+    def test_local_changes_debounced(self):
+        self.daemon = SyncDaemon(self.sclient, min_interval=60, debounce=0.2, jitter=0).start()
+        self.assertTrue(wait_for(lambda: len(self.synced) == 1))
+        for doc_id in self.ids[:5]:
+            self.sclient.documents[doc_id].update({"title": "edited"})
+            time.sleep(0.02)
+        self.assertTrue(wait_for(lambda: len(self.synced) == 2))
+        time.sleep(0.3)
+        self.assertEqual(len(self.synced), 2)
+        for doc_id in self.ids[:5]:
+            self.assertEqual(self.library.document_details(doc_id)["title"], "edited")
+
+    def test_folder_edits(self):
+        self.daemon = SyncDaemon(self.sclient, min_interval=60, debounce=0.05, jitter=0).start()
+        self.assertTrue(wait_for(lambda: len(self.synced) == 1))
+        folder = self.sclient.add_new_local_folder("folder")
+        self.assertTrue(wait_for(lambda: len(self.synced) == 2))
+        folder_id = folder.id()
+        self.assertTrue(folder_id in self.library.folders)
+
+        folder.add_document(self.ids[0])
+        self.assertTrue(wait_for(lambda: self.ids[0] in self.library.folders[folder_id]["documents"]))
+        folder.remove_document(self.ids[0])
+        self.assertTrue(wait_for(lambda: not self.library.folders[folder_id]["documents"]))
+        self.sclient.folders[folder_id].delete()
+        self.assertTrue(wait_for(lambda: folder_id not in self.library.folders))
+
+    def test_edit_during_push(self):
+        self.daemon = SyncDaemon(self.sclient, min_interval=60, debounce=0.05, jitter=0).start()
+        self.assertTrue(wait_for(lambda: len(self.synced) == 1))
+        document = self.sclient.documents[self.ids[0]]
+        update_document = self.sclient.client.update_document
+        def editing_update_document(doc_id, document=None):
+            response = update_document(doc_id, document=document)
+            # edited by the user while the request is in flight
+            self.sclient.client.update_document = update_document
+            edit = threading.Thread(target=self.sclient.documents[doc_id].update,
+                                    args=({"title": "second", "year": 1999},))
+            edit.start()
+            edit.join()
+            return response
+        self.sclient.client.update_document = editing_update_document
+        document.update({"title": "first"})
+        self.assertTrue(wait_for(lambda: self.library.document_details(self.ids[0])["title"] == "second"))
+        self.assertTrue(wait_for(lambda: document.is_synced()))
+        self.assertEqual(self.library.document_details(self.ids[0])["year"], 1999)
+        self.assertEqual((document.object.title, document.object.year), ("second", 1999))
+
+        # set back to the synced value while the change is in flight
+        sent = []
+        def reverting_update_document(doc_id, document=None):
+            sent.append(document)
+            response = update_document(doc_id, document=document)
+            if len(sent) == 1:
+                self.sclient.documents[doc_id].update({"title": "second"})
+            return response
+        self.sclient.client.update_document = reverting_update_document
+        document.update({"title": "third"})
+        self.assertTrue(wait_for(lambda: len(sent) == 2 and document.is_synced()))
+        self.assertEqual(sent, [{"title": "third"}, {"title": "second"}])
+        self.assertEqual(self.library.document_details(self.ids[0])["title"], "second")
+        self.assertEqual(document.object.title, "second")
+
+    def test_adaptive_interval(self):
+        self.daemon = SyncDaemon(self.sclient, min_interval=0.05, max_interval=0.4, jitter=0).start()
+        self.assertTrue(wait_for(lambda: self.daemon.interval == 0.4))
+        self.library.update_document(self.ids[0], {"title": "remote"})
+        self.assertTrue(wait_for(lambda: self.sclient.documents[self.ids[0]].object.title == "remote"))
+        self.assertTrue(wait_for(lambda: self.daemon.interval == 0.05, 1))
+        self.assertEqual(self.daemon.failures, 0)
+
+    def test_failures_back_off(self):
+        self.daemon = SyncDaemon(self.sclient, min_interval=0.05, max_interval=0.2, jitter=0)
+        self.server.stop()
+        self.daemon.start()
+        self.assertTrue(wait_for(lambda: self.daemon.failures >= 2))
+        self.assertTrue(self.daemon.interval > 0.05)
+        self.assertTrue(self.daemon.last_error is not None)
+        self.server = LocalServer().start()
+
+if __name__ == "__main__":
+    unittest.main()
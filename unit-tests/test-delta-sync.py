@@ -0,0 +1,166 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import create_local_client
+from replica import DocumentReplica
+from synced_client import *
+from utils import LocalServerTest, request_counts
+
+class TestDeltaSync(LocalServerTest):
+
+    def setUp(self):
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(20)
+        self.sclient = DummySyncedClient(client=create_local_client(self.server.base_url),
+                                         full_sync_interval=3)
+        self.compared = []
+        state = self.sclient.documents.state
+        def counting_state(doc_id):
+            self.compared.append(doc_id)
+            return state(doc_id)
+        self.sclient.documents.state = counting_state
+
+    def sync(self):
+        self.compared = []
+        self.sclient.sync()
+
+    def test_unchanged_documents_skipped(self):
+        self.sclient.full_sync_interval = 10
+        # the first two syncs compare everything, the watermark lags one sync
+        self.sync()
+        self.sync()
+        self.assertEqual(len(self.compared), 20)
+        self.assertEqual(request_counts(reset=True)["document_details"], 20)
+
+        # only the last modified document is at the watermark
+        self.sync()
+        self.assertEqual(self.compared, [self.ids[-1]])
+        self.assertEqual(self.sclient.syncs_since_full, 1)
+        # the others weren't fetched
+        self.assertEqual(request_counts(field="retries")["document_details"], 0)
+        self.assertEqual(request_counts(field="cache_hits")["document_details"], 19)
+
+        # documents changed on the server are above the watermark
+        self.server.library.update_document(self.ids[3], {"title": "remote"})
+        self.sync()
+        self.assertEqual(sorted(self.compared), [self.ids[3], self.ids[-1]])
+        self.assertEqual(request_counts(reset=True)["document_details"], 1)
+        self.assertEqual(self.sclient.documents[self.ids[3]].object.title, "remote")
+
+        # the watermark only passes them two syncs later
+        self.sync()
+        self.assertEqual(sorted(self.compared), [self.ids[3], self.ids[-1]])
+        self.sync()
+        self.assertEqual(self.compared, [self.ids[3]])
+        self.assertEqual(request_counts(reset=True)["document_details"], 0)
+
+    def test_new_remote_documents(self):
+        self.sync()
+        self.sync()
+        new_ids = self.server.library.seed_documents(2)
+        self.sync()
+        self.assertEqual(self.sclient.syncs_since_full, 1)
+        self.assertEqual(len(self.sclient.documents), 22)
+        for doc_id in new_ids:
+            self.assertTrue(self.sclient.documents[doc_id].is_synced())
+
+    def test_remote_delete_triggers_full_sync(self):
+        self.sync()
+        self.sync()
+        self.sync()
+        self.assertEqual(self.sclient.syncs_since_full, 1)
+
+        # a deletion and a creation keep the library size but not the counts
+        self.server.library.delete_document(self.ids[0])
+        new_id = self.server.library.seed_documents(1)[0]
+        self.sync()
+        self.assertEqual(self.sclient.syncs_since_full, 0)
+        self.assertTrue(self.ids[0] not in self.sclient.documents)
+        self.assertTrue(new_id in self.sclient.documents)
+        self.assertEqual(len(self.sclient.documents), 20)
+
+    def test_periodic_full_sync(self):
+        self.sync()
+        self.sync()
+        for i in range(3):
+            self.sync()
+            self.assertEqual(self.sclient.syncs_since_full, i + 1)
+        self.sync()
+        self.assertEqual(self.sclient.syncs_since_full, 0)
+        self.assertEqual(len(self.compared), 20)
+
+        self.sync()
+        self.sclient.sync(full=True)
+        self.assertEqual(self.sclient.syncs_since_full, 0)
+
+    def test_change_below_watermark(self):
+        self.sync()
+        self.sync()
+        self.sync()
+        request_counts(reset=True)
+        # a version the watermark skips, e.g. restored from a backup
+        doc_id = self.ids[3]
+        self.server.library.update_document(doc_id, {"title": "restored"})
+        self.server.library.versions[doc_id] = self.sclient.watermark - 1
+        self.assertNotEqual(self.sclient.documents[doc_id].version(), self.sclient.watermark - 1)
+        self.sync()
+        # the trees differ, a full sync finds it right away
+        self.assertEqual(self.sclient.documents[doc_id].object.title, "restored")
+        self.assertEqual(self.sclient.syncs_since_full, 0)
+        self.assertEqual(request_counts(reset=True)["document_details"], 1)
+
+    def test_library_changed_while_listed(self):
+        self.sclient.page_size = 7
+        library = self.sclient.client.library
+        def changing_library(page, items):
+            if page == 1 and len(self.server.library.versions) == 20:
+                self.server.library.seed_documents(1)
+            return library(page=page, items=items)
+        self.sclient.client.library = changing_library
+        self.sync()
+        self.assertEqual(len(self.sclient.documents), 21)
+        self.assertEqual(request_counts(field="retries")["library"], 1)
+        self.assertEqual(request_counts(field="cache_hits")["library"], 0)
+
+    def test_local_changes_still_sent(self):
+        self.sync()
+        self.sync()
+        self.sclient.documents[self.ids[0]].update({"title": "local"})
+        self.sclient.documents[self.ids[1]].delete()
+        self.sync()
+        self.assertEqual(self.server.library.document_details(self.ids[0])["title"], "local")
+        self.assertTrue(self.ids[1] not in self.server.library.versions)
+        self.assertEqual(self.sclient.syncs_since_full, 1)
+
+        # the deletion sent by this client isn't mistaken for a remote one
+        self.sync()
+        self.assertEqual(self.sclient.syncs_since_full, 2)
+        self.assertEqual(len(self.sclient.documents), 19)
+
+    def test_watermarks_persisted(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "replica.db")
+            client = create_local_client(self.server.base_url)
+            sclient = DummySyncedClient(client=client, replica=DocumentReplica(filename))
+            sclient.sync()
+            sclient.sync()
+            sclient.sync()
+
+            restarted = DummySyncedClient(client=client, replica=DocumentReplica(filename))
+            self.assertEqual(restarted.watermark, sclient.watermark)
+            self.assertEqual(restarted.high_water, sclient.high_water)
+            self.assertEqual(restarted.syncs_since_full, 1)
+            self.assertFalse(restarted.full_sync_due())
+
+            restarted.reset()
+            self.assertTrue(restarted.full_sync_due())
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    unittest.main()
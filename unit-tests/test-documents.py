@@ -0,0 +1,135 @@
+import copy
+import os
+import pickle
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import create_local_client
+from synced_client import *
+from utils import LocalServerTest
+
+class TestDocuments(unittest.TestCase):
+
+    def test_fields(self):
+        document = SyncedDocument({u"id": 1, u"version": 2, u"title": u"Title", u"year": 2001})
+        self.assertEqual(document.id(), 1)
+        self.assertEqual(document.version(), 2)
+        self.assertEqual(document.object.title, u"Title")
+        self.assertTrue(hasattr(document.object, "year"))
+        self.assertFalse(hasattr(document.object, "doi"))
+        self.assertRaises(AttributeError, getattr, document.object, "doi")
+        self.assertEqual(SyncedDocument({"title": "no id"}).id(), None)
+
+    def test_set_and_delete(self):
+        document = SyncedDocument({"id": 1, "version": 2, "title": "Title"})
+        document.object.title = "Other"
+        document.object.year = 2001
+        self.assertEqual(document.object.title, "Other")
+        self.assertEqual(document.object.year, 2001)
+        self.assertEqual(document.object.to_dict(), {"id": 1, "version": 2, "title": "Other", "year": 2001})
+
+        del document.object.year
+        self.assertFalse("year" in document.object)
+        self.assertRaises(AttributeError, delattr, document.object, "year")
+
+    def test_shapes_shared(self):
+        first = SyncedDocument({"id": 1, "version": 2, "title": "First", "year": 2001})
+        second = SyncedDocument({"year": 2002, "title": "Second", "version": 3, "id": 2})
+        self.assertTrue(first.object.shape is second.object.shape)
+        self.assertEqual(first.object.keys(), ["id", "version", "title", "year"])
+
+        # the same fields added in another order
+        first = SyncedDocument({"id": 1})
+        first.object.year = 2001
+        first.object.version = 2
+        first.object.title = "First"
+        self.assertTrue(first.object.shape is second.object.shape)
+
+    def test_to_json(self):
+        document = SyncedDocument({"id": 1, "version": 2, "title": "Title", "files": [], "group_id": None})
+        self.assertEqual(document.to_json(), {"title": "Title"})
+        obj = SyncedObject({"id": 1, "name": "Object"})
+        self.assertEqual(obj.to_json(), {"id": 1, "name": "Object"})
+        folder = SyncedFolder({"id": 2, "name": "Folder", "parent": 1})
+        self.assertEqual(folder.to_json(), {"name": "Folder", "parent": 1})
+
+    def test_no_instance_dict(self):
+        document = SyncedDocument({"id": 1, "version": 2})
+        self.assertFalse(hasattr(document, "__dict__"))
+        self.assertFalse(hasattr(document.object, "__dict__"))
+        self.assertRaises(AttributeError, setattr, document, "unknown", 1)
+
+    def test_copy_and_pickle(self):
+        document = SyncedDocument({"id": 1, "version": 2, "title": "Title", "tags": ["a"]})
+        record = copy.copy(document.object)
+        record.title = "Copy"
+        self.assertEqual(document.object.title, "Title")
+        self.assertTrue(record.shape is document.object.shape)
+
+        copied = copy.deepcopy(document)
+        copied.object.tags.append("b")
+        self.assertEqual(document.object.tags, ["a"])
+        self.assertTrue(copied.object.shape is document.object.shape)
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            loaded = pickle.loads(pickle.dumps(document.object, protocol))
+            self.assertEqual(loaded.to_dict(), document.object.to_dict())
+        loaded = pickle.loads(pickle.dumps(document, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(loaded.id(), 1)
+        self.assertEqual(loaded.object.title, "Title")
+        self.assertEqual(loaded.status, document.status)
+
+class TestMinimalDiffs(LocalServerTest):
+
+    def setUp(self):
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(3)
+        self.sclient = DummySyncedClient(client=create_local_client(self.server.base_url))
+        self.sclient.sync()
+
+        self.sent = []
+        update_document = self.sclient.client.update_document
+        def recording_update_document(doc_id, document):
+            self.sent.append((doc_id, document))
+            return update_document(doc_id, document=document)
+        self.sclient.client.update_document = recording_update_document
+
+    def test_reverted_changes_dropped(self):
+        document = self.sclient.documents[self.ids[0]]
+        title = document.object.title
+        document.update({"title": "changed", "year": document.object.year})
+        self.assertEqual(document.changes, {"title": "changed"})
+        self.assertEqual(self.sclient.modified_ids, set([self.ids[0]]))
+
+        # equal values with another key order or string type
+        authors = [dict(reversed(author.items())) for author in document.object.authors]
+        document.update({"title": unicode(title), "authors": authors})
+        self.assertTrue(document.is_synced())
+        self.assertEqual(document.changes, {})
+        self.assertEqual(self.sclient.modified_ids, set())
+
+        version = self.server.library.versions[self.ids[0]]
+        self.sclient.sync()
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.server.library.versions[self.ids[0]], version)
+
+    def test_only_changed_fields_sent(self):
+        document = self.sclient.documents[self.ids[1]]
+        document.update({"title": "local", "tags": list(document.object.tags), "year": 1900})
+        self.sclient.sync()
+        self.assertEqual(self.sent, [(self.ids[1], {"title": "local", "year": 1900})])
+        self.assertTrue(document.is_synced())
+        self.assertEqual(document.object.title, "local")
+
+    def test_change_already_on_server(self):
+        document = self.sclient.documents[self.ids[2]]
+        document.update({"title": "same"})
+        self.server.library.update_document(self.ids[2], {"title": "same"})
+        self.sclient.sync()
+        self.assertEqual(self.sent, [])
+        self.assertTrue(document.is_synced())
+        self.assertEqual(document.version(), self.server.library.versions[self.ids[2]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import create_local_client
+from synced_client import *
+from utils import LocalServerTest, request_counts
+
+class TestFolderSync(LocalServerTest):
+
+    def setUp(self):
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(10)
+        self.sclient = DummySyncedClient(client=create_local_client(self.server.base_url))
+
+    def remote_folder(self, name, parent=None, document_ids=()):
+        folder = {"name": name}
+        if parent is not None:
+            folder["parent"] = parent
+        folder_id = self.library.new_folder(self.library.folders, folder)
+        for doc_id in document_ids:
+            self.library.folders[folder_id]["documents"].add(doc_id)
+        return folder_id
+
+    def remote_documents(self, folder_id):
+        return set(self.library.folders[folder_id]["documents"].all())
+
+    def test_remote_folders(self):
+        top = self.remote_folder("top", document_ids=self.ids[:3])
+        child = self.remote_folder("child", top, self.ids[2:4])
+        empty = self.remote_folder("empty", child)
+        self.sclient.sync()
+
+        self.assertEqual(sorted(self.sclient.folders.keys()), sorted([top, child, empty]))
+        self.assertEqual(self.sclient.folders[child].parent(), top)
+        self.assertEqual(self.sclient.folders[child].object.name, "child")
+        self.assertEqual(self.sclient.folders[top].document_ids, set(self.ids[:3]))
+        self.assertEqual(self.sclient.folders[child].document_ids, set(self.ids[2:4]))
+        # empty folders aren't listed
+        self.assertEqual(request_counts()["folder_documents"], 2)
+
+        del self.library.folders[empty]
+        self.sclient.sync()
+        self.assertTrue(empty not in self.sclient.folders)
+
+    def test_new_local_folders(self):
+        self.sclient.sync()
+        top = self.sclient.add_new_local_folder("top")
+        child = self.sclient.add_new_local_folder("child", top.id())
+        grandchild = self.sclient.add_new_local_folder("grandchild", child.id())
+        top.add_document(self.ids[0])
+        grandchild.add_document(self.ids[1])
+        self.sclient.sync()
+
+        for folder in [top, child, grandchild]:
+            self.assertTrue(folder.is_synced())
+            self.assertTrue(folder.id() > 0)
+            self.assertTrue(folder.id() in self.library.folders)
+        self.assertEqual(self.library.folders[child.id()]["parent"], top.id())
+        self.assertEqual(self.library.folders[grandchild.id()]["parent"], child.id())
+        self.assertEqual(self.remote_documents(top.id()), set([self.ids[0]]))
+        self.assertEqual(self.remote_documents(grandchild.id()), set([self.ids[1]]))
+        self.assertEqual(request_counts()["create_folder"], 3)
+
+    def test_membership_merge(self):
+        folder_id = self.remote_folder("folder", document_ids=self.ids[:4])
+        self.sclient.sync()
+        folder = self.sclient.folders[folder_id]
+
+        folder.add_document(self.ids[5])
+        folder.remove_document(self.ids[0])
+        # already made on the server
+        folder.remove_document(self.ids[1])
+        self.library.folders[folder_id]["documents"].remove(self.ids[1])
+        self.library.folders[folder_id]["documents"].add(self.ids[6])
+        self.library.folders[folder_id]["documents"].remove(self.ids[3])
+
+        request_counts(reset=True)
+        self.sclient.sync()
+        expected = set([self.ids[2], self.ids[5], self.ids[6]])
+        self.assertEqual(self.remote_documents(folder_id), expected)
+        self.assertEqual(folder.document_ids, expected)
+        self.assertEqual(request_counts()["add_document_to_folder"], 1)
+        self.assertEqual(request_counts()["delete_document_from_folder"], 1)
+
+        # nothing left to send
+        request_counts(reset=True)
+        self.sclient.sync()
+        self.assertEqual(request_counts()["add_document_to_folder"] + request_counts()["delete_document_from_folder"], 0)
+
+    def test_local_delete(self):
+        top = self.remote_folder("top")
+        child = self.remote_folder("child", top)
+        other = self.remote_folder("other")
+        self.sclient.sync()
+        self.sclient.folders[top].delete()
+        self.sclient.folders[child].delete()
+        # a new folder inside a deleted one goes away too
+        self.sclient.add_new_local_folder("new", child)
+        self.sclient.sync()
+
+        self.assertEqual(request_counts()["delete_folder"], 1)
+        self.assertEqual(sorted(self.library.folders.keys()), [other])
+        self.assertEqual(sorted(self.sclient.folders.keys()), [other])
+        self.assertEqual(request_counts()["create_folder"], 0)
+
+    def test_failed_delete(self):
+        top = self.remote_folder("top")
+        child = self.remote_folder("child", top, [self.ids[0]])
+        self.sclient.sync()
+        self.sclient.folders[top].delete()
+        self.sclient.add_new_local_folder("new", child)
+        delete_folder = self.sclient.client.delete_folder
+        self.sclient.client.delete_folder = lambda folder_id: False
+        self.sclient.sync()
+
+        # kept to be deleted by the next sync, nothing created inside it
+        self.assertEqual(sorted(self.library.folders.keys()), [top, child])
+        self.assertTrue(self.sclient.folders[top].is_deleted())
+        self.assertEqual(request_counts()["create_folder"], 0)
+
+        self.sclient.client.delete_folder = delete_folder
+        self.sclient.sync()
+        self.assertEqual(self.library.folders, {})
+        self.assertEqual(self.sclient.folders, {})
+        self.assertEqual(request_counts()["create_folder"], 0)
+
+    def test_deleted_document(self):
+        folder = self.sclient.add_new_local_folder("folder")
+        self.sclient.sync()
+        folder.add_document(self.ids[0])
+        folder.add_document(self.ids[1])
+        # deleted on the server before the folder is synced
+        self.library.delete_document(self.ids[1])
+        self.sclient.sync()
+        self.assertEqual(folder.document_ids, set([self.ids[0]]))
+        self.assertEqual(self.remote_documents(folder.id()), set([self.ids[0]]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from concurrency import Budgeted
+from local_server import create_local_client
+from replica import DocumentReplica
+from synced_client import *
+from utils import LocalServerTest, request_counts
+
+class InFlight(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.maximum = 0
+
+    def call(self, delay):
+        with self.lock:
+            self.current += 1
+            self.maximum = max(self.maximum, self.current)
+        time.sleep(delay)
+        with self.lock:
+            self.current -= 1
+
+class TestBudget(unittest.TestCase):
+
+    def test_shared_budget(self):
+        target = InFlight()
+        semaphore = threading.BoundedSemaphore(3)
+        proxies = [Budgeted(target, semaphore) for i in range(4)]
+        pool = ThreadPool(12)
+        pool.map(lambda i: proxies[i % 4].call(0.01), range(48))
+        pool.close()
+        self.assertEqual(target.maximum, 3)
+
+class TestGroupSync(LocalServerTest):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        LocalServerTest.setUp(self)
+        self.personal_ids = self.library.seed_documents(5)
+        self.group_ids = []
+        self.group_documents = {}
+        for i in range(3):
+            group_id = self.library.create_group({"name": "group %d" % i})
+            self.group_ids.append(group_id)
+            self.group_documents[group_id] = self.library.seed_documents(4 + i, group_id)
+
+    def tearDown(self):
+        LocalServerTest.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def create_client(self, replica=None):
+        sclient = DummySyncedClient(client=create_local_client(self.server.base_url), replica=replica)
+        sclient.add_all_groups()
+        return sclient
+
+    def test_sync(self):
+        sclient = self.create_client()
+        sclient.sync()
+        self.assertEqual(sorted(sclient.documents.keys()), self.personal_ids)
+        self.assertEqual(sorted(sclient.groups.keys()), self.group_ids)
+        for group_id in self.group_ids:
+            group = sclient.groups[group_id]
+            self.assertEqual(sorted(group.documents.keys()), self.group_documents[group_id])
+            for document in group.documents.values():
+                self.assertTrue(document.is_synced())
+                self.assertEqual(document.object.group_id, group_id)
+        self.assertEqual(request_counts()["group_doc_details"], 4 + 5 + 6)
+
+    def test_local_changes(self):
+        sclient = self.create_client()
+        sclient.sync()
+        group_id = self.group_ids[1]
+        group = sclient.groups[group_id]
+        doc_ids = self.group_documents[group_id]
+        group.documents[doc_ids[0]].update({"title": "group edit"})
+        group.documents[doc_ids[1]].delete()
+        new_document = group.add_new_local_document({"type": "Book", "title": "new in group"})
+        folder = group.add_new_local_folder("group folder")
+        sclient.sync()
+
+        self.assertEqual(self.library.document_details(doc_ids[0], group_id)["title"], "group edit")
+        self.assertTrue(doc_ids[1] not in self.library.versions)
+        self.assertTrue(new_document.id() in self.library.group(group_id)["documents"])
+        self.assertTrue(new_document.id() not in self.library.library)
+        self.assertTrue(folder.id() in self.library.group(group_id)["folders"])
+        self.assertEqual(len(sclient.documents), 5)
+
+    def test_remote_changes_and_conflicts(self):
+        sclient = self.create_client()
+        sclient.sync()
+        group_id = self.group_ids[2]
+        doc_ids = self.group_documents[group_id]
+        local_document = sclient.groups[group_id].documents[doc_ids[0]]
+        local_document.update({"tags": local_document.object.tags + ["local"]})
+        self.library.update_document(doc_ids[0], {"tags": local_document.object.tags + ["remote"]})
+        self.library.delete_document(doc_ids[1], group_id)
+        sclient.sync()
+
+        details = self.library.document_details(doc_ids[0], group_id)
+        self.assertEqual(details["tags"][-2:], ["remote", "local"])
+        self.assertTrue(doc_ids[1] not in sclient.groups[group_id].documents)
+
+    def test_groups_in_flight(self):
+        sclient = self.create_client()
+        sclient.concurrency = 2
+        in_flight = InFlight()
+        for group in sclient.groups.values():
+            group.sync = lambda full: in_flight.call(0.05)
+        sclient.sync_groups()
+        self.assertEqual(in_flight.maximum, 2)
+
+    def test_replica_partitions(self):
+        filename = os.path.join(self.directory, "replica.db")
+        self.create_client(DocumentReplica(filename)).sync()
+
+        request_counts(reset=True)
+        sclient = self.create_client(DocumentReplica(filename))
+        self.assertEqual(sorted(sclient.documents.keys()), self.personal_ids)
+        for group_id in self.group_ids:
+            self.assertEqual(sorted(sclient.groups[group_id].documents.keys()), self.group_documents[group_id])
+        sclient.sync()
+        self.assertEqual(request_counts()["group_doc_details"] + request_counts()["document_details"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
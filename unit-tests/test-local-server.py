@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import *
+
+class TestEnv:
+    server = None
+    client = None
+
+class TestLocalServer(unittest.TestCase):
+
+    def setUp(self):
+        TestEnv.server.library.clear()
+        self.client = TestEnv.client
+
+    def test_paging(self):
+        ids = TestEnv.server.library.seed_documents(45)
+        pages = []
+        for page in range(3):
+            response = self.client.library(page=page, items=20)
+            self.assertEqual(response["total_results"], 45)
+            self.assertEqual(response["total_pages"], 3)
+            self.assertEqual(response["current_page"], page)
+            pages.extend(response["document_ids"])
+        self.assertEqual(pages, ids)
+
+    def test_versions(self):
+        created = self.client.create_document(document={"type": "Book", "title": "versions"})
+        document_id = created["document_id"]
+        details = self.client.document_details(document_id)
+        self.assertEqual(details["version"], created["version"])
+
+        updated = self.client.update_document(document_id, document={"title": "updated"})
+        self.assertTrue(updated["version"] > created["version"])
+        details = self.client.document_details(document_id)
+        self.assertEqual(details["title"], "updated")
+        self.assertEqual(details["version"], updated["version"])
+
+    def test_delete(self):
+        document_id = self.client.create_document(document={"type": "Book", "title": "delete"})["document_id"]
+        self.assertTrue(self.client.delete_library_document(document_id))
+        self.assertEqual(self.client.document_details(document_id).status_code, 404)
+        self.assertFalse(self.client.delete_library_document(document_id))
+
+    def test_download_redirect(self):
+        document_id = self.client.create_document(document={"type": "Book", "title": "file"})["document_id"]
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf:
+            pdf.write("%PDF-1.4 local server")
+            pdf.flush()
+            file_hash = self.client.upload_pdf(document_id, pdf.name)["file_hash"]
+
+        files = self.client.document_details(document_id)["files"]
+        self.assertEqual([f["file_hash"] for f in files], [file_hash])
+        response = self.client.download_file(document_id, file_hash)
+        self.assertEqual(response["data"], "%PDF-1.4 local server")
+
+    def test_folders(self):
+        document_id = self.client.create_document(document={"type": "Book", "title": "folder"})["document_id"]
+        parent = self.client.create_folder(folder={"name": "parent"})["folder_id"]
+        child = self.client.create_folder(folder={"name": "child", "parent": parent})["folder_id"]
+        self.client.add_document_to_folder(child, document_id)
+        self.assertEqual(self.client.folder_documents(child)["document_ids"], [document_id])
+
+        # deleting the parent removes its children
+        self.assertTrue(self.client.delete_folder(parent))
+        self.assertEqual(self.client.folders(), [])
+
+if __name__ == "__main__":
+    TestEnv.server = LocalServer().start()
+    TestEnv.client = create_local_client(TestEnv.server.base_url)
+    unittest.main()
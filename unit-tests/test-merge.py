@@ -0,0 +1,94 @@
+import os
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import create_local_client
+from synced_client import *
+from utils import LocalServerTest, request_counts
+
+def modified_document(base, changes):
+    document = SyncedDocument(base, SyncStatus.Synced)
+    document.update(changes)
+    return document
+
+class TestThreeWayMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = ThreeWayMergeResolver()
+        self.base = {"id": 1, "version": 1, "title": "Base", "year": 2000,
+                     "tags": ["a", "b", "c"],
+                     "authors": [{"forename": "A", "surname": "One"}, {"forename": "B", "surname": "Two"}]}
+
+    def remote(self, **fields):
+        remote = dict(self.base, version=2)
+        remote.update(fields)
+        return SyncedDocument(remote, SyncStatus.Synced)
+
+    def test_one_side_changes(self):
+        local = modified_document(self.base, {"title": "Local"})
+        self.resolver.resolve_both_updated(local, self.remote(year=2001, doi="10.1/x"))
+        self.assertTrue(local.is_modified())
+        self.assertEqual(local.changes, {"title": "Local"})
+        self.assertEqual(local.object.year, 2001)
+        self.assertEqual(local.object.doi, "10.1/x")
+        self.assertEqual(local.version(), 2)
+
+    def test_same_change_on_both_sides(self):
+        local = modified_document(self.base, {"title": "Same"})
+        self.resolver.resolve_both_updated(local, self.remote(title="Same"))
+        self.assertTrue(local.is_synced())
+        self.assertEqual(local.changes, {})
+
+    def test_scalar_conflict_keeps_local(self):
+        local = modified_document(self.base, {"title": "Local"})
+        self.resolver.resolve_both_updated(local, self.remote(title="Remote"))
+        self.assertEqual(local.changes, {"title": "Local"})
+        self.assertEqual(local.object.title, "Remote")
+
+    def test_lists_merged(self):
+        local = modified_document(self.base, {"tags": ["a", "c", "local"]})
+        self.resolver.resolve_both_updated(local, self.remote(tags=["a", "b", "c", "remote"]))
+        self.assertEqual(local.changes, {"tags": ["a", "c", "remote", "local"]})
+
+        authors = self.base["authors"]
+        local = modified_document(self.base, {"authors": authors[1:]})
+        three = {"forename": "C", "surname": "Three"}
+        self.resolver.resolve_both_updated(local, self.remote(authors=authors + [three]))
+        self.assertEqual(local.changes, {"authors": [authors[1], three]})
+
+    def test_lists_converge(self):
+        # the local removal was also made on the server
+        local = modified_document(self.base, {"tags": ["a", "c"]})
+        self.resolver.resolve_both_updated(local, self.remote(tags=["c", "a"]))
+        self.assertTrue(local.is_synced())
+
+class TestConflictSync(LocalServerTest):
+
+    def setUp(self):
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(10)
+        self.sclient = DummySyncedClient(client=create_local_client(self.server.base_url))
+        self.sclient.sync()
+        request_counts(reset=True)
+
+    def test_conflicts_resolved_without_refetch(self):
+        for doc_id in self.ids:
+            document = self.sclient.documents[doc_id]
+            document.update({"tags": document.object.tags + ["local"], "title": "local %d" % doc_id})
+            self.server.library.update_document(doc_id, {"tags": document.object.tags + ["remote"]})
+
+        self.sclient.sync()
+        calls = request_counts()
+        self.assertEqual(calls["document_details"], len(self.ids))
+        self.assertEqual(calls["update_document"], len(self.ids))
+
+        for doc_id in self.ids:
+            details = self.server.library.document_details(doc_id)
+            self.assertEqual(details["tags"][-2:], ["remote", "local"])
+            self.assertEqual(details["title"], "local %d" % doc_id)
+            self.assertTrue(self.sclient.documents[doc_id].is_synced())
+            self.assertEqual(self.sclient.documents[doc_id].version(), details["version"])
+
+if __name__ == "__main__":
+    unittest.main()
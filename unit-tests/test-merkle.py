@@ -0,0 +1,139 @@
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import create_local_client
+from merkle import MerkleTree
+from replica import DocumentReplica
+from synced_client import *
+from utils import LocalServerTest
+
+def build(pairs, depth=3):
+    tree = MerkleTree(depth)
+    for doc_id, version in pairs:
+        tree.update(doc_id, None, version)
+    return tree
+
+class TestMerkleTree(unittest.TestCase):
+
+    def setUp(self):
+        self.pairs = [(doc_id, doc_id * 10) for doc_id in range(1000)]
+
+    def test_order_independent(self):
+        shuffled = list(self.pairs)
+        random.Random(1).shuffle(shuffled)
+        tree = build(self.pairs)
+        self.assertEqual(tree.root(), build(shuffled).root())
+        self.assertEqual(len(tree), 1000)
+        self.assertNotEqual(tree.root(), build(self.pairs[1:]).root())
+        self.assertNotEqual(tree.root(), MerkleTree().root())
+
+    def test_incremental_updates(self):
+        tree = build(self.pairs)
+        root = tree.root()
+        tree.update(5, 50, 51)
+        self.assertNotEqual(tree.root(), root)
+        self.assertEqual(tree.root(), build(self.pairs[:5] + [(5, 51)] + self.pairs[6:]).root())
+        tree.update(5, 51, 50)
+        self.assertEqual(tree.root(), root)
+        tree.update(1000, None, 1)
+        tree.update(1000, 1, None)
+        self.assertEqual(tree.root(), root)
+
+    def test_diff(self):
+        tree = build(self.pairs)
+        other = build(self.pairs)
+        self.assertEqual(tree.diff(other), [])
+        self.assertEqual(tree.diff(tree), [])
+        other.update(3, 30, 31)
+        other.update(700, 7000, None)
+        other.update(2000, None, 1)
+        expected = sorted(set([tree.bucket(3), tree.bucket(700), tree.bucket(2000)]))
+        self.assertEqual(tree.diff(other), expected)
+        self.assertEqual(other.diff(tree), expected)
+
+    def test_pickle(self):
+        tree = build(self.pairs)
+        copy = pickle.loads(pickle.dumps(tree))
+        self.assertEqual(copy.root(), tree.root())
+        copy.update(1, 10, 11)
+        self.assertEqual(copy.diff(tree), [tree.bucket(1)])
+
+class TestLibraryFingerprint(LocalServerTest):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(30)
+
+    def tearDown(self):
+        LocalServerTest.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def create_client(self, name=None, cache_size=None, concurrency=4):
+        replica = None
+        if name is not None:
+            replica = DocumentReplica(os.path.join(self.directory, name), cache_size=cache_size)
+        return DummySyncedClient(client=create_local_client(self.server.base_url), replica=replica,
+                                 page_size=7, concurrency=concurrency)
+
+    def server_fingerprint(self):
+        return build(self.library.versions.items()).root()
+
+    def test_same_library_same_fingerprint(self):
+        sclients = [self.create_client(), self.create_client("replica.db"),
+                    self.create_client("bounded.db", cache_size=5)]
+        for sclient in sclients:
+            sclient.sync()
+            # built on first use, kept up to date afterwards
+            self.assertEqual(sclient.library_fingerprint(), self.server_fingerprint())
+
+        self.library.update_document(self.ids[0], {"title": "remote"})
+        self.library.delete_document(self.ids[1])
+        for i, sclient in enumerate(sclients):
+            sclient.documents[self.ids[2 + i]].update({"title": "local"})
+            sclient.sync(full=True)
+        for sclient in sclients:
+            sclient.sync(full=True)
+            self.assertEqual(sclient.library_fingerprint(), self.server_fingerprint())
+            sclient.documents.tree = None
+            self.assertEqual(sclient.library_fingerprint(), self.server_fingerprint())
+
+        # local changes don't change the synced versions
+        sclients[0].documents[self.ids[10]].update({"title": "not sent"})
+        self.assertEqual(sclients[0].library_fingerprint(), self.server_fingerprint())
+
+        # the replica of another process compares to the same tree
+        restarted = self.create_client("replica.db")
+        self.assertEqual(restarted.documents.merkle().diff(sclients[0].documents.merkle()), [])
+
+    def test_plan_checks_skipped_documents(self):
+        sclient = self.create_client(concurrency=1)
+        # the watermark is set after two syncs
+        sclient.sync()
+        sclient.sync()
+        plan = sclient.sync(dry_run=True)
+        self.assertFalse(plan.full)
+        self.assertEqual(plan.operations, [])
+
+        # changed with a version below the watermark, only the trees show it
+        self.library.update_document(self.ids[4], {"title": "remote"})
+        self.library.versions[self.ids[4]] = sclient.watermark - 1
+        plan = sclient.sync(dry_run=True)
+        self.assertTrue(plan.full)
+        self.assertEqual([(operation.kind, operation.doc_id) for operation in plan.operations],
+                         [("fetch", self.ids[4])])
+
+        self.library.delete_document(self.ids[5])
+        sclient.sync()
+        self.assertEqual(sclient.documents[self.ids[4]].object.title, "remote")
+        self.assertTrue(self.ids[5] not in sclient.documents)
+        self.assertEqual(sclient.library_fingerprint(), self.server_fingerprint())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import json
+import os
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from metrics import *
+
+class TestHistogram(unittest.TestCase):
+
+    def test_empty(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.count, 0)
+        self.assertEqual(histogram.quantile(0.5), None)
+
+    def test_quantiles(self):
+        histogram = Histogram()
+        for i in range(1, 1001):
+            histogram.observe(i / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertEqual(histogram.min, 0.001)
+        self.assertEqual(histogram.max, 1.0)
+        # the bucket bounds grow by 25% so the estimates should be close
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.5, delta=0.05)
+        self.assertAlmostEqual(histogram.quantile(0.99), 0.99, delta=0.1)
+        self.assertEqual(histogram.quantile(1.0), 1.0)
+
+    def test_overflow(self):
+        histogram = Histogram([1, 2])
+        histogram.observe(10)
+        self.assertEqual(histogram.counts, [0, 0, 1])
+        self.assertEqual(histogram.quantile(0.5), 10)
+
+    def test_merge(self):
+        histogram, other = Histogram([1, 2]), Histogram([1, 2])
+        histogram.observe(1.5)
+        other.observe(0.5)
+        other.observe(10)
+        histogram.merge(other)
+        self.assertEqual(histogram.counts, [1, 1, 1])
+        self.assertEqual((histogram.count, histogram.sum), (3, 12.0))
+        self.assertEqual((histogram.min, histogram.max), (0.5, 10))
+        histogram.merge(Histogram([1, 2]))
+        self.assertEqual((histogram.count, histogram.min, histogram.max), (3, 0.5, 10))
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry(enabled=True)
+        self.registry.record_latency("library", 0.2)
+        self.registry.record_latency("library", 0.4)
+        self.registry.record_status("library", 200)
+        self.registry.record_status("library", 404)
+        self.registry.record_bytes("library", 10, 2048)
+        self.registry.record_cache_hit("document_details")
+
+    def test_snapshot(self):
+        snapshot = self.registry.snapshot()
+        # must be serializable as is
+        snapshot = json.loads(json.dumps(snapshot))
+        library = snapshot["methods"]["library"]
+        self.assertEqual(library["latency"]["count"], 2)
+        self.assertEqual(library["status"], {"200": 1, "404": 1})
+        self.assertEqual(library["bytes_sent"], 10)
+        self.assertEqual(library["bytes_received"], 2048)
+        self.assertEqual(snapshot["methods"]["document_details"]["cache_hits"], 1)
+
+    def test_prometheus(self):
+        text = self.registry.to_prometheus()
+        self.assertTrue('mendeley_client_request_duration_seconds_count{method="library"} 2' in text)
+        self.assertTrue('mendeley_client_request_duration_seconds_bucket{method="library",le="+Inf"} 2' in text)
+        self.assertTrue('mendeley_client_responses_total{method="library",status="404"} 1' in text)
+        self.assertTrue('mendeley_client_response_bytes_total{method="library"} 2048' in text)
+
+    def test_current_method(self):
+        self.assertEqual(self.registry.current_method(), MetricsRegistry.UNKNOWN_METHOD)
+        previous = self.registry.set_current_method("library")
+        self.assertEqual(self.registry.current_method(), "library")
+        self.registry.set_current_method(previous)
+        self.assertEqual(self.registry.current_method(), MetricsRegistry.UNKNOWN_METHOD)
+
+    def test_reset(self):
+        self.registry.reset()
+        self.assertEqual(self.registry.snapshot()["methods"], {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+import os
+import threading
+import time
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+import metrics
+from concurrency import Stage, run_stages
+from local_server import create_local_client
+from synced_client import *
+from utils import LocalServerTest
+
+class TestStage(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+        metrics.registry.enable()
+
+    def tearDown(self):
+        metrics.registry.disable()
+
+    def test_chain(self):
+        results = []
+        lock = threading.Lock()
+        def collect(item):
+            with lock:
+                results.append(item)
+        last = Stage("last", collect, workers=2)
+        first = Stage("first", lambda item: last.put(item * 2), workers=3)
+        first.start()
+        last.start()
+        for i in range(20):
+            first.put(i)
+        first.close()
+        run_stages([first, last])
+        self.assertEqual(sorted(results), [i * 2 for i in range(20)])
+
+        stages = metrics.registry.snapshot()["stages"]
+        self.assertEqual(stages["first"]["items"], 20)
+        self.assertEqual(stages["last"]["queue_depth"]["count"], 20)
+
+    def test_backpressure(self):
+        stage = Stage("slow", lambda item: time.sleep(0.01), workers=1, maxsize=2).start()
+        for i in range(10):
+            stage.put(i)
+            self.assertTrue(stage.queue.qsize() <= 2)
+        stage.close()
+        run_stages([stage])
+        self.assertTrue(metrics.registry.snapshot()["stages"]["slow"]["put_wait_seconds"] > 0)
+
+    def test_error(self):
+        def fail(item):
+            if item == 3:
+                raise ValueError(item)
+        first = Stage("first", fail, workers=2).start()
+        last = Stage("last", lambda item: None).start()
+        # the producers don't block once a stage failed
+        for i in range(50):
+            first.put(i)
+        first.close()
+        self.assertRaises(ValueError, run_stages, [first, last])
+
+class TestPipelinedSync(LocalServerTest):
+
+    def setUp(self):
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(30)
+
+    def create_client(self, concurrency=4):
+        return DummySyncedClient(client=create_local_client(self.server.base_url),
+                                 page_size=7, concurrency=concurrency)
+
+    def test_same_result_as_sequential(self):
+        sclients = [self.create_client(1), self.create_client(4)]
+        for sclient in sclients:
+            sclient.sync()
+        self.library.update_document(self.ids[0], {"title": "remote"})
+        for i, sclient in enumerate(sclients):
+            sclient.documents[self.ids[1]].update({"title": "local %d" % i})
+            sclient.sync()
+            self.assertEqual(sclient.documents[self.ids[0]].object.title, "remote")
+            self.assertEqual(self.library.document_details(self.ids[1])["title"], "local %d" % i)
+
+        # picks up the change sent by the other
+        sclients[0].sync()
+        for doc_id in self.ids:
+            first, second = sclients[0].documents[doc_id], sclients[1].documents[doc_id]
+            self.assertEqual((first.version(), first.object.title), (second.version(), second.object.title))
+            self.assertTrue(sclients[1].documents[doc_id].is_synced())
+
+        stages = metrics.registry.snapshot()["stages"]
+        for name in ["reconcile", "fetch", "apply", "push"]:
+            self.assertTrue(stages[name]["items"] > 0)
+        self.assertTrue("stage_queue_depth_bucket" in metrics.registry.to_prometheus())
+
+    def test_creations_and_deletions_after_listing(self):
+        sclient = self.create_client()
+        sclient.sync()
+        sclient.documents[self.ids[2]].delete()
+        sclient.documents[self.ids[20]].update({"title": "local"})
+        new_document = sclient.add_new_local_document({"type": "Book", "title": "new"})
+
+        listed = []
+        library = sclient.client.library
+        def recording_library(page, items):
+            listed.append(page)
+            # nothing created or deleted before the last page is listed
+            if len(listed) < 5:
+                self.assertEqual(len(self.library.library), 30)
+            return library(page=page, items=items)
+        sclient.client.library = recording_library
+        sclient.sync()
+
+        self.assertEqual(sorted(listed), range(5))
+        self.assertTrue(self.ids[2] not in self.library.versions)
+        self.assertEqual(self.library.document_details(self.ids[20])["title"], "local")
+        self.assertTrue(new_document.is_synced())
+        self.assertEqual(sclient.new_documents, [])
+        self.assertEqual(len(sclient.documents), 30)
+
+    def test_conflicts(self):
+        sclient = self.create_client()
+        sclient.sync()
+        document = sclient.documents[self.ids[5]]
+        document.update({"tags": document.object.tags + ["local"]})
+        self.library.update_document(self.ids[5], {"tags": document.object.tags + ["remote"]})
+        sclient.documents[self.ids[6]].update({"title": "local"})
+        self.library.delete_document(self.ids[6])
+        sclient.sync()
+
+        self.assertEqual(self.library.document_details(self.ids[5])["tags"][-2:], ["remote", "local"])
+        self.assertTrue(document.is_synced())
+        # the default resolver recreates documents modified locally
+        self.assertEqual(len(sclient.documents), 30)
+        self.assertTrue(self.ids[6] not in sclient.documents)
+        self.assertEqual(sclient.modified_ids | sclient.deleted_ids, set())
+
+    def test_conflicts_resolved_after_fetching(self):
+        sclient = self.create_client()
+        sclient.sync()
+        for doc_id in [self.ids[1], self.ids[25]]:
+            sclient.documents[doc_id].update({"title": "local"})
+            self.library.update_document(doc_id, {"abstract": "remote"})
+        for doc_id in self.ids[10:20]:
+            self.library.update_document(doc_id, {"title": "remote"})
+
+        fetched = []
+        fetch_document = sclient.fetch_document
+        def recording_fetch_document(doc_id):
+            fetched.append(doc_id)
+            return fetch_document(doc_id)
+        sclient.fetch_document = recording_fetch_document
+        resolved = []
+        resolve_both_updated = sclient.conflict_resolver.resolve_both_updated
+        def recording_resolve(local_document, remote_document):
+            resolved.append(len(fetched))
+            return resolve_both_updated(local_document, remote_document)
+        sclient.conflict_resolver.resolve_both_updated = recording_resolve
+        try:
+            sclient.sync()
+        finally:
+            del sclient.conflict_resolver.resolve_both_updated
+
+        self.assertEqual(resolved, [12, 12])
+        for doc_id in [self.ids[1], self.ids[25]]:
+            details = self.library.document_details(doc_id)
+            self.assertEqual((details["title"], details["abstract"]), ("local", "remote"))
+
+if __name__ == "__main__":
+    unittest.main()
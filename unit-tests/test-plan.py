@@ -0,0 +1,130 @@
+import os
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import create_local_client
+from synced_client import *
+from utils import LocalServerTest, request_counts
+
+class TestPlanOperations(unittest.TestCase):
+
+    def test_operations(self):
+        listed = [("new", 1), ("same", 2), ("changed", 3), ("both", 4), ("deleted_changed", 5)]
+        local_states = {"same": (2, SyncStatus.Synced),
+                        "changed": (1, SyncStatus.Synced),
+                        "both": (1, SyncStatus.Modified),
+                        "deleted_changed": (1, SyncStatus.Deleted),
+                        "gone": (1, SyncStatus.Synced),
+                        "gone_modified": (1, SyncStatus.Modified),
+                        "modified": (1, SyncStatus.Modified),
+                        "deleted": (1, SyncStatus.Deleted)}
+        new_document = SyncedDocument({"title": "new"})
+        operations = plan_operations(listed, local_states, set(["gone", "gone_modified"]),
+                                     set(["modified", "deleted", "both", "gone_modified", "unknown"]),
+                                     [new_document])
+        self.assertEqual([(operation.kind, operation.doc_id, operation.remote_version) for operation in operations],
+                         [("fetch", "new", 1), ("fetch", "changed", 3), ("conflict", "both", 4),
+                          ("conflict", "deleted_changed", 5), ("remove", "gone", None),
+                          ("conflict", "gone_modified", None), ("update", "both", None),
+                          ("delete", "deleted", None), ("update", "modified", None), ("create", None, None)])
+        self.assertTrue(operations[-1].document is new_document)
+        self.assertEqual([operation.fetches() for operation in operations],
+                         [True, True, True, True, False, False, False, False, False, False])
+
+        plan = SyncPlan(True, operations, 2)
+        self.assertEqual(plan.counts(), {"fetch": 2, "conflict": 3, "remove": 1, "update": 2, "delete": 1, "create": 1})
+        self.assertEqual(plan.estimated_requests(), 2 + 9)
+
+class TestDryRun(LocalServerTest):
+
+    def setUp(self):
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(20)
+        self.sclient = DummySyncedClient(client=create_local_client(self.server.base_url),
+                                         page_size=7, concurrency=1)
+        self.sclient.sync()
+        request_counts(reset=True)
+
+    def make_changes(self):
+        self.library.update_document(self.ids[0], {"title": "remote"})
+        self.library.delete_document(self.ids[1])
+        self.sclient.documents[self.ids[2]].update({"title": "local"})
+        self.sclient.documents[self.ids[3]].delete()
+        self.sclient.add_new_local_document({"type": "Book", "title": "new"})
+
+    def test_dry_run_changes_nothing(self):
+        self.make_changes()
+        versions = dict(self.library.versions)
+        states = self.sclient.documents.states(self.ids)
+        dirty = (set(self.sclient.modified_ids), set(self.sclient.deleted_ids))
+
+        plan = self.sclient.sync(full=True, dry_run=True)
+        self.assertTrue(plan.full)
+        self.assertEqual(plan.counts(), {"fetch": 1, "conflict": 0, "remove": 1, "update": 1, "delete": 1, "create": 1})
+        self.assertEqual(plan.estimated_requests(), 3 + 4)
+        self.assertEqual(plan.remote_deleted_ids, set([self.ids[1]]))
+
+        # only the library was listed
+        self.assertEqual(request_counts(reset=True), {"library": 3})
+        self.assertEqual(self.library.versions, versions)
+        self.assertEqual(self.sclient.documents.states(self.ids), states)
+        self.assertEqual((self.sclient.modified_ids, self.sclient.deleted_ids), dirty)
+        self.assertEqual(len(self.sclient.new_documents), 1)
+
+        # the plan is what the sync does
+        self.sclient.execute_plan(plan)
+        self.assertEqual(sum(request_counts(reset=True).values()), plan.estimated_requests() - plan.listing_requests)
+        self.assertEqual(self.sclient.documents[self.ids[0]].object.title, "remote")
+        self.assertTrue(self.ids[1] not in self.sclient.documents)
+        self.assertEqual(self.library.document_details(self.ids[2])["title"], "local")
+        self.assertTrue(self.ids[3] not in self.library.versions)
+        self.assertEqual(self.sclient.new_documents, [])
+        self.assertEqual((self.sclient.modified_ids, self.sclient.deleted_ids), (set(), set()))
+
+    def test_incremental_plan(self):
+        self.sclient.sync()
+        self.library.update_document(self.ids[5], {"title": "remote"})
+        plan = self.sclient.sync(dry_run=True)
+        self.assertFalse(plan.full)
+        self.assertEqual([(operation.kind, operation.doc_id) for operation in plan.operations],
+                         [("fetch", self.ids[5])])
+
+        # documents missing from the library make it a full plan
+        self.library.delete_document(self.ids[6])
+        plan = self.sclient.sync(dry_run=True)
+        self.assertTrue(plan.full)
+        self.assertEqual(sorted((operation.kind, operation.doc_id) for operation in plan.operations),
+                         [("fetch", self.ids[5]), ("remove", self.ids[6])])
+
+    def test_plan_then_delta_sync(self):
+        self.sclient.execute_plan(self.sclient.sync(dry_run=True))
+        self.assertEqual(self.sclient.syncs_since_full, 0)
+        self.assertEqual(self.sclient.documents.load_meta("checkpoint"), None)
+
+        # the watermark of the plan is kept, the next sync is incremental
+        self.library.update_document(self.ids[5], {"title": "remote"})
+        request_counts(reset=True)
+        self.sclient.sync()
+        self.assertEqual(self.sclient.syncs_since_full, 1)
+        self.assertEqual(self.sclient.documents[self.ids[5]].object.title, "remote")
+        self.assertEqual(request_counts(reset=True)["document_details"], 1)
+
+    def test_conflicts(self):
+        self.library.update_document(self.ids[0], {"title": "remote"})
+        self.sclient.documents[self.ids[0]].update({"abstract": "local"})
+        self.library.delete_document(self.ids[1])
+        self.sclient.documents[self.ids[1]].update({"title": "local"})
+        plan = self.sclient.sync(full=True, dry_run=True)
+        self.assertEqual(plan.counts()["conflict"], 2)
+
+        self.sclient.sync(full=True)
+        self.assertEqual(self.library.document_details(self.ids[0])["title"], "remote")
+        self.assertEqual(self.library.document_details(self.ids[0])["abstract"], "local")
+        # recreated by the default resolver
+        self.assertEqual(len(self.library.library), 20)
+        self.assertTrue(self.ids[1] not in self.sclient.documents)
+        self.assertEqual(self.sclient.sync(dry_run=True).operations, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import create_local_client
+from synced_client import *
+from utils import LocalServerTest
+
+class TestPush(LocalServerTest):
+
+    def setUp(self):
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(10)
+
+    def create_client(self, concurrency):
+        sclient = DummySyncedClient(client=create_local_client(self.server.base_url), concurrency=concurrency)
+        sclient.sync()
+        return sclient
+
+    def make_changes(self, sclient):
+        for doc_id in self.ids[:4]:
+            sclient.documents[doc_id].update({"title": "local"})
+        for doc_id in self.ids[4:7]:
+            sclient.documents[doc_id].delete()
+        return [sclient.add_new_local_document({"type": "Book", "title": "new %d" % i}) for i in range(3)]
+
+    def break_client(self, sclient):
+        client = sclient.client
+        update_document, delete_library_document, create_document = \
+            client.update_document, client.delete_library_document, client.create_document
+        def failing_update_document(doc_id, document):
+            if doc_id == self.ids[0]:
+                return {"error": "rejected"}
+            return update_document(doc_id, document=document)
+        def failing_delete_library_document(doc_id):
+            if doc_id == self.ids[4]:
+                raise IOError("connection reset")
+            return delete_library_document(doc_id)
+        def failing_create_document(document):
+            if document["title"] == "new 0":
+                return {"document_id": 1}
+            return create_document(document=document)
+        client.update_document = failing_update_document
+        client.delete_library_document = failing_delete_library_document
+        client.create_document = failing_create_document
+        return lambda: (setattr(client, "update_document", update_document),
+                        setattr(client, "delete_library_document", delete_library_document),
+                        setattr(client, "create_document", create_document))
+
+    def check_failures(self, concurrency):
+        sclient = self.create_client(concurrency)
+        new_documents = self.make_changes(sclient)
+        repair = self.break_client(sclient)
+        sclient.sync()
+
+        failed = sorted((result.operation, result.doc_id, result.error)
+                        for result in sclient.push_results if not result.succeeded())
+        self.assertEqual(failed, [("create", None, "no version in the response"),
+                                  ("delete", self.ids[4], "IOError: connection reset"),
+                                  ("update", self.ids[0], "rejected")])
+        self.assertEqual(len([result for result in sclient.push_results if result.succeeded()]), 7)
+        for result in sclient.push_results:
+            if result.succeeded() and result.operation != "delete":
+                self.assertEqual(result.version, self.library.versions[result.doc_id])
+
+        # the failed changes are kept and sent by the next sync
+        self.assertEqual(sclient.modified_ids, set([self.ids[0]]))
+        self.assertEqual(sclient.deleted_ids, set([self.ids[4]]))
+        self.assertEqual(sclient.new_documents, [new_documents[0]])
+        self.assertTrue(new_documents[1].is_synced())
+        self.assertEqual(self.library.document_details(self.ids[1])["title"], "local")
+        self.assertTrue(self.ids[5] not in self.library.versions)
+
+        repair()
+        sclient.sync()
+        self.assertTrue(all(result.succeeded() for result in sclient.push_results))
+        self.assertEqual(len(sclient.push_results), 3)
+        self.assertEqual(self.library.document_details(self.ids[0])["title"], "local")
+        self.assertTrue(self.ids[4] not in self.library.versions)
+        self.assertTrue(new_documents[0].is_synced())
+        self.assertEqual(len(self.library.library), 10 - 3 + 3)
+
+    def test_failures_one_worker(self):
+        self.check_failures(1)
+
+    def test_failures_pipelined(self):
+        self.check_failures(4)
+
+    def test_concurrent_staged_push(self):
+        sclient = self.create_client(4)
+        self.make_changes(sclient)
+        lock = threading.Lock()
+        in_flight = [0, 0]
+        def slow(method):
+            def call(*args, **kwargs):
+                with lock:
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight)
+                time.sleep(0.02)
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    with lock:
+                        in_flight[0] -= 1
+            return call
+        for name in ["update_document", "delete_library_document", "create_document"]:
+            setattr(sclient.client, name, slow(getattr(sclient.client, name)))
+
+        results = sclient.sync_local_changes(set()) + sclient.send_new_documents()
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(result.succeeded() for result in results))
+        self.assertTrue(1 < in_flight[1] <= 4)
+
+if __name__ == "__main__":
+    unittest.main()
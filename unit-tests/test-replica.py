@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import create_local_client
+from replica import DocumentReplica
+from synced_client import *
+from utils import LocalServerTest, request_counts
+
+class TestReplica(LocalServerTest):
+
+    cache_size = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "replica.db")
+        LocalServerTest.setUp(self)
+        self.ids = self.library.seed_documents(20)
+
+    def tearDown(self):
+        LocalServerTest.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def restart(self):
+        """A new client using the same replica, like after a process restart"""
+        return DummySyncedClient(client=create_local_client(self.server.base_url),
+                                 replica=DocumentReplica(self.filename, cache_size=self.cache_size),
+                                 page_size=7)
+
+    def test_restart_fetches_nothing(self):
+        sclient = self.restart()
+        sclient.sync()
+        self.assertEqual(request_counts(reset=True)["document_details"], 20)
+
+        sclient = self.restart()
+        self.assertEqual(sorted(sclient.documents.keys()), self.ids)
+        sclient.sync()
+        self.assertEqual(request_counts(reset=True)["document_details"], 0)
+
+        # only the documents modified on the server are fetched
+        self.server.library.update_document(self.ids[0], {"title": "remote"})
+        sclient = self.restart()
+        sclient.sync()
+        self.assertEqual(request_counts(reset=True)["document_details"], 1)
+        self.assertEqual(sclient.documents[self.ids[0]].object.title, "remote")
+        self.assertTrue(sclient.documents[self.ids[0]].is_synced())
+
+    def test_pending_changes_survive_restart(self):
+        sclient = self.restart()
+        sclient.sync()
+        sclient.documents[self.ids[0]].update({"title": "local"})
+        sclient.documents[self.ids[1]].delete()
+        new_document = sclient.add_new_local_document({"type": "Book", "title": "new"})
+        new_document.update({"year": 2001})
+
+        sclient = self.restart()
+        self.assertTrue(sclient.documents[self.ids[0]].is_modified())
+        self.assertEqual(sclient.documents[self.ids[0]].changes, {"title": "local"})
+        self.assertTrue(sclient.documents[self.ids[1]].is_deleted())
+        self.assertEqual(len(sclient.new_documents), 1)
+        self.assertEqual(sclient.new_documents[0].object.year, 2001)
+
+        sclient.sync()
+        self.assertEqual(self.server.library.document_details(self.ids[0])["title"], "local")
+        self.assertTrue(self.ids[1] not in self.server.library.versions)
+        self.assertEqual(len(self.server.library.library), 20)
+
+        sclient = self.restart()
+        self.assertEqual(len(sclient.new_documents), 0)
+        self.assertEqual(len(sclient.documents), 20)
+        for document in sclient.documents.values():
+            self.assertTrue(document.is_synced())
+
+class TestBoundedReplica(TestReplica):
+
+    cache_size = 3
+
+    def test_bounded_cache(self):
+        sclient = self.restart()
+        sclient.sync()
+        self.assertTrue(len(sclient.documents.loaded) <= 3)
+        self.assertEqual(len(sclient.documents), 20)
+        self.assertEqual(sorted(sclient.documents), self.ids)
+
+        # documents with local changes stay loaded
+        for doc_id in self.ids[:5]:
+            sclient.documents[doc_id].update({"title": "local"})
+        for doc_id in self.ids[5:]:
+            sclient.documents[doc_id]
+        self.assertEqual(sorted(sclient.documents.pinned.keys()), self.ids[:5])
+        self.assertTrue(len(sclient.documents.loaded) <= 3)
+        self.assertEqual(sclient.documents.state(self.ids[0])[1], SyncStatus.Modified)
+        self.assertEqual(sclient.documents.dirty_ids(), (set(self.ids[:5]), set()))
+
+        sclient.sync()
+        # the synced documents are dropped as others are loaded
+        sclient.documents[self.ids[10]]
+        self.assertTrue(len(sclient.documents.loaded) <= 3)
+        self.assertEqual(sclient.documents.pinned, {})
+
+        # changed without being saved while in the cache
+        document = sclient.documents[self.ids[11]]
+        document.status = SyncStatus.Modified
+        for doc_id in self.ids[12:16]:
+            sclient.documents[doc_id]
+        self.assertTrue(sclient.documents.pinned[self.ids[11]] is document)
+        for doc_id in self.ids[:5]:
+            self.assertEqual(self.server.library.document_details(doc_id)["title"], "local")
+
+    def test_full_sync_deletions(self):
+        sclient = self.restart()
+        sclient.sync()
+        self.server.library.delete_document(self.ids[4])
+        self.server.library.delete_document(self.ids[12])
+        sclient.sync(full=True)
+        self.assertEqual(sorted(sclient.documents.keys()), self.ids[:4] + self.ids[5:12] + self.ids[13:])
+        self.assertEqual(sclient.documents.count_listed(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
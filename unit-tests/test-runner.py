@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from local_server import LocalServer, create_local_client
+from mendeley_client import MendeleyTokensStore
+from sync_runner import sync_accounts
+
+class LocalClientFactory(object):
+    """Clients of the local server of each account"""
+
+    def __init__(self, base_urls):
+        self.base_urls = base_urls
+
+    def __call__(self, account, access_token):
+        if account not in self.base_urls:
+            raise KeyError(account)
+        return create_local_client(self.base_urls[account], access_token)
+
+class TestRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.servers = {}
+        self.store = MendeleyTokensStore(None)
+        for i in range(6):
+            account = "account%d" % i
+            server = self.servers[account] = LocalServer().start()
+            server.library.seed_documents(5 + i)
+            self.store.add_account(account, "token%d" % i)
+
+    def tearDown(self):
+        for server in self.servers.values():
+            server.stop()
+        shutil.rmtree(self.directory)
+
+    def factory(self):
+        return LocalClientFactory(dict((account, server.base_url) for account, server in self.servers.items()))
+
+    def test_sync_accounts(self):
+        replicas = os.path.join(self.directory, "replicas")
+        report = sync_accounts(self.store, self.factory(), processes=2, accounts_per_process=2,
+                               connections=4, page_size=3, replica_directory=replicas)
+        self.assertEqual(report["accounts"], 6)
+        self.assertEqual(report["failed"], [])
+        self.assertEqual([result.account for result in report["results"]], sorted(self.servers))
+        self.assertEqual([result.documents for result in report["results"]], range(5, 11))
+        self.assertEqual(report["sync_seconds"]["count"], 6)
+        self.assertEqual(report["requests"]["document_details"], sum(range(5, 11)))
+        self.assertEqual(report["request_latency"]["count"], sum(report["requests"].values()))
+        self.assertTrue(report["accounts_per_second"] > 0)
+
+        # each account has its own replica
+        self.servers["account1"].library.seed_documents(2)
+        report = sync_accounts(self.store, self.factory(), processes=2, replica_directory=replicas)
+        self.assertEqual(report["requests"]["document_details"], 2)
+        self.assertEqual(report["results"][1].documents, 8)
+        self.assertEqual(sorted(os.listdir(replicas))[:2], ["account0.db", "account1.db"])
+
+    def test_failures_are_isolated(self):
+        self.store.add_account("unknown", "token")
+        self.servers["account2"].stop()
+        del self.servers["account2"]
+        report = sync_accounts(self.store, self.factory(), processes=3)
+        self.assertEqual(report["accounts"], 7)
+        self.assertEqual(sorted(result.account for result in report["failed"]), ["account2", "unknown"])
+        for result in report["results"]:
+            if result.succeeded():
+                self.assertEqual(result.documents, 5 + int(result.account[-1]))
+        self.assertEqual(report["sync_seconds"]["count"], 5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,7 @@ from utils import *
 parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
 os.sys.path.insert(0, parent_dir) 
 from synced_client import *
+from local_server import LocalServer, create_local_client
 
 class TestEnv:
     sclient = None
@@ -68,6 +69,22 @@ class TestDocumentsSyncing(unittest.TestCase):
         for document in TestEnv.sclient.documents.values():
             self.assertTrue(document.is_synced())
 
+    def test_fetch_paged(self):
+        count = 5
+        ids = TestEnv.seed_library(count)
+
+        # use pages smaller than the library
+        page_size = TestEnv.sclient.page_size
+        TestEnv.sclient.page_size = 2
+        try:
+            TestEnv.sclient.sync()
+        finally:
+            TestEnv.sclient.page_size = page_size
+
+        self.assertEqual(sorted(ids), sorted(TestEnv.sclient.documents.keys()))
+        for document in TestEnv.sclient.documents.values():
+            self.assertTrue(document.is_synced())
+
     def test_new_local(self):
         count = 5
         ids = TestEnv.seed_library(count)
@@ -325,7 +342,13 @@ class TestDocumentsSyncing(unittest.TestCase):
         self.assertTrue(local_document.version() > original_version)            
 
 def main(config_file):
-    sclient = DummySyncedClient(config_file)
+    if use_local_server():
+        server = LocalServer().start()
+        sclient = DummySyncedClient(client=create_local_client(server.base_url))
+        # the local server versions can't collide
+        TestEnv.sleep_time = 0
+    else:
+        sclient = DummySyncedClient(config_file)
 
     # verify that the version number is available on this server before running all the tests
     document = TemporaryDocument(sclient.client).document()
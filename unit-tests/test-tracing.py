@@ -0,0 +1,112 @@
+import json
+import os
+import tempfile
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+import tracing
+from concurrency import bounded_imap
+from local_server import LocalServer, create_local_client
+from tracing import *
+
+class RecordingHook(TraceHook):
+
+    def __init__(self):
+        self.spans = []
+
+    def span_finished(self, span):
+        self.spans.append(span)
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = Tracer()
+        self.hook = RecordingHook()
+
+    def test_disabled(self):
+        self.assertFalse(self.tracer.enabled)
+        with self.tracer.span("call", method="library"):
+            pass
+        self.tracer.add_span("queue", 0, 1)
+        self.assertEqual(self.hook.spans, [])
+
+    def test_nested_spans_inherit_method(self):
+        self.tracer.add_hook(self.hook)
+        with self.tracer.span("call", method="library") as call:
+            with self.tracer.span("decode") as decode:
+                pass
+            self.tracer.add_span("time_to_first_byte", call.start, 0.1)
+
+        names = [span.name for span in self.hook.spans]
+        self.assertEqual(names, ["decode", "time_to_first_byte", "call"])
+        for span in self.hook.spans:
+            self.assertEqual(span.method(), "library")
+        self.assertTrue(decode.parent is call)
+        self.assertTrue(call.duration() >= decode.duration())
+
+    def test_error_is_recorded(self):
+        self.tracer.add_hook(self.hook)
+        try:
+            with self.tracer.span("call"):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.hook.spans[0].args["error"], "ValueError")
+
+    def test_queue_span_has_method(self):
+        self.tracer.add_hook(self.hook)
+        self.tracer.queued(10)
+        self.tracer.add_queue_span()
+        with self.tracer.span("call", method="document_details"):
+            self.tracer.queued(20)
+            self.tracer.add_queue_span()
+            # only recorded once
+            self.tracer.add_queue_span()
+        self.tracer.queued(30)
+        self.tracer.queued(None)
+        self.tracer.add_queue_span()
+        queues = [span for span in self.hook.spans if span.name == "queue"]
+        self.assertEqual([(span.start, span.method()) for span in queues], [(10, None), (20, "document_details")])
+        self.assertTrue(queues[1].duration() > 0)
+
+    def test_chrome_trace(self):
+        fd, filename = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            with trace_to_file(filename, self.tracer):
+                with self.tracer.span("call", method="library"):
+                    pass
+            self.assertFalse(self.tracer.enabled)
+            trace = json.load(open(filename))
+        finally:
+            os.remove(filename)
+
+        events = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["name"], "call")
+        self.assertEqual(events[0]["cat"], "library")
+        self.assertTrue(events[0]["dur"] >= 0)
+
+class TestPooledCalls(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalServer().start()
+        self.hook = RecordingHook()
+        tracing.tracer.add_hook(self.hook)
+
+    def tearDown(self):
+        tracing.tracer.remove_hook(self.hook)
+        self.server.stop()
+
+    def test_queue_spans(self):
+        ids = self.server.library.seed_documents(6)
+        client = create_local_client(self.server.base_url)
+        details = list(bounded_imap(client.document_details, ids, 2))
+        self.assertEqual([document["id"] for document in details], ids)
+        queues = [span for span in self.hook.spans if span.name == "queue"]
+        self.assertEqual(len(queues), 6)
+        self.assertTrue(all(span.method() == "document_details" for span in queues))
+
+if __name__ == "__main__":
+    unittest.main()
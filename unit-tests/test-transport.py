@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+from transport import *
+from local_server import LocalServer, create_local_client
+
+class TestRecordReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cassette = os.path.join(self.directory, "test.cassette")
+        self.server = LocalServer().start()
+        self.server.library.seed_documents(3)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def record(self):
+        recorder = RecordingTransport(self.cassette)
+        client = create_local_client(self.server.base_url, transport=recorder)
+        library = client.library()
+        created = client.create_document(document={"type": "Book", "title": "recorded"})
+        details = client.document_details(created["document_id"])
+        updated = client.update_document(created["document_id"], document={"title": "updated"})
+        details_after = client.document_details(created["document_id"])
+        recorder.close()
+        return library, created, details, updated, details_after
+
+    def replay(self, created, transport):
+        client = create_local_client(self.server.base_url, transport=transport)
+        library = client.library()
+        client.create_document(document={"type": "Book", "title": "recorded"})
+        details = client.document_details(created["document_id"])
+        client.update_document(created["document_id"], document={"title": "updated"})
+        details_after = client.document_details(created["document_id"])
+        return library, details, details_after
+
+    def test_replay(self):
+        library, created, details, updated, details_after = self.record()
+        # the server isn't needed anymore
+        self.server.library.clear()
+
+        replayed = self.replay(created, ReplayTransport(self.cassette))
+        self.assertEqual(replayed, (library, details, details_after))
+        self.assertEqual(replayed[2]["title"], "updated")
+
+    def test_miss(self):
+        self.record()
+        client = create_local_client(self.server.base_url, transport=ReplayTransport(self.cassette))
+        # the body doesn't match the recorded one
+        self.assertRaises(ReplayMissError, client.create_document, document={"type": "Book", "title": "other"})
+
+    def test_simulated_latency(self):
+        library, created, details, updated, details_after = self.record()
+        transport = ReplayTransport(self.cassette, latency=0.05)
+        start = time.time()
+        self.replay(created, transport)
+        self.assertTrue(time.time() - start >= 5 * 0.05)
+
+if __name__ == "__main__":
+    unittest.main()
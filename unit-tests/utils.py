@@ -1,7 +1,15 @@
 import calendar
+import collections
 import os
 import sys
 import time
+import unittest
+
+parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+os.sys.path.insert(0, parent_dir)
+
+import metrics
+from local_server import LocalServer
 
 def timed(fn):
     def wrapped(*args, **kwargs):
@@ -44,6 +52,41 @@ def get_config_file():
             del sys.argv[1]    
     return config_file
 
+def use_local_server():
+    """Return True if the tests should run against local_server.py
+       instead of the real api (--local on the command line)"""
+    if "--local" in sys.argv:
+        sys.argv.remove("--local")
+        return True
+    return False
+
+def request_counts(reset=False, field=None):
+    """{method name: api calls} recorded by the metrics registry, or the
+       count field of their metrics, e.g. retries, 0 for the methods not
+       called. Reset afterwards if reset so the next call only counts the
+       new ones."""
+    methods = metrics.registry.snapshot()["methods"]
+    if reset:
+        metrics.registry.reset()
+    counts = collections.defaultdict(int)
+    for name, method in methods.items():
+        counts[name] = method["latency"]["count"] if field is None else method[field]
+    return counts
+
+class LocalServerTest(unittest.TestCase):
+    """Runs a local_server.LocalServer, self.server, for each test with the
+       api calls recorded by the metrics registry, see request_counts"""
+
+    def setUp(self):
+        self.server = LocalServer().start()
+        self.library = self.server.library
+        metrics.registry.reset()
+        metrics.registry.enable()
+
+    def tearDown(self):
+        metrics.registry.disable()
+        self.server.stop()
+
 class TemporaryDocument:
 
     def __init__(self, client):